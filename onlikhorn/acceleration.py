@@ -0,0 +1,91 @@
+import numpy as np
+import torch
+
+
+class Relaxation:
+    """Successive over-relaxation of the Sinkhorn fixed-point map: z <- z + omega (T(z) - z).
+
+    With omega='adaptive', omega is set from the observed contraction rate theta of the residuals,
+    omega = 2 / (1 + sqrt(1 - theta)), capped at omega_max. Whenever the residual increases, the step
+    falls back to the plain update (omega = 1).
+    """
+
+    def __init__(self, omega=1.5, omega_max=1.9):
+        self.adaptive = omega == 'adaptive'
+        self.omega = 1. if self.adaptive else omega
+        self.omega_max = omega_max
+        self.last_err = None
+        self.n_fallbacks_ = 0
+
+    def __call__(self, z, new_z, err):
+        omega = self.omega
+        if self.last_err is not None:
+            if err > self.last_err:
+                omega = 1.
+                self.n_fallbacks_ += 1
+            elif self.adaptive and self.last_err > 0:
+                theta = err / self.last_err
+                self.omega = min(2 / (1 + np.sqrt(max(1 - theta, 0))), self.omega_max)
+        self.last_err = err
+        if omega == 1.:
+            return new_z
+        return z + omega * (new_z - z)
+
+
+class AndersonMixing:
+    """Anderson acceleration (type II) of the Sinkhorn fixed-point map, with a bounded history.
+
+    The mixing coefficients solve a Tikhonov-regularized least-squares problem on the last `depth` residual
+    differences. Whenever the residual increases, the history is cleared and the plain update is used.
+    """
+
+    def __init__(self, depth=5, reg=1e-10):
+        self.depth = depth
+        self.reg = reg
+        self.last_err = None
+        self.n_fallbacks_ = 0
+        self.reset()
+
+    def reset(self):
+        self.last_z, self.last_residual = None, None
+        self.dz, self.dresidual = [], []
+
+    def __call__(self, z, new_z, err):
+        residual = new_z - z
+        if self.last_err is not None and err > self.last_err:
+            self.last_err = err
+            self.n_fallbacks_ += 1
+            self.reset()
+            return new_z
+        self.last_err = err
+        if self.last_z is not None:
+            self.dz.append(z - self.last_z)
+            self.dresidual.append(residual - self.last_residual)
+            if len(self.dz) > self.depth:
+                self.dz.pop(0)
+                self.dresidual.pop(0)
+        self.last_z, self.last_residual = z, residual
+        if len(self.dz) == 0:
+            return new_z
+        dz = torch.stack(self.dz, dim=1)
+        dresidual = torch.stack(self.dresidual, dim=1)
+        gram = dresidual.transpose(0, 1) @ dresidual
+        gram += self.reg * gram.diagonal().max().clamp_min(1e-30) * torch.eye(len(gram), dtype=gram.dtype,
+                                                                              device=gram.device)
+        gamma = torch.linalg.solve(gram, dresidual.transpose(0, 1) @ residual)
+        mixed = new_z - (dz + dresidual) @ gamma
+        if not torch.all(torch.isfinite(mixed)):
+            self.reset()
+            return new_z
+        return mixed
+
+
+def make_accelerator(acceleration, omega=1.5, depth=5):
+    if acceleration is None:
+        return None
+    elif acceleration == 'sor':
+        return Relaxation(omega=omega)
+    elif acceleration == 'anderson':
+        return AndersonMixing(depth=depth)
+    else:
+        raise ValueError(f'Unknown acceleration {acceleration}')
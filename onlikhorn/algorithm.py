@@ -1,12 +1,25 @@
+import logging
+import os
 import time
 import warnings
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from typing import Optional, Union, List, Tuple
 
 import numpy as np
 import torch
-from pykeops.torch import LazyTensor
 
-from onlikhorn.data import Subsampler
+from onlikhorn.acceleration import make_accelerator
+from onlikhorn.backend import BACKENDS, select_backend
+from onlikhorn.data import Subsampler, PrefetchSampler
+from onlikhorn.cache import BlockCostCache
+from onlikhorn.checkpoint import load_checkpoint, load_sampler_state, rng_state, sampler_state, save_checkpoint, \
+    set_rng_state
+from onlikhorn.kernels import compute_distance, precompute_cost
+from onlikhorn.memory import memory_columns, project_online_memory
+from onlikhorn.profiling import NULL_PROFILER, check_profiler
+
+logger = logging.getLogger(__name__)
 
 import time
 
@@ -21,68 +34,160 @@ def var_norm(v):
     return v.max() - v.min()
 
 
-def compute_distance(x, y, lazy=False):
-    if lazy:
-        x = LazyTensor(x[:, None, :])
-        y = LazyTensor(y[None, :, :])
-        return (((x - y) ** 2) / 2).sum(dim=2)
-    else:
-        x2 = torch.sum(x ** 2, dim=1)
-        y2 = torch.sum(y ** 2, dim=1)
-        return .5 * (x2[:, None] + y2[None, :] - 2 * x @ y.transpose(0, 1))[..., None]
-
-
 def logaddexp(x, y):
     return torch.logsumexp(torch.cat([x[None, :], y[None, :]], dim=0), dim=0)
 
 
-def check_idx(n, idx):
-    if isinstance(idx, slice):
-        return np.arange(n)[idx].tolist()
-    elif isinstance(idx, list):
-        return idx
-    else:
-        raise ValueError
+def increment_weights(old_weights, new_weights, epsilon):
+    """Weights w such that exp((w - C) / epsilon) is the increase of the terms of atoms going from old_weights to
+    (larger) new_weights: new + epsilon * log(1 - exp((old - new) / epsilon)), or new for atoms without mass."""
+    return torch.where(torch.isinf(old_weights), new_weights,
+                       new_weights + epsilon * torch.log(-torch.expm1((old_weights - new_weights) / epsilon)))
 
 
 class BasePotential:
-    def __init__(self, positions: torch.Tensor, weights: torch.tensor, epsilon=1.):
+    def __init__(self, positions: torch.Tensor, weights: torch.tensor, epsilon=1., block_size=None, backend=None,
+                 backend_options=None):
         self.positions = positions
         self.weights = weights
         self.epsilon = epsilon
+        self.block_size = block_size
+        self.backend = backend
+        # Extra keyword arguments of the explicitly requested backend, e.g. dict(tol=1e-6) for 'truncated'
+        self.backend_options = {} if backend_options is None else backend_options
         self.seen = slice(None)
 
         self.n_calls_ = 0
+        self.backend_stats_ = {}
+        self.query_caches = {}
+        # Atoms added since the query caches were last updated, as (positions, weights, total_shift at push time)
+        self.pending_queries = []
+        self.total_shift = 0.
+        self.profiler = NULL_PROFILER
+
+    def __getstate__(self):  # Profilers are not saved with the potential
+        state = self.__dict__.copy()
+        state.pop('profiler', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.profiler = NULL_PROFILER
 
     def add_weight(self, weight):
         self.weights[self.seen] += weight
+        if not np.isfinite(float(weight)):  # e.g. log(1 - lr) with lr = 1, discarding every atom
+            self.invalidate_queries()
+            self.total_shift = 0.
+            return
+        self.total_shift = self.total_shift + weight
+        for cache in self.query_caches.values():
+            if cache['lse'] is not None:
+                cache['lse'] = cache['lse'] + weight / self.epsilon
+
+    def support(self):
+        """Positions and weights of the atoms the potential is made of."""
+        return self.positions[self.seen], self.weights[self.seen]
 
     @property
     def n_samples_(self):
-        return len(self.positions[self.seen])
+        return len(self.support()[1])
+
+    def get_backend(self, n, m, C=None):
+        """Reduction backend and block size used to evaluate the potential on n points."""
+        if C is not None:
+            if self.block_size is not None or not isinstance(C, torch.Tensor):
+                return 'tiled', self.block_size
+            return 'dense', None
+        if self.backend is None:
+            if self.positions.device.type == 'cuda':
+                return 'keops', None
+            return ('tiled', self.block_size) if self.block_size is not None else ('dense', None)
+        elif self.backend == 'auto':
+            return select_backend(n, m, self.positions.shape[1], dtype=self.positions.dtype,
+                                  device=self.positions.device)
+        else:
+            return self.backend, self.block_size
 
     def __call__(self, positions: torch.tensor = None, C=None, free=False, return_C=False):
         """Evaluation"""
-        lazy = self.positions.device.type == 'cuda' and C is None and not return_C
-        if C is None:
-            C = compute_distance(positions, self.positions[self.seen], lazy=lazy)
-            if not free:
-                self.n_calls_ += C.shape[0] * C.shape[1] * self.positions.shape[1]
+        n = positions.shape[0] if C is None else C.shape[0]
+        m = self.n_samples_
+        if C is None and return_C:
+            with self.profiler.phase('distance', pairs=n * m * self.positions.shape[1]):
+                C = compute_distance(positions, self.support()[0], lazy=False)
         if not free:
-            self.n_calls_ += C.shape[0] * C.shape[1] * self.positions.shape[1]
-        weights = self.weights[None, self.seen, None]
-        if lazy:
-            weights = LazyTensor(weights)
-        weighted_C = (weights - C) / self.epsilon
-        e = - self.epsilon * weighted_C.logsumexp(dim=1)[..., 0]
+            self.n_calls_ += n * m * self.positions.shape[1]
+        lse = self.reduce(positions, *self.support(), C=C)
+        e = - self.epsilon * lse
         if not return_C:
             return e
         else:
             return e, C
 
+    def reduce(self, positions, atom_positions, atom_weights, C=None):
+        """log sum_j exp((atom_weights_j - C(positions_i, atom_positions_j)) / epsilon), with the backend of the
+        potential."""
+        n = positions.shape[0] if C is None else C.shape[0]
+        m = len(atom_weights)
+        backend, block_size = self.get_backend(n, m, C=C)
+        options = self.backend_options if backend == self.backend else {}
+        t0 = time.perf_counter()
+        with self.profiler.phase('logsumexp', pairs=n * m * self.positions.shape[1]):
+            lse = BACKENDS[backend](positions, atom_positions, atom_weights, self.epsilon, C=C,
+                                    block_size=block_size, **options)
+        elapsed = time.perf_counter() - t0
+        stats = self.backend_stats_.setdefault(backend, dict(calls=0, time=0.))
+        stats['calls'] += 1
+        stats['time'] += elapsed
+        logger.debug(f'{type(self).__name__} {n}x{m} backend={backend} block_size={block_size} time={elapsed:.2e}')
+        return lse
+
+    def register_queries(self, name, positions):
+        """Keep the log-partial sums of the potential on a fixed set of positions, see `query`."""
+        self.query_caches[name] = dict(positions=positions, lse=None, epsilon=None)
+
+    def query(self, name, positions=None):
+        """Free evaluation of the potential on the positions registered under name (registered on first use).
+
+        The log-partial sums over the atoms are updated incrementally: uniform weight shifts are added, and atoms
+        pushed since the last query are reduced against the queries and merged with a logaddexp, here rather than
+        at push time, so that this work is counted in evaluations. Any other change of the atoms (overwriting
+        pushes, trim, refit, a new epsilon) triggers a full recomputation.
+        """
+        self.flush_queries()
+        cache = self.query_caches.get(name)
+        if cache is None or (positions is not None and cache['positions'] is not positions):
+            self.register_queries(name, positions)
+            cache = self.query_caches[name]
+        if cache['lse'] is None or cache['epsilon'] != self.epsilon:
+            cache['lse'] = self.reduce(cache['positions'], *self.support())
+            cache['epsilon'] = self.epsilon
+        return - self.epsilon * cache['lse']
+
+    def update_queries(self, positions, weights):
+        """Account for new atoms in the query caches, on the next query."""
+        if any(cache['lse'] is not None for cache in self.query_caches.values()):
+            self.pending_queries.append((positions, weights.clone(), self.total_shift))
+
+    def flush_queries(self):
+        """Reduce the pending atoms against the up-to-date query caches."""
+        for positions, weights, shift in self.pending_queries:
+            weights = weights + (self.total_shift - shift)  # Later uniform shifts apply to these atoms as well
+            for cache in self.query_caches.values():
+                if cache['lse'] is not None and cache['epsilon'] == self.epsilon:
+                    cache['lse'] = logaddexp(cache['lse'], self.reduce(cache['positions'], positions, weights))
+        self.pending_queries = []
+
+    def invalidate_queries(self):
+        for cache in self.query_caches.values():
+            cache['lse'] = None
+        self.pending_queries = []
+
     def to(self, device):
         self.weights = self.weights.to(device)
         self.positions = self.positions.to(device)
+        self.invalidate_queries()
         return self
 
     @property
@@ -97,11 +202,12 @@ class BasePotential:
         return self.seen == slice(None)
 
     def refit(self, F, C=None):
-        x = self.positions[self.seen]
+        x, weights = self.support()
         la = np.log(x.shape[0])
         eF = F(x, C=C) + la
-        fixed_err = var_norm(eF - self.weights[self.seen])
+        fixed_err = var_norm(eF - weights)
         self.weights[self.seen] = eF
+        self.invalidate_queries()
         return fixed_err
 
 class ConvolutionPotential(BasePotential):
@@ -124,51 +230,108 @@ class PotentialDifference:
 
 
 class FinitePotential(BasePotential):
-    def __init__(self, positions: torch.Tensor, weights: Optional[torch.Tensor] = None, epsilon=1.):
+    def __init__(self, positions: torch.Tensor, weights: Optional[torch.Tensor] = None, epsilon=1., block_size=None,
+                 backend=None, backend_options=None):
         weights_provided = isinstance(weights, torch.Tensor)
         if not weights_provided:
             weights = torch.full_like(positions[:, 0], fill_value=-float('inf'))
-        super(FinitePotential, self).__init__(positions, weights, epsilon)
+        super(FinitePotential, self).__init__(positions, weights, epsilon, block_size=block_size, backend=backend,
+                                              backend_options=backend_options)
         if weights_provided:
             self.seen = slice(None)
         else:
-            self.seen = []
-            self.seen_set = set()
+            # Seen atoms are copied in append order in the active buffers, so that evaluation reads a slice of them
+            # instead of gathering the seen atoms. `seen` holds their indices in the same order.
+            n = len(positions)
+            self.mask = torch.zeros(n, dtype=torch.bool, device=positions.device)
+            self.slots = torch.full((n,), fill_value=-1, dtype=torch.long, device=positions.device)
+            self.order = torch.empty(n, dtype=torch.long, device=positions.device)
+            self.active_positions = torch.empty_like(positions)
+            self.active_weights = torch.empty_like(weights)
+            self.n_active = 0
+            self.seen = self.order[:0]
+
+    @property
+    def full(self):
+        return isinstance(self.seen, slice)
+
+    def support(self):
+        if self.full:
+            return self.positions, self.weights
+        return self.active_positions[:self.n_active], self.active_weights[:self.n_active]
+
+    def to(self, device):
+        super(FinitePotential, self).to(device)
+        if not self.full:
+            for name in ['mask', 'slots', 'order', 'active_positions', 'active_weights']:
+                setattr(self, name, getattr(self, name).to(device))
+            self.seen = self.order[:self.n_active]
+        return self
+
+    def add_weight(self, weight):
+        super(FinitePotential, self).add_weight(weight)
+        if not self.full:
+            self.active_weights[:self.n_active] += weight
+
+    def refit(self, F, C=None):
+        fixed_err = super(FinitePotential, self).refit(F, C=C)
+        if not self.full:
+            self.active_weights[:self.n_active] = self.weights[self.seen]
+        return fixed_err
 
     def push(self, idx, weights, override=False):
-        idx = check_idx(len(self.weights), idx)
-        if self.seen != slice(None):  # Still a set
-            self.seen_set.update(set(idx))
-            if len(self.seen_set) == len(self.weights):
-                self.seen = slice(None)
-            else:
-                self.seen = list(self.seen_set)
+        if isinstance(idx, slice):
+            idx = torch.arange(len(self.weights), device=self.weights.device)[idx] if not self.full else idx
+        else:
+            idx = torch.as_tensor(idx, dtype=torch.long, device=self.weights.device)
         if override:
             self.weights[idx] = weights
+            self.invalidate_queries()
         else:
             if isinstance(weights, float):
                 weights = torch.full_like(self.weights[idx], fill_value=weights)
+            # Repeated indices are written once, so caches are updated with the increase of every unique atom
+            unique_idx = idx if isinstance(idx, slice) else torch.unique(idx)
+            old_weights = self.weights[unique_idx]
             self.weights[idx] = logaddexp(self.weights[idx], weights)
+            if self.query_caches and weights.max() > -float('inf'):
+                self.update_queries(self.positions[unique_idx],
+                                    increment_weights(old_weights, self.weights[unique_idx], self.epsilon))
+        if not self.full:
+            new_idx = torch.unique(idx[~self.mask[idx]])
+            start, stop = self.n_active, self.n_active + len(new_idx)
+            self.mask[new_idx] = True
+            self.slots[new_idx] = torch.arange(start, stop, device=idx.device)
+            self.order[start:stop] = new_idx
+            self.active_positions[start:stop] = self.positions[new_idx]
+            self.n_active = stop
+            if stop == len(self.weights):
+                self.seen = slice(None)  # The bookkeeping of seen atoms is no longer needed
+                self.mask, self.slots, self.order = None, None, None
+                self.active_positions, self.active_weights = None, None
+            else:
+                self.seen = self.order[:stop]
+                self.active_weights[self.slots[idx]] = self.weights[idx]
 
 
 class InfinitePotential(BasePotential):
-    def __init__(self, max_length, dimension, epsilon=1.):
+    def __init__(self, max_length, dimension, epsilon=1., block_size=None, backend=None, backend_options=None):
         weights = torch.full((max_length,), fill_value=-float('inf'))
         positions = torch.zeros((max_length, dimension))
-        super(InfinitePotential, self).__init__(positions, weights, epsilon)
+        super(InfinitePotential, self).__init__(positions, weights, epsilon, block_size=block_size, backend=backend,
+                                                backend_options=backend_options)
         self.max_length = max_length
         self.cursor = 0
         self.seen = slice(0, 0)
 
-    def add_weight(self, weight):
-        self.weights[self.seen] += weight
-
     @property
     def full(self):
         return self.seen.stop == self.max_length
 
     def push(self, positions, weights):
         old_cursor = self.cursor
+        # Pushes that do not overwrite atoms only add terms to the query caches
+        appending = old_cursor == self.seen.stop and old_cursor + len(positions) <= self.max_length
         self.cursor += len(positions)
         seen = min(self.max_length, self.seen.stop + len(positions))
         self.seen = slice(0, seen)
@@ -187,9 +350,17 @@ class InfinitePotential(BasePotential):
                 self.weights[t] = weights
             else:
                 self.weights[t] = weights[f]
+        if self.query_caches:
+            if appending:
+                self.update_queries(self.positions[old_cursor:self.cursor], self.weights[old_cursor:self.cursor])
+            else:
+                self.invalidate_queries()
+
+    def max_weight(self):
+        return self.weights[self.seen].max()
 
     def trim(self, ):
-        max_weight = self.weights[self.seen].max()
+        max_weight = self.max_weight()
         large_enough = self.weights[self.seen] > max_weight - 10
         n = large_enough.float().sum().int().item()
         if n > 0:
@@ -198,17 +369,20 @@ class InfinitePotential(BasePotential):
             self.weights[n:].fill_(-float('inf'))
             self.seen = slice(0, n)
             self.cursor = n
+            self.invalidate_queries()
 
 
 def subsampled_sinkhorn(x, la, y, lb, n_iter=100, batch_size: int = 10, epsilon=1, save_trace=False, ref=None,
-                        precompute_C=True, max_calls=None, trace_every=1):
+                        precompute_C=True, max_calls=None, trace_every=1, block_size=None,
+                        backend=None, backend_options=None, cost_dtype=None, profiler=None):
     if batch_size is not None and (batch_size != len(x) or batch_size != len(y)):
         x_sampler = Subsampler(x, la)
         y_sampler = Subsampler(y, lb)
         x, la, xidx = x_sampler(batch_size)
         y, lb, yidx = y_sampler(batch_size)
     return sinkhorn(x, la, y, lb, n_iter, epsilon, save_trace=save_trace, ref=ref, precompute_C=precompute_C,
-                    max_calls=max_calls, trace_every=trace_every)
+                    max_calls=max_calls, trace_every=trace_every, block_size=block_size, backend=backend,
+                    backend_options=backend_options, cost_dtype=cost_dtype, profiler=profiler)
 
 
 def gaussian_convolution(x, la, y, lb, epsilon):
@@ -221,13 +395,19 @@ def sinkhorn(x, la, y, lb, n_iter=100, epsilon=1., save_trace=False, F=None, G=N
              trace=None,
              max_calls=None, verbose=True, trace_every=1,
              ref=None,
-             start_iter=0, start_time=0):
+             start_iter=0, start_time=0, block_size=None, backend=None, backend_options=None, cost_dtype=None,
+             tol=None, acceleration=None, omega=1.5, anderson_depth=5, async_eval=False, eval_budget=None,
+             profiler=None):
     eval_time = 0
     t0 = time.perf_counter()
     if F is None:
-        F = FinitePotential(y, lb.clone(), epsilon=epsilon)
+        F = FinitePotential(y, lb.clone(), epsilon=epsilon, block_size=block_size, backend=backend,
+                            backend_options=backend_options)
     if G is None:
-        G = FinitePotential(x, la.clone(), epsilon=epsilon)
+        G = FinitePotential(x, la.clone(), epsilon=epsilon, block_size=block_size, backend=backend,
+                            backend_options=backend_options)
+    profiler = check_profiler(profiler)
+    F.profiler, G.profiler = profiler, profiler
 
     if n_iter is None:
         assert max_calls is not None
@@ -235,7 +415,8 @@ def sinkhorn(x, la, y, lb, n_iter=100, epsilon=1., save_trace=False, F=None, G=N
 
     if precompute_C is not False:
         if precompute_C is True:
-            Cxy = compute_distance(x, y, lazy=False)
+            with profiler.phase('distance', pairs=x.shape[0] * y.shape[0] * x.shape[1]):
+                Cxy = precompute_cost(x, y, dtype=cost_dtype, block_size=block_size)
             Cyx = Cxy.transpose(0, 1)
             F.n_calls_ += x.shape[0] * y.shape[0] * x.shape[1]
         else:
@@ -245,28 +426,40 @@ def sinkhorn(x, la, y, lb, n_iter=100, epsilon=1., save_trace=False, F=None, G=N
         Cxy, Cyx = None, None
 
     trace, ref = check_trace(save_trace, trace=trace, ref=ref, ref_needed=False)
+    evaluator = AsyncEvaluator(epsilon, ref, verbose=verbose) if save_trace and async_eval else None
+    accelerator = make_accelerator(acceleration, omega=omega, depth=anderson_depth)
 
     call_trace = 0
     for i in range(start_iter, n_iter):
         eG = G(positions=y, C=Cyx)
-        if save_trace:
+        if save_trace or tol is not None:
             fixed_err = var_norm(eG + lb - F.weights)
             w = (eG * lb.exp()).sum()
         else:
             fixed_err, w = None, None
-        F.push(slice(None), eG + lb, override=True)
+        with profiler.phase('push'):
+            F.push(slice(None), eG + lb, override=True)
         eF = F(positions=x, C=Cxy)
         n_calls = F.n_calls_ + G.n_calls_
         n_samples = F.n_samples_ + G.n_samples_
         if max_calls is not None and n_calls > max_calls:
             break
-        if save_trace and n_calls >= call_trace:
-            eval_t0 = time.perf_counter()
+        if fixed_err is not None:
             fixed_err += var_norm(eF + la - G.weights)
             w += (eF * la.exp()).sum()
+        if save_trace and n_calls >= call_trace:
+            eval_t0 = time.perf_counter()
             this_trace = dict(n_iter=i + 1, n_calls=n_calls, n_samples=n_samples,
                               fixed_err=fixed_err.item(), w=w.item(), algorithm='full')
-            fixed_err, ref_err = evaluate(F, G, epsilon, ref)
+            budget = eval_budget * n_calls if eval_budget is not None else None
+            this_trace.update(memory_columns(F, G, C=Cxy))
+            this_trace.update(profiler.columns())
+            with profiler.phase('evaluate'):
+                if evaluator is not None:
+                    evaluator.submit(this_trace, F, G, budget=budget)
+                else:
+                    ref_fixed_err, ref_err = evaluate(F, G, epsilon, ref, budget=budget)
+                    fill_trace(this_trace, ref_fixed_err, ref_err)
             if torch.cuda.is_available():
                 torch.cuda.synchronize()
             eval_time += time.perf_counter() - eval_t0
@@ -274,16 +467,21 @@ def sinkhorn(x, la, y, lb, n_iter=100, epsilon=1., save_trace=False, F=None, G=N
                 torch.cuda.synchronize()
             this_trace['time'] = time.perf_counter() - t0 - eval_time + start_time
             this_trace['eval_time'] = eval_time
-            for name, err in fixed_err.items():
-                this_trace[f'fixed_err_{name}'] = err
-            for name, err in ref_err.items():
-                this_trace[f'ref_err_{name}'] = err
 
             trace.append(this_trace)
             call_trace = n_calls + trace_every
-            if verbose:
+            if verbose and evaluator is None:
                 print(' '.join(f'{k}:{v:.2e}' if type(v) in [int, float] else f'{k}:{v}' for k, v in this_trace.items()))
-        G.push(slice(None), eF + la, override=True)
+        if accelerator is not None:
+            new_weights = accelerator(G.weights.clone(), eF + la, var_norm(eF + la - G.weights).item())
+        else:
+            new_weights = eF + la
+        with profiler.phase('push'):
+            G.push(slice(None), new_weights, override=True)
+        if tol is not None and fixed_err < tol:
+            break
+    if evaluator is not None:
+        evaluator.close()
     anchor = F(torch.zeros_like(x[[0]]))
     F.add_weight(anchor)
     G.add_weight(-anchor)
@@ -293,20 +491,18 @@ def sinkhorn(x, la, y, lb, n_iter=100, epsilon=1., save_trace=False, F=None, G=N
         return F, G
 
 
-def scatter(target: torch.tensor, xidx: List[int], yidx: List[int], value: torch.tensor):
-    idx = np.concatenate([a[..., None] for a in np.meshgrid(xidx, yidx, indexing='ij')], axis=2).reshape(-1, 2)
-    target[idx[:, 0], idx[:, 1]] = value.reshape(-1)
-
-
 def online_sinkhorn(x_sampler=None, y_sampler=None,
                     x=None, la=None, y=None, lb=None, use_finite=True,
                     epsilon=1., max_length=100000, trim_every=None,
-                    refit=False, precompute_C=False,
+                    refit=False, precompute_C=False, cost_dtype=None,
                     n_iter=100, force_full=False,
                     batch_sizes: Optional[Union[List[int], int]] = 10, max_calls=None, verbose=True,
                     start_time=0,
                     trace_every=1,
-                    lrs: Union[List[float], float] = .1, save_trace=False, ref=None):
+                    lrs: Union[List[float], float] = .1, save_trace=False, ref=None, block_size=None,
+                    backend=None, backend_options=None, F=None, G=None, trace=None, start_iter=0, tol=None,
+                    cache_bytes=None, prefetch=None, prefetch_workers=1, async_eval=False, eval_budget=None,
+                    profiler=None, dry_run=False, checkpoint=None, checkpoint_every=600.):
     eval_time = 0
     t0 = time.perf_counter()
 
@@ -328,110 +524,198 @@ def online_sinkhorn(x_sampler=None, y_sampler=None,
         lrs = [lrs for _ in range(n_iter)]
     assert (n_iter == len(lrs) == len(batch_sizes))
 
+    if dry_run:  # Projected peak memory and per-iteration projection, without solving
+        if use_finite:
+            dimension, n_x, n_y, device = x.shape[1], len(x), len(y), x.device
+        else:
+            dimension, n_x, n_y, device = x_sampler.dimension, None, None, x_sampler.device
+        return project_online_memory(batch_sizes[start_iter:], dimension, max_length=max_length,
+                                     use_finite=use_finite, n_x=n_x, n_y=n_y, refit=refit, force_full=force_full,
+                                     precompute_C=precompute_C, cache_bytes=cache_bytes, cost_dtype=cost_dtype,
+                                     block_size=block_size, backend=backend, device=device, prefetch=prefetch)
+
+    # The solver state is saved to checkpoint every checkpoint_every seconds, and resumed from if it exists. The
+    # final Sinkhorn iterations of force_full are not checkpointed: a run interrupted there resumes from the last
+    # online iterations saved
+    state = load_checkpoint(checkpoint) if checkpoint is not None and os.path.exists(checkpoint) else None
+    if state is not None:
+        F, G, trace, start_iter = state['F'], state['G'], state['trace'], state['n_iter']
+        eval_time = state['eval_time']
+        start_time = state['time'] + eval_time
+    warm_start = F is not None
+    # Batches are consumed within their iteration, so they are gathered in reused buffers, unless drawn ahead
+    reuse_buffers = not prefetch
     if use_finite:
-        x_sampler = Subsampler(x, la)
-        y_sampler = Subsampler(y, lb)
-        F = FinitePotential(y, epsilon=epsilon).to(x_sampler.device)
-        G = FinitePotential(x, epsilon=epsilon).to(y_sampler.device)
+        x_sampler = Subsampler(x, la, reuse_buffers=reuse_buffers)
+        y_sampler = Subsampler(y, lb, reuse_buffers=reuse_buffers)
     else:
         if x_sampler is None:
-            x_sampler = Subsampler(x, la)
+            x_sampler = Subsampler(x, la, reuse_buffers=reuse_buffers)
         if y_sampler is None:
-            y_sampler = Subsampler(y, lb)
-        F = InfinitePotential(max_length=max_length, dimension=y_sampler.dimension, epsilon=epsilon).to(
-            x_sampler.device)
-        G = InfinitePotential(max_length=max_length, dimension=x_sampler.dimension, epsilon=epsilon).to(
-            y_sampler.device)
+            y_sampler = Subsampler(y, lb, reuse_buffers=reuse_buffers)
+    if prefetch:  # Draw the batches of the next iterations in the background
+        sampling_schedule = ([] if warm_start else [batch_sizes[0]]) + batch_sizes[start_iter:]
+        x_sampler = PrefetchSampler(x_sampler, sampling_schedule, depth=prefetch, n_workers=prefetch_workers)
+        y_sampler = PrefetchSampler(y_sampler, sampling_schedule, depth=prefetch, n_workers=prefetch_workers)
+    if not warm_start:
+        if use_finite:
+            F = FinitePotential(y, epsilon=epsilon, block_size=block_size, backend=backend,
+                                backend_options=backend_options).to(x_sampler.device)
+            G = FinitePotential(x, epsilon=epsilon, block_size=block_size, backend=backend,
+                                backend_options=backend_options).to(y_sampler.device)
+        else:
+            F = InfinitePotential(max_length=max_length, dimension=y_sampler.dimension, epsilon=epsilon,
+                                  block_size=block_size, backend=backend,
+                                  backend_options=backend_options).to(x_sampler.device)
+            G = InfinitePotential(max_length=max_length, dimension=x_sampler.dimension, epsilon=epsilon,
+                                  block_size=block_size, backend=backend,
+                                  backend_options=backend_options).to(y_sampler.device)
+    profiler = check_profiler(profiler)
+    F.profiler, G.profiler = profiler, profiler
 
     if force_full:  # save for later
         xf, laf, yf, lbf = x, la, y, lb
-        if precompute_C:
-            C = torch.empty((xf.shape[0], yf.shape[0], 1), device=xf.device)
+        if state is not None:
+            C = state['C']
+        elif precompute_C:
+            # Costs computed along the way are kept for the final Sinkhorn iterations, within cache_bytes
+            C = BlockCostCache(xf, yf, block_size=block_size, max_bytes=cache_bytes, dtype=cost_dtype)
         else:
             C = None
     else:
         xf, laf, yf, lbf = None, None, None, None
         C = None
-    # Init
-    x, la, xidx = x_sampler(batch_sizes[0])
-    y, lb, yidx = y_sampler(batch_sizes[0])
-    if force_full and precompute_C:
-        this_C = compute_distance(x, y, lazy=False)
-        scatter(C[..., 0], xidx, yidx, this_C[..., 0].transpose(0, 1))
-
-    F.push(yidx if use_finite else y, la)
-    G.push(xidx if use_finite else x, lb)
-
-    trace, ref = check_trace(save_trace, ref=ref, ref_needed=True)
+    if not warm_start:
+        # Init
+        with profiler.phase('sampling'):
+            x, la, xidx = x_sampler(batch_sizes[0])
+            y, lb, yidx = y_sampler(batch_sizes[0])
+        if force_full and precompute_C:
+            with profiler.phase('distance', pairs=x.shape[0] * y.shape[0] * x.shape[1]):
+                C.scatter(xidx, yidx, compute_distance(x, y, lazy=False)[..., 0])
+
+        with profiler.phase('push'):
+            F.push(yidx if use_finite else y, la)
+            G.push(xidx if use_finite else x, lb)
+
+    trace, ref = check_trace(save_trace, trace=trace, ref=ref, ref_needed=True)
+    evaluator = AsyncEvaluator(epsilon, ref, verbose=verbose) if save_trace and async_eval else None
 
     call_trace = 0
-    for i in range(n_iter):
+    if state is not None:
+        load_sampler_state(x_sampler, state['x_sampler'])
+        load_sampler_state(y_sampler, state['y_sampler'])
+        set_rng_state(state['rng'])
+        call_trace = state['call_trace']
+    last_checkpoint = time.perf_counter()
+    for i in range(start_iter, n_iter):
         n_calls = F.n_calls_ + G.n_calls_
         n_samples = F.n_samples_ + G.n_samples_
-        if max_calls is not None and n_calls > max_calls:
+        out_of_budget = max_calls is not None and n_calls > max_calls
+        # Also saved when running out of calls, so that a run with a larger max_calls continues from here
+        if checkpoint is not None and i > start_iter and (
+                out_of_budget or time.perf_counter() - last_checkpoint >= checkpoint_every):
+            checkpoint_t0 = time.perf_counter()
+            if evaluator is not None:
+                evaluator.collect(wait=True)
+            save_checkpoint(checkpoint, dict(F=F, G=G, C=C, trace=trace, n_iter=i, call_trace=call_trace,
+                                             time=checkpoint_t0 - t0 - eval_time + start_time, eval_time=eval_time,
+                                             x_sampler=sampler_state(x_sampler), y_sampler=sampler_state(y_sampler),
+                                             rng=rng_state()))
+            last_checkpoint = time.perf_counter()
+            eval_time += last_checkpoint - checkpoint_t0  # Excluded from trace times, as evaluations
+        if out_of_budget:
             break
         if save_trace and n_calls >= call_trace:
             eval_t0 = time.perf_counter()
             this_trace = dict(n_iter=i, n_calls=n_calls, n_samples=n_samples, algorithm='online')
-            fixed_err, ref_err = evaluate(F, G, epsilon, ref)
+            budget = eval_budget * n_calls if eval_budget is not None else None
+            this_trace.update(memory_columns(F, G, C=C))
+            this_trace.update(profiler.columns())
+            with profiler.phase('evaluate'):
+                if evaluator is not None:
+                    evaluator.submit(this_trace, F, G, budget=budget)
+                    fixed_err = evaluator.collect()
+                else:
+                    fixed_err, ref_err = evaluate(F, G, epsilon, ref, budget=budget)
+                    fill_trace(this_trace, fixed_err, ref_err)
             if torch.cuda.is_available():
                 torch.cuda.synchronize()
             eval_time += time.perf_counter() - eval_t0
-            for name, err in fixed_err.items():
-                this_trace[f'fixed_err_{name}'] = err
-            for name, err in ref_err.items():
-                this_trace[f'ref_err_{name}'] = err
             if torch.cuda.is_available():
                 torch.cuda.synchronize()
             this_trace['time'] = time.perf_counter() - t0 - eval_time + start_time
             this_trace['eval_time'] = eval_time
             trace.append(this_trace)
             call_trace = n_calls + trace_every
-            if verbose:
+            if verbose and evaluator is None:
                 print(' '.join(f'{k}:{v:.2e}' if type(v) in [int, float] else f'{k}:{v}' for k, v in this_trace.items()))
-        y, lb, yidx = y_sampler(batch_sizes[i])
+            if tol is not None and len(fixed_err) > 0 and max(fixed_err.values()) < tol:
+                break
+        with profiler.phase('sampling'):
+            y, lb, yidx = y_sampler(batch_sizes[i])
         if refit:
-            F.push(yidx if use_finite else y, -float('inf'))
-            F.refit(G)
+            with profiler.phase('push'):
+                F.push(yidx if use_finite else y, -float('inf'))
+            with profiler.phase('refit'):
+                F.refit(G)
         else:
-            F.add_weight(safe_log(1 - lrs[i]))
+            with profiler.phase('add_weight'):
+                F.add_weight(safe_log(1 - lrs[i]))
             if force_full and precompute_C:
                 eG, this_C = G(y, return_C=True)
-                xidx = check_idx(len(G.positions), G.seen)
-                scatter(C[..., 0], xidx, yidx, this_C[..., 0].transpose(0, 1))
+                C.scatter(G.seen, yidx, this_C[..., 0].transpose(0, 1))
             else:
                 eG = G(y)
-            F.push(yidx if use_finite else y, np.log(lrs[i]) + eG + lb)
-        x, la, xidx = x_sampler(batch_sizes[i])
+            with profiler.phase('push'):
+                F.push(yidx if use_finite else y, np.log(lrs[i]) + eG + lb)
+        with profiler.phase('sampling'):
+            x, la, xidx = x_sampler(batch_sizes[i])
         if refit:
-            G.push(xidx if use_finite else x, -float('inf'))
-            G.refit(F)
+            with profiler.phase('push'):
+                G.push(xidx if use_finite else x, -float('inf'))
+            with profiler.phase('refit'):
+                G.refit(F)
         else:
-            G.add_weight(safe_log(1 - lrs[i]))
+            with profiler.phase('add_weight'):
+                G.add_weight(safe_log(1 - lrs[i]))
             if force_full and precompute_C:
                 eF, this_C = F(x, return_C=True)
-                yidx = check_idx(len(F.positions), F.seen)
-                scatter(C[..., 0], xidx, yidx, this_C[..., 0])
+                C.scatter(xidx, F.seen, this_C[..., 0])
             else:
                 eF = F(x)
-            G.push(xidx if use_finite else x, np.log(lrs[i]) + eF + la)
+            with profiler.phase('push'):
+                G.push(xidx if use_finite else x, np.log(lrs[i]) + eF + la)
         if not use_finite and trim_every is not None and i % trim_every == 0:
-            G.trim()
-            F.trim()
+            with profiler.phase('trim'):
+                G.trim()
+                F.trim()
 
         if force_full and G.full and F.full:
+                if evaluator is not None:
+                    evaluator.close()
+                    evaluator = None
                 start_time = time.perf_counter() - t0 - eval_time + start_time
+                if precompute_C:  # Missing tiles computed during the Sinkhorn iterations count towards max_calls
+                    C.counter = F
                 res = sinkhorn(xf, laf, yf, lbf, F=F, G=G, save_trace=save_trace, trace=trace, start_iter=i,
                                n_iter=n_iter - 1, ref=ref, precompute_C=C if precompute_C else False,
                                max_calls=max_calls, trace_every=trace_every, start_time=start_time,
-                               epsilon=epsilon)
+                               epsilon=epsilon, block_size=block_size, backend=backend,
+                               backend_options=backend_options, tol=tol, async_eval=async_eval,
+                               eval_budget=eval_budget, profiler=profiler)
                 if save_trace:
                     F, G, trace = res
                 else:
                     F, G = res
                 break
+    if prefetch:
+        x_sampler.close()
+        y_sampler.close()
+    if evaluator is not None:
+        evaluator.close()
 
-    anchor = F(torch.zeros_like(x[[0]]))
+    anchor = F(torch.zeros_like(G.positions[[0]]))
     F.add_weight(anchor)
     G.add_weight(-anchor)
     if save_trace:
@@ -440,21 +724,173 @@ def online_sinkhorn(x_sampler=None, y_sampler=None,
         return F, G
 
 
-def evaluate(F, G, epsilon, ref):
+@contextmanager
+def using_backend(potentials, backend, backend_options=None):
+    """Temporarily evaluate the potentials with another backend."""
+    saved = [(potential.backend, potential.backend_options) for potential in potentials]
+    for potential in potentials:
+        potential.backend = backend
+        potential.backend_options = {} if backend_options is None else backend_options
+    try:
+        yield
+    finally:
+        for potential, (backend, backend_options) in zip(potentials, saved):
+            potential.backend, potential.backend_options = backend, backend_options
+
+
+def evaluate(F, G, epsilon, ref, budget=None, backend=None, backend_options=None):
+    """Fixed-point errors and errors to the references of (F, G) on the reference points.
+
+    With a budget (in calls, as n_calls), errors are estimated on random subsets instead, see `estimate_errors`.
+    With backend, evaluations use this backend rather than the one of the potentials, e.g. backend='pool' with
+    backend_options=dict(pool=pool).
+    """
+    if backend is not None:
+        with using_backend([F, G], backend, backend_options):
+            return evaluate(F, G, epsilon, ref, budget=budget)
+    if budget is not None:
+        return estimate_errors(F, G, epsilon, ref, budget)
     ref_err = {}
     fixed_err = {}
     for name, (fr, xr, gr, yr) in ref.items():
-        f = F(xr, free=True)
-        g = G(yr, free=True)
+        f = F.query(name, xr)
+        g = G.query(name, yr)
         if fr is not None and gr is not None:
             ref_err[name] = (var_norm(f - fr) + var_norm(g - gr)).item()
 
-        gg = FinitePotential(xr, f - np.log(len(f)), epsilon=epsilon)(yr)
-        ff = FinitePotential(yr, g - np.log(len(g)), epsilon=epsilon)(xr)
+        gg = FinitePotential(xr, f - np.log(len(f)), epsilon=epsilon, block_size=F.block_size, backend=F.backend,
+                             backend_options=F.backend_options)(yr)
+        ff = FinitePotential(yr, g - np.log(len(g)), epsilon=epsilon, block_size=G.block_size, backend=G.backend,
+                             backend_options=G.backend_options)(xr)
         fixed_err[name] = (var_norm(f - ff) + var_norm(g - gg)).item()
     return fixed_err, ref_err
 
 
+def random_subset(n, size, generator):
+    """Indices of a random subset of range(n) of the given size, or None if size >= n."""
+    if size >= n:
+        return None
+    return torch.randperm(n, generator=generator)[:size]
+
+
+def bootstrap_var_norm(df, dg, generator, n_bootstrap=200, level=.95):
+    """var_norm(df) + var_norm(dg), with a basic bootstrap confidence interval over the points.
+
+    The range of a subsample underestimates the range of the full set, and so does the range of a resample.
+    The basic interval [2 value - q_hi, 2 value - q_lo] reflects this bias, and thus lies above the estimate.
+    """
+    value = (var_norm(df) + var_norm(dg)).item()
+    stats = 0
+    for d in (df, dg):
+        resampled = d[torch.randint(len(d), (n_bootstrap, len(d)), generator=generator).to(d.device)]
+        stats = stats + resampled.max(dim=1)[0] - resampled.min(dim=1)[0]
+    q_lo, q_hi = torch.quantile(stats.float().cpu(), torch.tensor([(1 - level) / 2, (1 + level) / 2])).tolist()
+    return value, 2 * value - q_hi, 2 * value - q_lo
+
+
+def subsample_atoms(potential, size, generator):
+    """Uniform subset of size atoms of a potential, whose weights are raised by epsilon * log(n_atoms / size).
+
+    Weights enter reductions divided by epsilon, so that the partial sums over the subset are unbiased estimates of
+    the full sums. Their logarithms, hence the evaluated potentials, are still biased (by Jensen's inequality).
+    """
+    positions, weights = potential.support()
+    idx = random_subset(len(weights), size, generator)
+    if idx is None:
+        return positions, weights
+    idx = idx.to(weights.device)
+    return positions[idx], weights[idx] + potential.epsilon * np.log(len(weights) / size)
+
+
+def estimate_errors(F, G, epsilon, ref, budget, min_size=32, n_bootstrap=200, level=.95, seed=0):
+    """Estimate the errors of `evaluate` within a budget of calls per reference set.
+
+    Query points and atoms of both potentials are subsampled uniformly to a common size s, with 4 s^2 d <= budget;
+    atom weights are corrected as in `subsample_atoms`, so that partial sums are unbiased. Errors are reported with
+    bootstrap confidence intervals over the query points, under the keys '{name}_lo' and '{name}_hi' (collapsed to
+    the value when nothing was subsampled).
+    Subsets are drawn from a generator seeded with seed, so that successive trace points share their randomness.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    fixed_err, ref_err = {}, {}
+
+    for name, (fr, xr, gr, yr) in ref.items():
+        size = max(int(np.sqrt(budget / (4 * xr.shape[1]))), min_size)
+        xidx, yidx = random_subset(len(xr), size, generator), random_subset(len(yr), size, generator)
+        xs = xr if xidx is None else xr[xidx.to(xr.device)]
+        ys = yr if yidx is None else yr[yidx.to(yr.device)]
+        f = - F.epsilon * F.reduce(xs, *subsample_atoms(F, size, generator))
+        g = - G.epsilon * G.reduce(ys, *subsample_atoms(G, size, generator))
+        gg = FinitePotential(xs, f - np.log(len(f)), epsilon=epsilon, block_size=F.block_size, backend=F.backend,
+                             backend_options=F.backend_options)(ys)
+        ff = FinitePotential(ys, g - np.log(len(g)), epsilon=epsilon, block_size=G.block_size, backend=G.backend,
+                             backend_options=G.backend_options)(xs)
+        errors = [(fixed_err, f - ff, g - gg)]
+        if fr is not None and gr is not None:
+            fs = fr if xidx is None else fr[xidx.to(fr.device)]
+            gs = gr if yidx is None else gr[yidx.to(gr.device)]
+            errors.append((ref_err, f - fs, g - gs))
+        exact = xidx is None and yidx is None and size >= max(F.n_samples_, G.n_samples_)
+        for err, df, dg in errors:
+            if exact:
+                err[name] = err[f'{name}_lo'] = err[f'{name}_hi'] = (var_norm(df) + var_norm(dg)).item()
+            else:
+                err[name], err[f'{name}_lo'], err[f'{name}_hi'] = bootstrap_var_norm(
+                    df, dg, generator, n_bootstrap=n_bootstrap, level=level)
+    return fixed_err, ref_err
+
+
+def fill_trace(this_trace, fixed_err, ref_err):
+    for name, err in fixed_err.items():
+        this_trace[f'fixed_err_{name}'] = err
+    for name, err in ref_err.items():
+        this_trace[f'ref_err_{name}'] = err
+
+
+def snapshot(potential):
+    """Frozen FinitePotential copy of the atoms of a potential."""
+    positions, weights = potential.support()
+    return FinitePotential(positions.clone(), weights.clone(), epsilon=potential.epsilon,
+                           block_size=potential.block_size, backend=potential.backend,
+                           backend_options=potential.backend_options)
+
+
+class AsyncEvaluator:
+    """Evaluates snapshots of the potentials against the references on a background thread.
+
+    Trace entries are handed over at submission time and filled in when their evaluation completes, at the latest
+    on `close`. The solver only pays for the snapshot copy, which it counts in eval_time, so that trace times
+    exclude the evaluations.
+    """
+
+    def __init__(self, epsilon, ref, verbose=False):
+        self.epsilon = epsilon
+        self.ref = ref
+        self.verbose = verbose
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = []
+        self.last_fixed_err = {}
+
+    def submit(self, this_trace, F, G, budget=None):
+        future = self.executor.submit(evaluate, snapshot(F), snapshot(G), self.epsilon, self.ref, budget=budget)
+        self.pending.append((this_trace, future))
+
+    def collect(self, wait=False):
+        """Fill in the trace entries whose evaluation is over, and return the latest fixed-point errors."""
+        while self.pending and (wait or self.pending[0][1].done()):
+            this_trace, future = self.pending.pop(0)
+            fixed_err, ref_err = future.result()
+            fill_trace(this_trace, fixed_err, ref_err)
+            self.last_fixed_err = fixed_err
+            if self.verbose:
+                print(' '.join(f'{k}:{v:.2e}' if type(v) in [int, float] else f'{k}:{v}' for k, v in this_trace.items()))
+        return self.last_fixed_err
+
+    def close(self):
+        self.collect(wait=True)
+        self.executor.shutdown(wait=True)
+
+
 def check_trace(save_trace=False, trace=None, ref=None, ref_needed=False):
     if save_trace:
         if trace is None:
@@ -472,10 +908,13 @@ def check_trace(save_trace=False, trace=None, ref=None, ref_needed=False):
 def random_sinkhorn(x_sampler=None, y_sampler=None, x=None, la=None, y=None, lb=None, use_finite=True, n_iter=100,
                     epsilon=1, max_calls=None, start_time=0,
                     batch_sizes: Union[List[int], int] = 10, save_trace=False, ref=None, verbose=True,
-                    trace_every=1):
+                    trace_every=1, block_size=None, backend=None, backend_options=None, prefetch=None,
+                    prefetch_workers=1, async_eval=False, eval_budget=None, profiler=None):
     eval_time = 0
     t0 = time.perf_counter()
     trace, ref = check_trace(save_trace, ref=ref, ref_needed=True)
+    profiler = check_profiler(profiler)
+    evaluator = AsyncEvaluator(epsilon, ref, verbose=verbose) if save_trace and async_eval else None
 
     if n_iter is None:
         assert max_calls is not None
@@ -488,39 +927,56 @@ def random_sinkhorn(x_sampler=None, y_sampler=None, x=None, la=None, y=None, lb=
     if use_finite:
         x_sampler = Subsampler(x, la)
         y_sampler = Subsampler(y, lb)
+    if prefetch:
+        x_sampler = PrefetchSampler(x_sampler, batch_sizes, depth=prefetch, n_workers=prefetch_workers)
+        y_sampler = PrefetchSampler(y_sampler, batch_sizes, depth=prefetch, n_workers=prefetch_workers)
     F, G = None, None
     n_calls = 0
     call_trace = 0
     for i in range(n_iter):
         if max_calls is not None and n_calls > max_calls:
             break
-        x, la, _ = x_sampler(batch_sizes[i])
-        y, lb, _ = y_sampler(batch_sizes[i])
+        with profiler.phase('sampling'):
+            x, la, _ = x_sampler(batch_sizes[i])
+            y, lb, _ = y_sampler(batch_sizes[i])
         eG = 0 if i == 0 else G(y)
-        F = FinitePotential(y, eG + lb, epsilon=epsilon)
+        F = FinitePotential(y, eG + lb, epsilon=epsilon, block_size=block_size, backend=backend,
+                            backend_options=backend_options)
+        F.profiler = profiler
         eF = 0 if i == 0 else F(x)
-        G = FinitePotential(x, eF + la, epsilon=epsilon)
+        G = FinitePotential(x, eF + la, epsilon=epsilon, block_size=block_size, backend=backend,
+                            backend_options=backend_options)
+        G.profiler = profiler
         n_samples = F.n_samples_ + G.n_samples_
         n_calls += F.n_calls_ + G.n_calls_
         if save_trace and n_calls >= call_trace:
-            this_trace = dict(n_iter=i + 1, n_calls=n_calls, n_samples=n_samples, algorithm='random')
             eval_t0 = time.perf_counter()
-            fixed_err, ref_err = evaluate(F, G, epsilon, ref)
+            this_trace = dict(n_iter=i + 1, n_calls=n_calls, n_samples=n_samples, algorithm='random')
+            budget = eval_budget * n_calls if eval_budget is not None else None
+            this_trace.update(memory_columns(F, G))
+            this_trace.update(profiler.columns())
+            with profiler.phase('evaluate'):
+                if evaluator is not None:
+                    evaluator.submit(this_trace, F, G, budget=budget)
+                else:
+                    fixed_err, ref_err = evaluate(F, G, epsilon, ref, budget=budget)
+                    fill_trace(this_trace, fixed_err, ref_err)
             if torch.cuda.is_available():
                 torch.cuda.synchronize()
             eval_time += time.perf_counter() - eval_t0
-            for name, err in fixed_err.items():
-                this_trace[f'fixed_err_{name}'] = err
-            for name, err in ref_err.items():
-                this_trace[f'ref_err_{name}'] = err
             if torch.cuda.is_available():
                 torch.cuda.synchronize()
             this_trace['time'] = time.perf_counter() - t0 - eval_time + start_time
             this_trace['eval_time'] = eval_time
             trace.append(this_trace)
             call_trace = n_calls + trace_every
-            if verbose:
+            if verbose and evaluator is None:
                 print(' '.join(f'{k}:{v:.2e}' if type(v) in [int, float] else f'{k}:{v}' for k, v in this_trace.items()))
+    if evaluator is not None:
+        evaluator.close()
+    if prefetch:
+        x_sampler.close()
+        y_sampler.close()
     if save_trace:
         return F, G, trace
     else:
@@ -0,0 +1,183 @@
+import time
+from typing import List, Optional
+
+import numpy as np
+
+from onlikhorn.algorithm import sinkhorn, online_sinkhorn, FinitePotential
+from onlikhorn.kernels import precompute_cost
+
+
+def epsilon_schedule(epsilon, epsilon_start=1., decay=.5) -> List[float]:
+    """Geometric sequence of epsilons from epsilon_start down to epsilon (included)."""
+    if epsilon_start <= epsilon:
+        return [epsilon]
+    # No extra stage when epsilon is epsilon_start * decay ** k up to rounding
+    n_stages = int(np.ceil(np.log(epsilon / epsilon_start) / np.log(decay) - 1e-9))
+    # Rounded to 12 significant digits, e.g. 0.01 rather than 0.010000000000000002
+    epsilons = [float(f'{epsilon_start * decay ** k:.12g}') for k in range(n_stages)]
+    return epsilons + [epsilon]
+
+
+def tag_stage(trace, start, stage, epsilon, stage_calls):
+    for this_trace in trace[start:]:
+        this_trace['stage'] = stage
+        this_trace['stage_epsilon'] = epsilon
+        this_trace['stage_n_calls'] = this_trace['n_calls'] - stage_calls
+
+
+def scaled_sinkhorn(x, la, y, lb, epsilon=1., epsilon_start=1., decay=.5, n_iter=100, tol=None,
+                    stage_iter=100, stage_tol=1e-2, save_trace=False, ref=None,
+                    precompute_C=True, cost_dtype=None, max_calls=None, verbose=True, trace_every=1,
+                    block_size=None, backend=None, start_time=0):
+    """Sinkhorn with epsilon-scaling: solve for a geometric sequence of epsilons down to epsilon.
+
+    Potentials are carried over from one stage to the next. Intermediate stages stop after stage_iter
+    iterations or when their fixed-point error reaches stage_tol, the last stage uses n_iter and tol.
+    Trace entries are tagged with their stage, its epsilon, and the number of calls spent in the stage.
+    """
+    epsilons = epsilon_schedule(epsilon, epsilon_start, decay)
+    F = FinitePotential(y, lb.clone(), epsilon=epsilons[0], block_size=block_size, backend=backend)
+    G = FinitePotential(x, la.clone(), epsilon=epsilons[0], block_size=block_size, backend=backend)
+    if precompute_C is True:
+        precompute_C = precompute_cost(x, y, dtype=cost_dtype, block_size=block_size)
+        F.n_calls_ += x.shape[0] * y.shape[0] * x.shape[1]
+    trace = [] if save_trace else None
+    for stage, this_epsilon in enumerate(epsilons):
+        last = stage == len(epsilons) - 1
+        F.epsilon, G.epsilon = this_epsilon, this_epsilon
+        stage_calls = F.n_calls_ + G.n_calls_
+        stage_t0 = time.perf_counter()
+        trace_start = len(trace) if save_trace else 0
+        res = sinkhorn(x, la, y, lb, F=F, G=G, epsilon=this_epsilon, n_iter=n_iter if last else stage_iter,
+                       tol=tol if last else stage_tol, save_trace=save_trace, trace=trace, ref=ref,
+                       precompute_C=precompute_C, max_calls=max_calls, verbose=verbose, trace_every=trace_every,
+                       start_time=start_time)
+        if save_trace:
+            F, G, trace = res
+            tag_stage(trace, trace_start, stage, this_epsilon, stage_calls)
+            eval_time = trace[-1]['eval_time'] if len(trace) > trace_start else 0
+        else:
+            F, G = res
+            eval_time = 0
+        start_time += time.perf_counter() - stage_t0 - eval_time
+        if max_calls is not None and F.n_calls_ + G.n_calls_ > max_calls:
+            break
+    if save_trace:
+        return F, G, trace
+    else:
+        return F, G
+
+
+def scaled_online_sinkhorn(x_sampler=None, y_sampler=None, x=None, la=None, y=None, lb=None, use_finite=True,
+                           epsilon=1., epsilon_start=1., decay=.5, n_iter=100, stage_iter: Optional[int] = None,
+                           stage_calls=None, stage_tol=None, tol=None,
+                           batch_sizes=10, lrs=.1, max_calls=None, save_trace=False, ref=None, verbose=True,
+                           trace_every=1, start_time=0, **kwargs):
+    """Online Sinkhorn with epsilon-scaling.
+
+    The batch-size and step-size schedules run across stages rather than restarting, so that the warm potentials
+    are not wiped out by a unit step size. Each stage is stopped after stage_iter iterations (by default, the
+    n_iter iterations are split evenly between stages), after stage_calls calls, or when the fixed-point errors of
+    the trace fall below stage_tol. The last stage runs up to n_iter with tol and max_calls.
+    Other keyword arguments are passed to online_sinkhorn.
+    """
+    epsilons = epsilon_schedule(epsilon, epsilon_start, decay)
+    if isinstance(batch_sizes, int):
+        batch_sizes = [batch_sizes for _ in range(n_iter)]
+    if isinstance(lrs, (float, int)):
+        lrs = [lrs for _ in range(len(batch_sizes))]
+    n_iter = len(batch_sizes)
+    if stage_iter is None:
+        stage_iter = n_iter // len(epsilons)
+    F, G = None, None
+    trace = [] if save_trace else None
+    n_calls = 0
+    for stage, this_epsilon in enumerate(epsilons):
+        last = stage == len(epsilons) - 1
+        start_iter = stage * stage_iter
+        stop_iter = n_iter if last else min((stage + 1) * stage_iter, n_iter)
+        if start_iter >= stop_iter:
+            continue
+        if F is not None:
+            F.epsilon, G.epsilon = this_epsilon, this_epsilon
+        if last:
+            this_max_calls = max_calls
+        else:
+            this_max_calls = n_calls + stage_calls if stage_calls is not None else max_calls
+        stage_t0 = time.perf_counter()
+        trace_start = len(trace) if save_trace else 0
+        res = online_sinkhorn(x_sampler=x_sampler, y_sampler=y_sampler, x=x, la=la, y=y, lb=lb,
+                              use_finite=use_finite, epsilon=this_epsilon, F=F, G=G,
+                              batch_sizes=batch_sizes[:stop_iter], lrs=lrs[:stop_iter], n_iter=stop_iter,
+                              start_iter=start_iter, max_calls=this_max_calls, tol=tol if last else stage_tol,
+                              save_trace=save_trace, trace=trace, ref=ref, verbose=verbose,
+                              trace_every=trace_every, start_time=start_time, **kwargs)
+        if save_trace:
+            F, G, trace = res
+            tag_stage(trace, trace_start, stage, this_epsilon, n_calls)
+            eval_time = trace[-1]['eval_time'] if len(trace) > trace_start else 0
+        else:
+            F, G = res
+            eval_time = 0
+        start_time += time.perf_counter() - stage_t0 - eval_time
+        n_calls = F.n_calls_ + G.n_calls_
+        if max_calls is not None and n_calls > max_calls:
+            break
+    if save_trace:
+        return F, G, trace
+    else:
+        return F, G
+
+
+def freeze(potential):
+    """Copy of a full FinitePotential sharing its positions, to be kept while the original is updated."""
+    frozen = FinitePotential(potential.positions, potential.weights.clone(), epsilon=potential.epsilon,
+                             block_size=potential.block_size, backend=potential.backend,
+                             backend_options=potential.backend_options)
+    frozen.n_calls_ = potential.n_calls_
+    return frozen
+
+
+def regularization_path(x, la, y, lb, epsilons: List[float], n_iter=100, tol=None, save_trace=False, ref=None,
+                        precompute_C=True, cost_dtype=None, max_calls=None, verbose=True, trace_every=1,
+                        block_size=None, backend=None, backend_options=None, start_time=0):
+    """Sinkhorn solutions for every epsilon of epsilons, from the largest to the smallest.
+
+    The cost is computed once, and each solve is warm-started from the potentials of the previous epsilon, and
+    runs up to n_iter iterations or until tol. Returns the list of (epsilon, F, G) in decreasing order of epsilon,
+    and with save_trace the trace of all solves, tagged as in `scaled_sinkhorn`.
+    """
+    epsilons = sorted(epsilons, reverse=True)
+    F = FinitePotential(y, lb.clone(), epsilon=epsilons[0], block_size=block_size, backend=backend,
+                        backend_options=backend_options)
+    G = FinitePotential(x, la.clone(), epsilon=epsilons[0], block_size=block_size, backend=backend,
+                        backend_options=backend_options)
+    if precompute_C is True:
+        precompute_C = precompute_cost(x, y, dtype=cost_dtype, block_size=block_size)
+        F.n_calls_ += x.shape[0] * y.shape[0] * x.shape[1]
+    trace = [] if save_trace else None
+    solutions = []
+    for stage, this_epsilon in enumerate(epsilons):
+        F.epsilon, G.epsilon = this_epsilon, this_epsilon
+        stage_calls = F.n_calls_ + G.n_calls_
+        stage_t0 = time.perf_counter()
+        trace_start = len(trace) if save_trace else 0
+        res = sinkhorn(x, la, y, lb, F=F, G=G, epsilon=this_epsilon, n_iter=n_iter, tol=tol,
+                       save_trace=save_trace, trace=trace, ref=ref, precompute_C=precompute_C, max_calls=max_calls,
+                       verbose=verbose, trace_every=trace_every, start_time=start_time, block_size=block_size,
+                       backend=backend, backend_options=backend_options)
+        if save_trace:
+            F, G, trace = res
+            tag_stage(trace, trace_start, stage, this_epsilon, stage_calls)
+            eval_time = trace[-1]['eval_time'] if len(trace) > trace_start else 0
+        else:
+            F, G = res
+            eval_time = 0
+        start_time += time.perf_counter() - stage_t0 - eval_time
+        solutions.append((this_epsilon, freeze(F), freeze(G)))
+        if max_calls is not None and F.n_calls_ + G.n_calls_ > max_calls:
+            break
+    if save_trace:
+        return solutions, trace
+    else:
+        return solutions
@@ -0,0 +1,158 @@
+import json
+import logging
+import math
+import os
+import time
+from os.path import expanduser, join, dirname
+
+import torch
+from pykeops.torch import LazyTensor
+
+from onlikhorn.kernels import compute_distance, tiled_logsumexp
+from onlikhorn.parallel import pool_logsumexp
+from onlikhorn.truncation import truncated_logsumexp
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = {}
+
+BLOCK_SIZES = [(256, 4096), (1024, 8192), (4096, 4096)]
+
+# Problem sizes beyond which a candidate is not benchmarked
+MAX_PROBE_SIZE = (2048, 65536)
+MAX_DENSE_BYTES = 2 ** 30
+
+_selection_cache = {}
+
+
+def register_backend(name):
+    """Register a reduction computing log sum_j exp((weights_j - C(x_i, y_j)) / epsilon) for every x_i."""
+
+    def decorator(func):
+        BACKENDS[name] = func
+        return func
+
+    return decorator
+
+
+@register_backend('dense')
+def dense_logsumexp(x, y, weights, epsilon, C=None, block_size=None):
+    if C is None:
+        C = compute_distance(x, y, lazy=False)
+    return ((weights[None, :, None] - C) / epsilon).logsumexp(dim=1)[..., 0]
+
+
+@register_backend('tiled')
+def _tiled_logsumexp(x, y, weights, epsilon, C=None, block_size=None):
+    return tiled_logsumexp(x, y, weights, epsilon, C=C, block_size=block_size)
+
+
+@register_backend('keops')
+def keops_logsumexp(x, y, weights, epsilon, C=None, block_size=None):
+    if C is not None:
+        raise ValueError('The keops backend cannot reduce a precomputed cost')
+    C = compute_distance(x, y, lazy=True)
+    weights = LazyTensor(weights[None, :, None])
+    return ((weights - C) / epsilon).logsumexp(dim=1)[..., 0]
+
+
+# Approximate, hence never selected by the autotuner: request it with backend='truncated'
+register_backend('truncated')(truncated_logsumexp)
+
+# Row-sharded over worker processes (see parallel.ReductionPool), requested with backend='pool'
+register_backend('pool')(pool_logsumexp)
+
+
+def get_cache_file():
+    return os.environ.get('ONLIKHORN_BACKEND_CACHE', join(expanduser('~/cache'), 'onlikhorn_backends.json'))
+
+
+def probe_key(n, m, d, dtype, device):
+    """Sizes are rounded to the next power of two, so that growing batches share their probes."""
+    n, m = (2 ** math.ceil(math.log2(max(size, 1))) for size in (n, m))
+    return f'{torch.device(device).type}-{str(dtype).replace("torch.", "")}-{n}-{m}-{d}'
+
+
+def get_candidates(n, m, dtype):
+    candidates = [('tiled', block_size) for block_size in BLOCK_SIZES]
+    if n * m * torch.finfo(dtype).bits // 8 * 3 <= MAX_DENSE_BYTES:
+        candidates.append(('dense', None))
+    candidates.append(('keops', None))
+    return candidates
+
+
+def benchmark(backend, block_size, n, m, d, dtype, device, n_repeat=3):
+    x = torch.randn((n, d), dtype=dtype, device=device)
+    y = torch.randn((m, d), dtype=dtype, device=device)
+    weights = torch.full((m,), fill_value=-math.log(m), dtype=dtype, device=device)
+    func = BACKENDS[backend]
+    try:
+        func(x, y, weights, 1., block_size=block_size)  # Warm-up, and compilation for keops
+        timings = []
+        for _ in range(n_repeat):
+            if x.device.type == 'cuda':
+                torch.cuda.synchronize()
+            t0 = time.perf_counter()
+            func(x, y, weights, 1., block_size=block_size)
+            if x.device.type == 'cuda':
+                torch.cuda.synchronize()
+            timings.append(time.perf_counter() - t0)
+    except Exception as e:  # Typically keops not being compiled for this device
+        logger.info(f'Backend {backend} unavailable for {n}x{m}x{d}: {e}')
+        return float('inf')
+    return min(timings)
+
+
+def load_selections(cache_file=None):
+    if cache_file is None:
+        cache_file = get_cache_file()
+    if not os.path.exists(cache_file):
+        return {}
+    with open(cache_file, 'r') as f:
+        return json.load(f)
+
+
+def save_selection(key, selection, cache_file=None):
+    if cache_file is None:
+        cache_file = get_cache_file()
+    if dirname(cache_file) and not os.path.exists(dirname(cache_file)):
+        os.makedirs(dirname(cache_file))
+    selections = load_selections(cache_file)
+    selections[key] = selection
+    tmp_file = cache_file + f'.{os.getpid()}.tmp'
+    with open(tmp_file, 'w+') as f:
+        json.dump(selections, f, indent=1)
+    os.replace(tmp_file, cache_file)
+
+
+def autotune(n, m, d, dtype=torch.float32, device='cpu', n_repeat=3):
+    """Micro-benchmark every candidate backend on a problem of size at most MAX_PROBE_SIZE.
+
+    Returns a selection dict holding the winning backend, its block size and the timings of all candidates."""
+    probe_n, probe_m = min(n, MAX_PROBE_SIZE[0]), min(m, MAX_PROBE_SIZE[1])
+    timings = {}
+    for backend, block_size in get_candidates(n, m, dtype):
+        name = backend if block_size is None else f'{backend}-{block_size[0]}x{block_size[1]}'
+        timings[name] = benchmark(backend, block_size, probe_n, probe_m, d, dtype, device, n_repeat=n_repeat)
+    best = min(timings, key=timings.get)
+    backend, *block_size = best.split('-')
+    block_size = [int(size) for size in block_size[0].split('x')] if block_size else None
+    return dict(backend=backend, block_size=block_size, timings=timings, probe_size=[probe_n, probe_m])
+
+
+def select_backend(n, m, d, dtype=torch.float32, device='cpu', cache_file=None):
+    """Backend and block size for a (n, m, d) reduction, probed on first use and cached on disk."""
+    key = probe_key(n, m, d, dtype, device)
+    if key not in _selection_cache:
+        selections = load_selections(cache_file)
+        if key in selections:
+            selection = selections[key]
+        else:
+            selection = autotune(n, m, d, dtype=dtype, device=device)
+            save_selection(key, selection, cache_file)
+            logger.info(f'Selected backend {selection["backend"]} for {key}, timings: '
+                        + ' '.join(f'{k}:{v:.2e}' for k, v in selection['timings'].items()))
+        _selection_cache[key] = selection
+    selection = _selection_cache[key]
+    block_size = tuple(selection['block_size']) if selection['block_size'] is not None else None
+    return selection['backend'], block_size
@@ -0,0 +1,121 @@
+import torch
+
+from onlikhorn.algorithm import FinitePotential
+
+
+def batched_distance(x, y):
+    """(B, n, m) cost |x_bi - y_bj|^2 / 2 between x of shape (B, n, d) and y of shape (B, m, d)."""
+    x2 = torch.sum(x ** 2, dim=2)
+    y2 = torch.sum(y ** 2, dim=2)
+    return .5 * (x2[:, :, None] + y2[:, None, :] - 2 * torch.bmm(x, y.transpose(1, 2)))
+
+
+def batched_logsumexp(x, y, weights, epsilon, C=None):
+    """log sum_j exp((weights_bj - C(x_bi, y_bj)) / epsilon), of shape (B, n)."""
+    if C is None:
+        C = batched_distance(x, y)
+    return torch.logsumexp((weights[:, None, :] - C) / epsilon, dim=2)
+
+
+def batched_var_norm(v):
+    """Variation norm of each row of v, ignoring non-finite entries (atoms of zero weight)."""
+    finite = torch.isfinite(v)
+    return (v.masked_fill(~finite, -float('inf')).max(dim=1)[0]
+            - v.masked_fill(~finite, float('inf')).min(dim=1)[0])
+
+
+class BatchedPotential:
+    """B finite potentials with the same number of atoms, of positions (B, m, d) and weights (B, m).
+
+    Atoms with a weight of -inf do not contribute, which allows padding problems of different sizes.
+    """
+
+    def __init__(self, positions: torch.Tensor, weights: torch.Tensor, epsilon=1.):
+        self.positions = positions
+        self.weights = weights
+        self.epsilon = epsilon
+        self.n_calls_ = 0
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, b):
+        """Potential of problem b, as a FinitePotential."""
+        return FinitePotential(self.positions[b], self.weights[b], epsilon=self.epsilon)
+
+    def __call__(self, positions: torch.Tensor, C=None, batch_idx=None, free=False):
+        """Evaluation on positions of shape (B, n, d), or (n, d) for the same points in every problem.
+
+        With batch_idx, only the listed problems are evaluated, and positions (or C) are those of these problems.
+        """
+        atom_positions, weights = self.positions, self.weights
+        if batch_idx is not None:
+            atom_positions, weights = atom_positions[batch_idx], weights[batch_idx]
+        if C is None and positions.dim() == 2:
+            positions = positions[None].expand(len(weights), -1, -1)
+        if not free:
+            n = positions.shape[1] if C is None else C.shape[1]
+            self.n_calls_ += len(weights) * n * weights.shape[1] * self.positions.shape[2]
+        return - self.epsilon * batched_logsumexp(positions, atom_positions, weights, self.epsilon, C=C)
+
+    def to(self, device):
+        self.positions = self.positions.to(device)
+        self.weights = self.weights.to(device)
+        return self
+
+    @property
+    def device(self):
+        return self.positions.device
+
+    def cpu(self):
+        return self.to('cpu')
+
+
+def batched_sinkhorn(x, la, y, lb, n_iter=100, epsilon=1., tol=None, precompute_C=True, verbose=False):
+    """Sinkhorn iterations on B problems in lockstep, with x of shape (B, n, d) and y of shape (B, m, d).
+
+    Each problem follows the iterates of `sinkhorn`, with the same fixed-point error, stopping rule and final
+    anchoring F(0) = 0. With tol, problems whose fixed-point error falls below tol are frozen, and the next
+    iterations only run on the remaining ones. Returns batched potentials F and G, with the number of
+    iterations of each problem (n_iter_) and their last fixed-point errors (fixed_err_).
+    """
+    B, n, d = x.shape
+    m = y.shape[1]
+    F = BatchedPotential(y, lb.clone(), epsilon=epsilon)
+    G = BatchedPotential(x, la.clone(), epsilon=epsilon)
+    if precompute_C:
+        Cxy = batched_distance(x, y)
+        F.n_calls_ += B * n * m * d
+    n_iters = torch.zeros(B, dtype=torch.long, device=x.device)
+    fixed_err = torch.full((B,), fill_value=float('inf'), dtype=x.dtype, device=x.device)
+    active = torch.arange(B, device=x.device)
+    for i in range(n_iter):
+        if len(active) == 0:
+            break
+        if len(active) < B:  # Only gather the remaining problems once some have converged
+            idx = active
+            xa, laa, ya, lba = x[idx], la[idx], y[idx], lb[idx]
+            Ca = Cxy[idx] if precompute_C else None
+        else:
+            idx = None
+            xa, laa, ya, lba = x, la, y, lb
+            Ca = Cxy if precompute_C else None
+        eG = G(ya, C=Ca.transpose(1, 2) if precompute_C else None, batch_idx=idx)
+        err = batched_var_norm(eG + lba - F.weights[active])
+        F.weights[active] = eG + lba
+        eF = F(xa, C=Ca, batch_idx=idx)
+        err += batched_var_norm(eF + laa - G.weights[active])
+        G.weights[active] = eF + laa
+        fixed_err[active] = err
+        n_iters[active] += 1
+        if verbose:
+            print(f'n_iter:{i + 1} n_active:{len(active)} fixed_err:{err.max().item():.2e}')
+        if tol is not None:
+            active = active[err >= tol]
+    # Same anchoring as `sinkhorn`: F(0) = 0 in every problem
+    anchor = F(torch.zeros_like(x[:, :1]), free=True)
+    F.weights += anchor
+    G.weights -= anchor
+    F.n_iter_, G.n_iter_ = n_iters, n_iters
+    F.fixed_err_, G.fixed_err_ = fixed_err, fixed_err
+    return F, G
@@ -1,10 +1,14 @@
+import math
 from os.path import expanduser
 
 import torch
-from joblib import Memory
+
+from onlikhorn.kernels import CostCodec, check_block_size, compute_distance, cost_bound
 
 
 def torch_cached(func):
+    from joblib import Memory  # Only needed by the scripts
+
     mem = Memory(expanduser('~/cache'))
 
     def cached_func(*args, **kwargs):
@@ -22,4 +26,210 @@ def torch_cached(func):
             processed_kwargs[k] = kwarg
         return mem.cache(false_func)(*processed_args, **processed_kwargs)
 
-    return cached_func
\ No newline at end of file
+    return cached_func
+
+
+def as_index(idx, n, device):
+    if isinstance(idx, slice):
+        return torch.arange(n, device=device)[idx]
+    return torch.as_tensor(idx, dtype=torch.long, device=device)
+
+
+class BlockCostCache:
+    """Cost between x and y, of shape (n, m, 1), cached by (row_size, col_size) tiles under a memory budget.
+
+    Entries can be written in any order with `scatter`, typically as a by-product of online iterations. Tiles are
+    allocated on their first write, and each cached tile only keeps which of its rows and columns were written: its
+    known entries are tracked as the product of the two, which is exact for the products of seen points written by
+    `online_sinkhorn`, and otherwise a subset of the written entries. Reading a tile (see `kernels.cost_tile`)
+    returns it as is when all its entries are known, and computes it from x and y otherwise. At most max_bytes of
+    tiles are kept, least recently used tiles being evicted first. Tiles may be stored in float16, bfloat16 or int16
+    (see `kernels.CostCodec`). The calls of computed tiles are counted in n_calls_, and charged as well to counter
+    (e.g. a potential) if set, so that they count towards its max_calls budget as they happen.
+    """
+
+    def __init__(self, x, y, block_size=None, max_bytes=None, dtype=None):
+        self.x, self.y = x, y
+        self.codec = CostCodec.from_range(dtype, cost_bound(x, y)) if dtype is not None else CostCodec()
+        (self.row_size, self.col_size, self.n_row_tiles, self.n_col_tiles,
+         n_slots) = self.layout(len(x), len(y), block_size, max_bytes, self.codec.dtype)
+        n_tiles = self.n_row_tiles * self.n_col_tiles
+        device = x.device
+        self.data = [None] * n_slots  # Allocated on first use
+        self.filled_rows = torch.zeros((n_slots, self.row_size), dtype=torch.bool, device=device)
+        self.filled_cols = torch.zeros((n_slots, self.col_size), dtype=torch.bool, device=device)
+        self.last_used = torch.full((n_slots,), fill_value=-1, dtype=torch.long, device=device)
+        self.slot_tiles = torch.full((n_slots,), fill_value=-1, dtype=torch.long, device=device)
+        self.tile_slots = torch.full((n_tiles,), fill_value=-1, dtype=torch.long, device=device)
+        self.clock = 0
+
+        self.n_computed_tiles_ = 0
+        self.n_evictions_ = 0
+        self.n_calls_ = 0
+        self.counter = None
+
+    @staticmethod
+    def layout(n, m, block_size=None, max_bytes=None, dtype=None):
+        """Tile sizes, number of row and column tiles, and number of tile slots within max_bytes."""
+        row_size, col_size = check_block_size(block_size)
+        row_size, col_size = min(row_size, n), min(col_size, m)
+        n_row_tiles, n_col_tiles = math.ceil(n / row_size), math.ceil(m / col_size)
+        n_tiles = n_row_tiles * n_col_tiles
+        tile_bytes = (row_size * col_size * torch.empty((), dtype=dtype or torch.float32).element_size()
+                      + row_size + col_size)
+        n_slots = n_tiles if max_bytes is None else min(n_tiles, int(max_bytes) // tile_bytes)
+        return row_size, col_size, n_row_tiles, n_col_tiles, n_slots
+
+    @classmethod
+    def projected_nbytes(cls, n, m, block_size=None, max_bytes=None, dtype=None):
+        """nbytes of a cache between n and m points once all its slots are used, without allocating it."""
+        dtype = CostCodec.from_range(dtype, 1.).dtype if dtype is not None else torch.float32
+        row_size, col_size, _, _, n_slots = cls.layout(n, m, block_size, max_bytes, dtype)
+        return n_slots * (row_size * col_size * torch.empty((), dtype=dtype).element_size() + row_size + col_size)
+
+    @property
+    def shape(self):
+        return len(self.x), len(self.y), 1
+
+    @property
+    def device(self):
+        return self.x.device
+
+    @property
+    def nbytes(self):
+        return (sum(data.numel() * data.element_size() for data in self.data if data is not None)
+                + self.filled_rows.numel() + self.filled_cols.numel())
+
+    def transpose(self, dim0, dim1):
+        assert {dim0, dim1} == {0, 1}
+        return TransposedCost(self)
+
+    def tile_size(self, tile):
+        i, j = divmod(tile, self.n_col_tiles)
+        return (min(self.row_size, len(self.x) - i * self.row_size),
+                min(self.col_size, len(self.y) - j * self.col_size))
+
+    def allocate(self, tile):
+        """Slot of a tile, evicting the least recently used tile if the pool is full. -1 if the budget is zero."""
+        slot = self.tile_slots[tile].item()
+        if slot < 0 and len(self.data) > 0:
+            slot = torch.argmin(self.last_used).item()
+            old_tile = self.slot_tiles[slot].item()
+            if old_tile >= 0:
+                self.tile_slots[old_tile] = -1
+                self.n_evictions_ += 1
+            self.slot_tiles[slot] = tile
+            self.tile_slots[tile] = slot
+            self.filled_rows[slot] = False
+            self.filled_cols[slot] = False
+            if self.data[slot] is None:
+                self.data[slot] = torch.empty((self.row_size, self.col_size), dtype=self.codec.dtype,
+                                              device=self.device)
+        if slot >= 0:
+            self.clock += 1
+            self.last_used[slot] = self.clock
+        return slot
+
+    def mark_filled(self, slot, rows, cols):
+        """Record that the entries rows x cols of a slot are known.
+
+        The known entries R x K and the new ones rows x cols are still a product (R | rows) x (K | cols) if rows
+        cover R or cols lie in K, and cols cover K or rows lie in R. Otherwise, the largest of the two products is
+        kept, which underestimates the known entries: the tile will only be recomputed.
+        """
+        new_rows = torch.zeros_like(self.filled_rows[slot])
+        new_cols = torch.zeros_like(self.filled_cols[slot])
+        new_rows[rows], new_cols[cols] = True, True
+        known_rows, known_cols = self.filled_rows[slot], self.filled_cols[slot]
+        rows_cover = not torch.any(known_rows & ~new_rows).item()
+        rows_within = not torch.any(new_rows & ~known_rows).item()
+        cols_cover = not torch.any(known_cols & ~new_cols).item()
+        cols_within = not torch.any(new_cols & ~known_cols).item()
+        if (rows_cover or cols_within) and (cols_cover or rows_within):
+            known_rows |= new_rows
+            known_cols |= new_cols
+        elif new_rows.sum() * new_cols.sum() > known_rows.sum() * known_cols.sum():
+            known_rows.copy_(new_rows)
+            known_cols.copy_(new_cols)
+
+    def complete(self, slot, n_rows, n_cols):
+        return bool(self.filled_rows[slot, :n_rows].all() and self.filled_cols[slot, :n_cols].all())
+
+    def scatter(self, xidx, yidx, value):
+        """Write C[xidx[a], yidx[b]] = value[a, b]."""
+        if len(self.data) == 0:
+            return
+        xidx = as_index(xidx, len(self.x), self.device)
+        yidx = as_index(yidx, len(self.y), self.device)
+        value = value.reshape(len(xidx), len(yidx))
+        row_tiles, col_tiles = xidx // self.row_size, yidx // self.col_size
+        for i in torch.unique(row_tiles).tolist():
+            row_sel = torch.nonzero(row_tiles == i)[:, 0]
+            rows = xidx[row_sel] % self.row_size
+            for j in torch.unique(col_tiles).tolist():
+                col_sel = torch.nonzero(col_tiles == j)[:, 0]
+                cols = yidx[col_sel] % self.col_size
+                slot = self.allocate(i * self.n_col_tiles + j)
+                self.data[slot][rows[:, None], cols[None, :]] = self.codec.encode(value[row_sel][:, col_sel])
+                self.mark_filled(slot, rows, cols)
+
+    def get_tile(self, i, j):
+        """Float32 tile (i, j), computed from x and y if some of its entries are unknown."""
+        tile = i * self.n_col_tiles + j
+        n_rows, n_cols = self.tile_size(tile)
+        slot = self.allocate(tile)
+        if slot >= 0 and self.complete(slot, n_rows, n_cols):
+            return self.codec.decode(self.data[slot][:n_rows, :n_cols])
+        rows = slice(i * self.row_size, i * self.row_size + n_rows)
+        cols = slice(j * self.col_size, j * self.col_size + n_cols)
+        C = compute_distance(self.x[rows], self.y[cols])[..., 0]
+        self.n_computed_tiles_ += 1
+        self.n_calls_ += n_rows * n_cols * self.x.shape[1]
+        if self.counter is not None:
+            self.counter.n_calls_ += n_rows * n_cols * self.x.shape[1]
+        if slot >= 0:
+            self.data[slot][:n_rows, :n_cols] = self.codec.encode(C)
+            self.filled_rows[slot, :n_rows] = True
+            self.filled_cols[slot, :n_cols] = True
+        return C
+
+    def tile(self, rows: slice, cols: slice):
+        rows = range(len(self.x))[rows]
+        cols = range(len(self.y))[cols]
+        row_blocks = []
+        for i in range(rows.start // self.row_size, (rows.stop - 1) // self.row_size + 1):
+            row_offset = i * self.row_size
+            col_blocks = []
+            for j in range(cols.start // self.col_size, (cols.stop - 1) // self.col_size + 1):
+                col_offset = j * self.col_size
+                col_blocks.append(self.get_tile(i, j)[max(rows.start - row_offset, 0):rows.stop - row_offset,
+                                                      max(cols.start - col_offset, 0):cols.stop - col_offset])
+            row_blocks.append(torch.cat(col_blocks, dim=1))
+        return torch.cat(row_blocks, dim=0)
+
+
+class TransposedCost:
+    """(m, n, 1) view of a BlockCostCache."""
+
+    def __init__(self, cache: BlockCostCache):
+        self.cache = cache
+
+    @property
+    def shape(self):
+        n, m, _ = self.cache.shape
+        return m, n, 1
+
+    @property
+    def nbytes(self):
+        return self.cache.nbytes
+
+    @property
+    def device(self):
+        return self.cache.device
+
+    def transpose(self, dim0, dim1):
+        assert {dim0, dim1} == {0, 1}
+        return self.cache
+
+    def tile(self, rows: slice, cols: slice):
+        return self.cache.tile(cols, rows).transpose(0, 1)
@@ -0,0 +1,45 @@
+import os
+import random
+
+import numpy as np
+import torch
+
+
+def rng_state():
+    """States of the global random generators (python, numpy, torch and cuda)."""
+    state = dict(python=random.getstate(), numpy=np.random.get_state(), torch=torch.get_rng_state())
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def sampler_state(sampler):
+    return sampler.state_dict() if hasattr(sampler, 'state_dict') else None
+
+
+def load_sampler_state(sampler, state):
+    if state is not None:
+        sampler.load_state_dict(state)
+
+
+def save_checkpoint(filename, state):
+    """Atomic torch.save: the state is written next to filename, which is then replaced in one step, so that
+    a run interrupted while saving leaves the previous checkpoint untouched."""
+    tmp_filename = f'{filename}.tmp'
+    torch.save(state, tmp_filename)
+    os.replace(tmp_filename, filename)
+
+
+def load_checkpoint(filename, map_location=None):
+    try:  # Checkpoints hold whole potentials, which recent torch versions do not unpickle by default
+        return torch.load(filename, map_location=map_location, weights_only=False)
+    except TypeError:
+        return torch.load(filename, map_location=map_location)
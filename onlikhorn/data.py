@@ -1,18 +1,46 @@
-import numpy as np
+import inspect
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Iterable
+
 import torch
-from sklearn.utils import shuffle
+
+
+def sample_without_replacement(n_total, n, generator):
+    """n distinct indices in [0, n_total), in random order, in time O(n) when n is small compared to n_total."""
+    if 2 * n > n_total:
+        return torch.randperm(n_total, generator=generator)[:n]
+    idx = torch.unique(torch.randint(n_total, (n,), generator=generator))
+    while len(idx) < n:
+        extra = torch.randint(n_total, (n - len(idx),), generator=generator)
+        idx = torch.unique(torch.cat([idx, extra]))
+    return idx[torch.randperm(n, generator=generator)]  # torch.unique sorts them
 
 
 class Subsampler:
-    def __init__(self, positions: torch.tensor, weights: torch.tensor, cycle=True):
+    """Draws batches of (positions, normalized log-weights, indices) from a finite measure.
+
+    The data is never moved: cyclic sampling walks through a permutation of the indices, which is redrawn at each
+    epoch, and non-cyclic sampling draws indices without replacement in time proportional to the batch size.
+    Randomness comes from a private torch Generator, seeded from the global torch RNG unless seed is given.
+    With reuse_buffers=True, batches are gathered in buffers that are overwritten by the next call.
+    """
+
+    def __init__(self, positions: torch.tensor, weights: torch.tensor, cycle=True, seed: Optional[int] = None,
+                 reuse_buffers=False):
         self.positions = positions
         self.cycle = cycle
         self.weights = weights
+        self.reuse_buffers = reuse_buffers
 
+        self.generator = torch.Generator()
+        if seed is None:
+            seed = torch.randint(2 ** 62, (1,)).item()
+        self.generator.manual_seed(seed)
         if self.cycle:
-            self.idx = np.arange(len(self.positions), dtype=np.long)
-            self.positions, self.weights, self.idx = shuffle(self.positions, self.weights, self.idx)
+            self.perm = torch.randperm(len(self.positions), generator=self.generator)
         self.cursor = 0
+        self._buffers = None
 
     @property
     def device(self):
@@ -25,32 +53,152 @@ class Subsampler:
     def to(self, device):
         self.positions = self.positions.to(device)
         self.weights = self.weights.to(device)
+        self._buffers = None
         return self
 
-    def __call__(self, n):
-        if n >= len(self.positions):
-            return self.positions, self.weights, self.idx.tolist()
+    def state_dict(self):
+        return dict(generator=self.generator.get_state(), cursor=self.cursor,
+                    perm=self.perm.clone() if self.cycle else None)
+
+    def load_state_dict(self, state):
+        self.generator.set_state(state['generator'])
+        self.cursor = state['cursor']
+        if self.cycle:
+            self.perm = state['perm'].clone()
+
+    def next_indices(self, n):
         if not self.cycle:
-            idx = np.random.permutation(len(self.positions))[:n].tolist()
-            weights = self.weights[idx]
-            positions = self.positions[idx]
+            return sample_without_replacement(len(self.positions), n, self.generator)
+        new_cursor = self.cursor + n
+        if new_cursor >= len(self.positions):
+            idx = self.perm[self.cursor:]
+            self.perm = torch.randperm(len(self.positions), generator=self.generator)
+            reset_cursor = new_cursor - len(self.positions)
+            idx = torch.cat([idx, self.perm[:reset_cursor]], dim=0)
+            self.cursor = reset_cursor
         else:
-            new_cursor = self.cursor + n
-            if new_cursor >= len(self.positions):
-                idx = self.idx[self.cursor:].copy()
-                positions = self.positions[self.cursor:].clone()
-                weights = self.weights[self.cursor:].clone()
-                self.positions, self.weights, self.idx = shuffle(self.positions, self.weights, self.idx)
-                reset_cursor = new_cursor - len(self.positions)
-                idx = np.concatenate([idx, self.idx[:reset_cursor]], axis=0)
-                positions = torch.cat([positions, self.positions[:reset_cursor]], dim=0)
-                weights = torch.cat([weights, self.weights[:reset_cursor]], dim=0)
-                self.cursor = reset_cursor
-            else:
-                idx = self.idx[self.cursor:new_cursor].copy()
-                positions = self.positions[self.cursor:new_cursor].clone()
-                weights = self.weights[self.cursor:new_cursor].clone()
-                self.cursor = new_cursor
+            idx = self.perm[self.cursor:new_cursor]
+            self.cursor = new_cursor
+        return idx
+
+    def gather(self, idx):
+        idx = idx.to(self.device)
+        if not self.reuse_buffers:
+            return torch.index_select(self.positions, 0, idx), torch.index_select(self.weights, 0, idx)
+        if self._buffers is None or len(self._buffers[0]) < len(idx):
+            self._buffers = (self.positions.new_empty((len(idx), self.dimension)),
+                             self.weights.new_empty((len(idx),)))
+        positions, weights = (buffer[:len(idx)] for buffer in self._buffers)
+        torch.index_select(self.positions, 0, idx, out=positions)
+        torch.index_select(self.weights, 0, idx, out=weights)
+        return positions, weights
+
+    def __call__(self, n):
+        if n >= len(self.positions):
+            return self.positions, self.weights, list(range(len(self.positions)))
+        idx = self.next_indices(n)
+        positions, weights = self.gather(idx)
         weights -= torch.logsumexp(weights, dim=0)
         return positions, weights, idx.tolist()
 
+
+class PrefetchSampler:
+    """Drop-in wrapper of a sampler that draws the next batches of a known batch-size schedule in the background.
+
+    Up to `depth` batches are in flight. Batch k is drawn by worker k % n_workers, each worker being a single
+    thread with its own seeded torch Generator, so that draws do not depend on thread timing. Samplers that do
+    not take a generator argument (e.g. Subsampler, which has its own) use a single worker. Draws that do not
+    follow the schedule are done synchronously, after the pending ones.
+    `state_dict` holds the random states as of the last consumed batch, so that pending batches are redrawn
+    identically after `load_state_dict`.
+    """
+
+    def __init__(self, sampler, batch_sizes: Iterable[int], depth=2, n_workers=1, seed: Optional[int] = None):
+        self.sampler = sampler
+        self.schedule = list(batch_sizes)
+        self.position = 0
+        self.depth = depth
+        if 'generator' in inspect.signature(sampler).parameters:
+            if seed is None:
+                seed = torch.randint(2 ** 62, (1,)).item()
+            self.generators = [torch.Generator(device=sampler.device).manual_seed(seed + worker)
+                               for worker in range(n_workers)]
+        else:
+            self.generators = None
+            n_workers = 1
+        self.executors = [ThreadPoolExecutor(max_workers=1) for _ in range(n_workers)]
+        self.pending = deque()
+        self.n_submitted = 0
+        self.fill()
+
+    @property
+    def device(self):
+        return self.sampler.device
+
+    @property
+    def dimension(self):
+        return self.sampler.dimension
+
+    def to(self, device):
+        self.wait()
+        self.sampler.to(device)
+        return self
+
+    def draw(self, n, worker):
+        """Batch of size n, with the random state it was drawn from."""
+        if self.generators is not None:
+            generator = self.generators[worker]
+            return generator.get_state(), self.sampler(n, generator=generator)
+        state = self.sampler.state_dict() if hasattr(self.sampler, 'state_dict') else None
+        return state, self.sampler(n)
+
+    def fill(self):
+        while len(self.pending) < self.depth and self.position < len(self.schedule):
+            n = self.schedule[self.position]
+            self.position += 1
+            worker = self.n_submitted % len(self.executors)
+            self.pending.append((n, worker, self.executors[worker].submit(self.draw, n, worker)))
+            self.n_submitted += 1
+
+    def wait(self):
+        for _, _, future in self.pending:
+            future.result()
+
+    def state_dict(self):
+        self.wait()
+        first_states = {}
+        for _, worker, future in self.pending:
+            first_states.setdefault(worker, future.result()[0])
+        if self.generators is not None:
+            states = [first_states.get(worker, generator.get_state())
+                      for worker, generator in enumerate(self.generators)]
+            return dict(generators=states, sampler=None, n_consumed=self.n_submitted - len(self.pending))
+        state = first_states.get(0, self.sampler.state_dict() if hasattr(self.sampler, 'state_dict') else None)
+        return dict(generators=None, sampler=state, n_consumed=self.n_submitted - len(self.pending))
+
+    def load_state_dict(self, state):
+        """Discard the pending batches, which are redrawn from the loaded states."""
+        self.wait()
+        self.position -= len(self.pending)
+        self.pending.clear()
+        if state['generators'] is not None:
+            for generator, generator_state in zip(self.generators, state['generators']):
+                generator.set_state(generator_state)
+        elif state['sampler'] is not None:
+            self.sampler.load_state_dict(state['sampler'])
+        self.n_submitted = state['n_consumed']
+        self.fill()
+
+    def __call__(self, n):
+        if not self.pending or self.pending[0][0] != n:
+            self.wait()
+            return self.sampler(n)
+        _, _, future = self.pending.popleft()
+        _, (positions, weights, idx) = future.result()
+        self.fill()
+        return positions.to(self.device), weights.to(self.device), idx
+
+    def close(self):
+        self.pending.clear()
+        for executor in self.executors:
+            executor.shutdown(wait=True)
@@ -11,40 +11,56 @@ from onlikhorn.data import Subsampler
 
 
 class GMMSampler:
-    def __init__(self, mean: torch.tensor, cov: torch.tensor, p: torch.tensor):
+    """Gaussian mixture, sampled and evaluated with torch on its device.
+
+    Cholesky factors of the covariances and their inverses are computed once. Sampling draws all component
+    labels and all standard normal vectors at once, and log_prob reduces over components with a logsumexp.
+    Both process batches in chunks of chunk_size points.
+    """
+
+    def __init__(self, mean: torch.tensor, cov: torch.tensor, p: torch.tensor, chunk_size=16384):
         k, d = mean.shape
         k, d, d = cov.shape
         k = p.shape
         self.dimension = d
         self.mean = mean
         self.cov = cov
-        self.icov = torch.cat([torch.inverse(cov)[None, :, :] for cov in self.cov], dim=0)
-        det = torch.tensor([torch.det(cov) for cov in self.cov])
-        self.norm = torch.sqrt((2 * np.pi) ** d * det)
         self.p = p
+        self.chunk_size = chunk_size
+        self.chol = torch.linalg.cholesky(cov)
+        self.ichol = torch.inverse(self.chol)
+        self.log_norm = d / 2 * np.log(2 * np.pi) + torch.log(torch.diagonal(self.chol, dim1=1, dim2=2)).sum(dim=1)
         self.device = 'cpu'
+        self.dtype = torch.float32
 
-    def to(self, device):
+    def to(self, device, dtype=None):
         self.device = device
+        if dtype is not None:
+            self.dtype = dtype
+        for name in ['mean', 'cov', 'p', 'chol', 'ichol', 'log_norm']:
+            setattr(self, name, getattr(self, name).to(device))
         return self
 
-    def __call__(self, n):
-        k, d = self.mean.shape
-        indices = np.random.choice(k, n, p=self.p.numpy())
-        pos = np.zeros((n, d), dtype=np.float32)
-        for i in range(k):
-            mask = indices == i
-            size = mask.sum()
-            pos[mask] = np.random.multivariate_normal(self.mean[i], self.cov[i], size=size)
-        logweight = np.full_like(pos[:, 0], fill_value=-np.log(n))
-        return torch.from_numpy(pos).to(self.device), torch.from_numpy(logweight).to(self.device), None
+    def __call__(self, n, generator=None):
+        """Draw n points. A generator, if given, must live on the device of the sampler."""
+        indices = torch.multinomial(self.p, n, replacement=True, generator=generator)
+        noise = torch.randn((n, self.dimension), generator=generator, dtype=self.mean.dtype, device=self.mean.device)
+        pos = torch.empty((n, self.dimension), dtype=self.dtype, device=self.mean.device)
+        for i in range(0, n, self.chunk_size):
+            chunk = slice(i, i + self.chunk_size)
+            this_indices = indices[chunk]
+            pos[chunk] = self.mean[this_indices] + torch.einsum('bde,be->bd', self.chol[this_indices], noise[chunk])
+        logweight = torch.full((n,), fill_value=-np.log(n), dtype=self.dtype, device=self.mean.device)
+        return pos, logweight, None
 
     def log_prob(self, x):
-        # b, d = x.shape
-        diff = x[:, None, :] - self.mean[None, :]  # b, k, d
-        return torch.log(torch.sum(self.p[None, :] * torch.exp(-torch.einsum('bkd,kde,bke->bk',
-                                                                             [diff, self.icov, diff]) / 2) / self.norm,
-                                   dim=1))
+        log_p = torch.log(self.p) - self.log_norm
+        out = []
+        for chunk in x.split(self.chunk_size):
+            diff = chunk[:, None, :] - self.mean[None, :]  # b, k, d
+            z = torch.einsum('kde,bke->bkd', self.ichol, diff)
+            out.append(torch.logsumexp(log_p[None, :] - (z ** 2).sum(dim=2) / 2, dim=1))
+        return torch.cat(out, dim=0)
 
 
 class GaussianSampler:
@@ -61,8 +77,8 @@ class GaussianSampler:
         self.gmm.to(device)
         return self
 
-    def __call__(self, n):
-        return self.gmm(n)
+    def __call__(self, n, generator=None):
+        return self.gmm(n, generator=generator)
 
     @property
     def dimension(self):
@@ -131,6 +147,9 @@ def get_output_dir():
     return output_dir
 
 
+_dragon_cache = {}
+
+
 def make_dragon(data_dir=None, size=3):
     if data_dir is None:
         data_dir = get_data_dir()
@@ -144,8 +163,11 @@ def make_dragon(data_dir=None, size=3):
             'http://graphics.stanford.edu/pub/3Dscanrep/dragon/dragon_recon.tar.gz',
             join(data_dir, 'dragon.tar.gz'))
         shutil.unpack_archive(join(data_dir, 'dragon.tar.gz'), data_dir)
-    x, la =  load_ply_file(filename, offset=[-0.011, 0.109, -0.008], scale=.04)
-    return x, torch.full_like(la, fill_value=-np.log(len(x)))
+    if filename not in _dragon_cache:  # Parsing the mesh is slow: kept for the next runs of the process
+        x, la = load_ply_file(filename, offset=[-0.011, 0.109, -0.008], scale=.04)
+        _dragon_cache[filename] = x, torch.full_like(la, fill_value=-np.log(len(x)))
+    x, la = _dragon_cache[filename]
+    return x.clone(), la.clone()
 
 
 def make_gmm_1d():
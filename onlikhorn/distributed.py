@@ -0,0 +1,156 @@
+import math
+
+import torch
+import torch.distributed as dist
+
+from onlikhorn.algorithm import InfinitePotential, online_sinkhorn
+from onlikhorn.data import PrefetchSampler
+
+
+def all_reduce_logsumexp(lse, group=None):
+    """logsumexp across ranks of per-rank partial log-sums, shifted by their global maximum for stability."""
+    shift = lse.clone()
+    dist.all_reduce(shift, op=dist.ReduceOp.MAX, group=group)
+    shift = torch.where(torch.isinf(shift), torch.zeros_like(shift), shift)
+    total = torch.exp(lse - shift)
+    dist.all_reduce(total, op=dist.ReduceOp.SUM, group=group)
+    return shift + torch.log(total)
+
+
+class ShardedPotential(InfinitePotential):
+    """InfinitePotential whose atoms are spread over the ranks of a process group.
+
+    Every rank holds up to max_length / world_size atoms. Pushed batches must be the same on every rank: the j-th
+    atom pushed overall goes to rank j % world_size, so that shards stay balanced. Evaluations reduce the
+    local atoms and combine the partial log-sums with an all-reduce, so that every rank must evaluate the same
+    points at the same time. n_samples_ and n_calls_ count the atoms of all ranks, as for a single process.
+    Refitting would need every atom on every rank, and is not supported.
+    """
+
+    def __init__(self, max_length, dimension, epsilon=1., block_size=None, backend=None, backend_options=None,
+                 group=None):
+        self.group = group
+        self.rank = dist.get_rank(group)
+        self.world_size = dist.get_world_size(group)
+        super(ShardedPotential, self).__init__(math.ceil(max_length / self.world_size), dimension, epsilon,
+                                               block_size=block_size, backend=backend,
+                                               backend_options=backend_options)
+        self.rank_seen = [0] * self.world_size
+        self.n_pushed = 0
+
+    @property
+    def n_samples_(self):
+        return sum(self.rank_seen)
+
+    def push(self, positions, weights):
+        n = len(positions)
+        for rank in range(self.world_size):
+            count = len(range((rank - self.n_pushed) % self.world_size, n, self.world_size))
+            self.rank_seen[rank] = min(self.max_length, self.rank_seen[rank] + count)
+        local = torch.arange((self.rank - self.n_pushed) % self.world_size, n, self.world_size,
+                             device=positions.device)
+        self.n_pushed += n
+        if not isinstance(weights, float):
+            weights = weights[local]
+        super(ShardedPotential, self).push(positions[local], weights)
+
+    def reduce(self, positions, atom_positions, atom_weights, C=None):
+        lse = super(ShardedPotential, self).reduce(positions, atom_positions, atom_weights, C=C)
+        return all_reduce_logsumexp(lse, group=self.group)
+
+    def update_queries(self, positions, weights):
+        # Ranks may disagree on whether a push appends, and incremental updates are collective: recompute instead
+        self.invalidate_queries()
+
+    def max_weight(self):
+        weights = self.weights[self.seen]
+        max_weight = weights.max() if len(weights) > 0 else weights.new_tensor(-float('inf'))
+        dist.all_reduce(max_weight, op=dist.ReduceOp.MAX, group=self.group)
+        return max_weight
+
+    def trim(self, ):
+        super(ShardedPotential, self).trim()
+        counts = torch.zeros(self.world_size, dtype=torch.long)
+        counts[self.rank] = self.seen.stop
+        dist.all_reduce(counts, op=dist.ReduceOp.SUM, group=self.group)
+        self.rank_seen = counts.tolist()
+
+    def refit(self, F, C=None):
+        raise NotImplementedError('Sharded potentials cannot be refitted')
+
+
+class BroadcastSampler:
+    """Sampler whose batches are drawn on rank src and broadcast to the other ranks of the group."""
+
+    def __init__(self, sampler, dimension, group=None, src=0, dtype=None):
+        self.sampler = sampler
+        self._dimension = dimension
+        self.group = group
+        self.src = src
+        self.rank = dist.get_rank(group)
+        self.dtype = dtype if dtype is not None else torch.get_default_dtype()
+
+    @property
+    def device(self):
+        return torch.device('cpu')
+
+    @property
+    def dimension(self):
+        return self._dimension
+
+    def __call__(self, n):
+        if self.rank == self.src:
+            positions, weights, _ = self.sampler(n)
+            positions, weights = positions.to(self.dtype).contiguous(), weights.to(self.dtype).contiguous()
+        else:
+            positions = torch.empty((n, self.dimension), dtype=self.dtype)
+            weights = torch.empty((n,), dtype=self.dtype)
+        dist.broadcast(positions, self.src, group=self.group)
+        dist.broadcast(weights, self.src, group=self.group)
+        return positions, weights, None
+
+    def close(self):
+        if hasattr(self.sampler, 'close'):
+            self.sampler.close()
+
+
+def distributed_online_sinkhorn(x_sampler, y_sampler, epsilon=1., max_length=100000, n_iter=100,
+                                batch_sizes=10, lrs=.1, group=None, src=0, prefetch=None, prefetch_workers=1,
+                                block_size=None, backend=None, backend_options=None, verbose=True, **kwargs):
+    """Online Sinkhorn with the atoms of both potentials sharded across the ranks of a process group.
+
+    To be called on every rank, e.g. after `dist.init_process_group('gloo', ...)`. Batches are drawn by the
+    samplers of rank src, optionally prefetched there, and broadcast. Only rank src prints the trace. Other keyword
+    arguments are passed to `online_sinkhorn`, with use_finite=False; refit, async_eval and eval_budget are not
+    supported. Returns the sharded potentials (and trace), the same on every rank.
+    """
+    for option in ['refit', 'async_eval', 'eval_budget', 'force_full']:
+        if kwargs.get(option):
+            raise ValueError(f'{option} is not supported in distributed mode')
+    if isinstance(batch_sizes, int):
+        batch_sizes = [batch_sizes for _ in range(n_iter if not isinstance(lrs, list) else len(lrs))]
+    rank = dist.get_rank(group)
+    if prefetch and rank == src:
+        x_sampler = PrefetchSampler(x_sampler, [batch_sizes[0]] + batch_sizes, depth=prefetch,
+                                    n_workers=prefetch_workers)
+        y_sampler = PrefetchSampler(y_sampler, [batch_sizes[0]] + batch_sizes, depth=prefetch,
+                                    n_workers=prefetch_workers)
+    x_sampler = BroadcastSampler(x_sampler, x_sampler.dimension, group=group, src=src)
+    y_sampler = BroadcastSampler(y_sampler, y_sampler.dimension, group=group, src=src)
+    F = ShardedPotential(max_length, y_sampler.dimension, epsilon=epsilon, block_size=block_size, backend=backend,
+                         backend_options=backend_options, group=group)
+    G = ShardedPotential(max_length, x_sampler.dimension, epsilon=epsilon, block_size=block_size, backend=backend,
+                         backend_options=backend_options, group=group)
+    # Same initialization as online_sinkhorn, which then starts warm
+    x, la, _ = x_sampler(batch_sizes[0])
+    y, lb, _ = y_sampler(batch_sizes[0])
+    F.push(y, la)
+    G.push(x, lb)
+    try:
+        return online_sinkhorn(x_sampler=x_sampler, y_sampler=y_sampler, use_finite=False, epsilon=epsilon,
+                               max_length=max_length, batch_sizes=batch_sizes, lrs=lrs, F=F, G=G,
+                               block_size=block_size, backend=backend, backend_options=backend_options,
+                               verbose=verbose and rank == src, **kwargs)
+    finally:
+        x_sampler.close()
+        y_sampler.close()
@@ -0,0 +1,189 @@
+import hashlib
+import json
+import math
+import os
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+from os.path import join
+
+
+def read_runs(exp_dir):
+    """(run directory, config, run info) of the runs stored by a sacred FileStorageObserver in exp_dir."""
+    if not os.path.exists(exp_dir):
+        return
+    for run_id in sorted(os.listdir(exp_dir)):
+        config_file, run_file = join(exp_dir, run_id, 'config.json'), join(exp_dir, run_id, 'run.json')
+        if not os.path.exists(config_file) or not os.path.exists(run_file):
+            continue
+        try:
+            with open(config_file, 'r') as f:
+                config = json.load(f)
+            with open(run_file, 'r') as f:
+                run = json.load(f)
+        except ValueError:  # Being written
+            continue
+        yield join(exp_dir, run_id), config, run
+
+
+def same_value(value, other):
+    if isinstance(value, float) or isinstance(other, float):
+        return (isinstance(other, (int, float)) and isinstance(value, (int, float))
+                and math.isclose(value, other, rel_tol=1e-9))
+    return value == other
+
+
+def matches(config, run_config):
+    """Whether a run was done with every entry of config (other entries being defaults)."""
+    return all(key in run_config and same_value(value, run_config[key]) for key, value in config.items())
+
+
+def completed_configs(exp_dir):
+    return [config for _, config, run in read_runs(exp_dir) if run.get('status') == 'COMPLETED']
+
+
+def pending_configs(configs, exp_dir):
+    """Configs without a completed run in exp_dir."""
+    completed = completed_configs(exp_dir)
+    return [config for config in configs if not any(matches(config, run_config) for run_config in completed)]
+
+
+def group_configs(configs, keys=('data_source',), chunk_size=None):
+    """Chunks of configs sharing the values of keys, e.g. their dataset, of at most chunk_size configs."""
+    groups = defaultdict(list)
+    for config in configs:
+        groups[tuple(str(config.get(key)) for key in keys)].append(config)
+    chunks = []
+    for group in groups.values():
+        size = len(group) if chunk_size is None else chunk_size
+        chunks.extend(group[i:i + size] for i in range(0, len(group), size))
+    return chunks
+
+
+def run_chunk(run, configs):
+    """Run configs one after the other, returning the failures as (config, error) pairs."""
+    failures = []
+    for config in configs:
+        try:
+            run(config)
+        except Exception as e:
+            failures.append((config, repr(e)))
+    return failures
+
+
+def run_local(run, configs, n_workers=1, exp_dir=None, group_keys=('data_source',), chunk_size=None,
+              verbose=True):
+    """Run run(config) for every config in a pool of n_workers persistent processes.
+
+    Configs with a completed run in exp_dir are skipped. Configs are grouped by the values of group_keys, and each
+    group (split in chunks of at most chunk_size configs) runs within a single worker, so that consecutive runs of a
+    worker share its imports, compiled kernels and memoized datasets. run must be picklable, i.e. defined at the top
+    level of a module; workers are spawned, so that they can use CUDA. Returns the failures as (config, error).
+    """
+    if exp_dir is not None:
+        n_configs = len(configs)
+        configs = pending_configs(configs, exp_dir)
+        if verbose:
+            print(f'Skipping {n_configs - len(configs)} completed configs out of {n_configs}')
+    chunks = group_configs(configs, keys=group_keys, chunk_size=chunk_size)
+    failures = []
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=get_context('spawn')) as executor:
+        futures = [executor.submit(run_chunk, run, chunk) for chunk in chunks]
+        for i, future in enumerate(as_completed(futures)):
+            failures.extend(future.result())
+            if verbose:
+                print(f'{i + 1}/{len(chunks)} chunks done, {len(failures)} failed configs')
+    return failures
+
+
+def config_id(config):
+    """Stable identifier of a config, e.g. to name the checkpoint it resumes from."""
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def run_one(run, config):
+    try:
+        return run(config), None
+    except Exception as e:
+        return None, repr(e)
+
+
+def last_fixed_err(result):
+    """Last test (or train) fixed-point error of a returned trace entry, lower being better."""
+    if result is None:
+        return float('inf')
+    score = result.get('fixed_err_test', result.get('fixed_err_train'))
+    return float('inf') if score is None or math.isnan(score) else score
+
+
+def budgets(min_budget, max_budget, eta=3):
+    """Geometric budgets min_budget * eta ** k, capped at max_budget (the last one)."""
+    budgets = []
+    budget = min_budget
+    while budget < max_budget:
+        budgets.append(budget)
+        budget *= eta
+    return budgets + [max_budget]
+
+
+def successive_halving(run, configs, min_budget, max_budget, eta=3, budget_key='max_calls', checkpoint_dir=None,
+                       problem_keys=('data_source', 'epsilon', 'method'), average_keys=('seed',), score=last_fixed_err,
+                       n_workers=1, exp_dir=None, verbose=True):
+    """Successive halving of a grid of configs over budgets min_budget * eta ** k, up to max_budget.
+
+    Every config first runs with budget_key set to min_budget. Configs then compete within their problem (the values
+    of problem_keys), as candidates that differ only by average_keys, e.g. seeds, scored by the mean of
+    score(run(config)). The best 1 / eta of the candidates of every problem (at least one) run again with eta times
+    the budget, and so on until max_budget. With checkpoint_dir, every config gets a checkpoint file there (config
+    entry 'checkpoint'), the same for all budgets: online.py then resumes promoted runs from the state where the
+    previous budget ran out, instead of starting over. Runs with a completed counterpart in exp_dir are not rerun;
+    the result stored by sacred is used instead. Failed runs are not promoted.
+    Returns a list of (budget, [(config, result), ...]) for every rung.
+    """
+    candidates = defaultdict(list)
+    for config in configs:
+        config = {key: value for key, value in config.items() if key != budget_key}
+        key = tuple((name, str(value)) for name, value in sorted(config.items()) if name not in average_keys)
+        if checkpoint_dir is not None:
+            config['checkpoint'] = join(checkpoint_dir, f'{config_id(config)}.pkl')
+        candidates[key].append(config)
+    problems = defaultdict(list)
+    for key, candidate in candidates.items():
+        problems[tuple(str(candidate[0].get(name)) for name in problem_keys)].append(key)
+    if checkpoint_dir is not None and not os.path.exists(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+    completed = [(config, run_info.get('result')) for _, config, run_info in read_runs(exp_dir)
+                 if run_info.get('status') == 'COMPLETED'] if exp_dir is not None else []
+
+    rungs = []
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=get_context('spawn')) as executor:
+        for budget in budgets(min_budget, max_budget, eta=eta):
+            rung = [(key, dict(config, **{budget_key: budget}))
+                    for keys in problems.values() for key in keys for config in candidates[key]]
+            results = [None] * len(rung)
+            futures = {}
+            for i, (_, config) in enumerate(rung):
+                done = [result for run_config, result in completed if matches(config, run_config)]
+                if done:
+                    results[i] = done[0]
+                else:
+                    futures[executor.submit(run_one, run, config)] = i
+            for future in as_completed(futures):
+                results[futures[future]], error = future.result()
+                if error is not None and verbose:
+                    print(f'Failed: {rung[futures[future]][1]} {error}')
+            rungs.append((budget, [(config, result) for (_, config), result in zip(rung, results)]))
+
+            scores = defaultdict(list)
+            for (key, _), result in zip(rung, results):
+                scores[key].append(score(result))
+            for problem, keys in problems.items():
+                keys = sorted(keys, key=lambda key: sum(scores[key]) / len(scores[key]))
+                problems[problem] = [key for key in keys[:max(len(keys) // eta, 1)]
+                                     if math.isfinite(sum(scores[key]))]
+                if keys and not problems[problem] and verbose:
+                    print(f'Dropping problem {dict(zip(problem_keys, problem))}: no candidate with a finite score')
+            if verbose:
+                print(f'{budget_key}={budget:.2e}: {len(rung)} runs, '
+                      f'{sum(len(keys) for keys in problems.values())} candidates promoted')
+    return rungs
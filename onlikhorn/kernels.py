@@ -0,0 +1,175 @@
+from typing import Union, Tuple
+
+import torch
+from pykeops.torch import LazyTensor
+
+DEFAULT_BLOCK_SIZE = (1024, 8192)
+
+
+def compute_distance(x, y, lazy=False):
+    if lazy:
+        x = LazyTensor(x[:, None, :])
+        y = LazyTensor(y[None, :, :])
+        return (((x - y) ** 2) / 2).sum(dim=2)
+    else:
+        x2 = torch.sum(x ** 2, dim=1)
+        y2 = torch.sum(y ** 2, dim=1)
+        return .5 * (x2[:, None] + y2[None, :] - 2 * x @ y.transpose(0, 1))[..., None]
+
+
+def check_block_size(block_size: Union[None, int, Tuple[int, int]]):
+    if block_size is None:
+        return DEFAULT_BLOCK_SIZE
+    elif isinstance(block_size, int):
+        return block_size, block_size
+    else:
+        row_size, col_size = block_size
+        return int(row_size), int(col_size)
+
+
+COST_DTYPES = {'float32': torch.float32, 'float16': torch.float16, 'bfloat16': torch.bfloat16, 'int16': torch.int16}
+
+
+class CostCodec:
+    """Storage format of a precomputed cost: a float type, or an int16 grid C = offset + scale * q."""
+
+    def __init__(self, dtype=torch.float32, scale=1., offset=0.):
+        if isinstance(dtype, str):
+            dtype = COST_DTYPES[dtype]
+        self.dtype = dtype
+        self.scale = scale
+        self.offset = offset
+
+    @classmethod
+    def from_range(cls, dtype, cost_max):
+        """Codec for costs in [0, cost_max], spanning the whole int16 range if need be.
+
+        Raises a ValueError if cost_max exceeds the largest float16 (65504), rather than storing infinite costs.
+        """
+        if isinstance(dtype, str):
+            dtype = COST_DTYPES[dtype]
+        if dtype == torch.int16:
+            scale = max(float(cost_max), 1e-30) / 65535
+            return cls(dtype, scale=scale, offset=32768 * scale)
+        if cost_max is not None and float(cost_max) > torch.finfo(dtype).max:
+            raise ValueError(f'Costs up to {float(cost_max):.2e} overflow {dtype}, use bfloat16 or int16 instead')
+        return cls(dtype)
+
+    def encode(self, C):
+        if self.dtype == torch.int16:
+            return ((C - self.offset) / self.scale).round_().clamp_(-32768, 32767).to(torch.int16)
+        return C.to(self.dtype)
+
+    def decode(self, data):
+        if self.dtype == torch.int16:
+            return data.float() * self.scale + self.offset
+        return data.float()
+
+    @property
+    def max_error(self):
+        """Worst-case absolute rounding error, relative to the cost for float types."""
+        if self.dtype == torch.int16:
+            return self.scale / 2
+        return torch.finfo(self.dtype).eps / 2
+
+
+class CompressedCost:
+    """Precomputed cost of shape (n, m, 1) held in a reduced-precision format and decoded tile by tile."""
+
+    def __init__(self, data: torch.Tensor, codec: CostCodec):
+        self.data = data
+        self.codec = codec
+
+    @classmethod
+    def empty(cls, n, m, dtype, cost_max=None, device='cpu'):
+        codec = CostCodec.from_range(dtype, cost_max)
+        return cls(torch.empty((n, m, 1), dtype=codec.dtype, device=device), codec)
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def device(self):
+        return self.data.device
+
+    @property
+    def nbytes(self):
+        return self.data.numel() * self.data.element_size()
+
+    def transpose(self, dim0, dim1):
+        return CompressedCost(self.data.transpose(dim0, dim1), self.codec)
+
+    def tile(self, rows: slice, cols: slice):
+        return self.codec.decode(self.data[rows, cols, 0])
+
+    def __setitem__(self, idx, value):
+        self.data[idx] = self.codec.encode(value)
+
+
+def cost_bound(x, y):
+    """Cheap upper bound on max_ij |x_i - y_j|^2 / 2, from the radii of x and y around a common center."""
+    center = (x.mean(dim=0) + y.mean(dim=0)) / 2
+    radius = (x - center[None, :]).norm(dim=1).max() + (y - center[None, :]).norm(dim=1).max()
+    return (radius ** 2 / 2).item()
+
+
+def precompute_cost(x, y, dtype=None, block_size=None):
+    """Precompute the (n, m, 1) cost between x and y, optionally stored in float16, bfloat16 or int16.
+
+    Reduced-precision costs are filled tile by tile, so that no full float32 (n, m) tensor is ever allocated,
+    and are decoded back to float32 tile by tile during evaluation. The soft c-transform is 1-Lipschitz in the
+    cost, so that each potential evaluation is off by at most the rounding error of the storage:
+    codec.max_error * max C for float16 / bfloat16, codec.max_error for the int16 grid.
+    """
+    if dtype is None or COST_DTYPES.get(dtype, dtype) == torch.float32:
+        return compute_distance(x, y, lazy=False)
+    row_size, col_size = check_block_size(block_size)
+    C = CompressedCost.empty(x.shape[0], y.shape[0], dtype, cost_max=cost_bound(x, y), device=x.device)
+    for i in range(0, x.shape[0], row_size):
+        for j in range(0, y.shape[0], col_size):
+            C[i:i + row_size, j:j + col_size] = compute_distance(x[i:i + row_size], y[j:j + col_size])
+    return C
+
+
+def cost_tile(C, rows: slice, cols: slice):
+    """Float32 tile C[rows, cols] of a precomputed cost of shape (n, m, 1)."""
+    if isinstance(C, torch.Tensor):
+        return C[rows, cols, 0].float()
+    return C.tile(rows, cols)
+
+
+def tiled_logsumexp(x, y, weights, epsilon, C=None, block_size=None):
+    """Compute log sum_j exp((weights_j - C(x_i, y_j)) / epsilon) block by block.
+
+    Row blocks of x are reduced against column blocks of y while keeping a running maximum and a running
+    rescaled sum per query, so that at most one (row_size, col_size) block of the cost is alive at a time.
+    If C is provided, its tiles are read instead of being recomputed from x and y.
+    """
+    row_size, col_size = check_block_size(block_size)
+    n = x.shape[0] if C is None else C.shape[0]
+    m = y.shape[0] if C is None else C.shape[1]
+    out = []
+    for i in range(0, n, row_size):
+        rows = slice(i, min(i + row_size, n))
+        running_max = torch.full((rows.stop - i,), fill_value=-float('inf'), dtype=weights.dtype,
+                                 device=weights.device)
+        running_sum = torch.zeros_like(running_max)
+        for j in range(0, m, col_size):
+            cols = slice(j, min(j + col_size, m))
+            if C is None:
+                this_C = compute_distance(x[rows], y[cols])[..., 0]
+            else:
+                this_C = cost_tile(C, rows, cols)
+            weighted_C = (weights[None, cols] - this_C) / epsilon
+            new_max = torch.maximum(running_max, weighted_C.max(dim=1)[0])
+            # Rows with no finite term yet keep a zero shift, so that exp(-inf - 0) = 0 instead of nan
+            shift = torch.where(torch.isinf(new_max), torch.zeros_like(new_max), new_max)
+            running_sum = (running_sum * torch.exp(running_max - shift)
+                           + torch.exp(weighted_C - shift[:, None]).sum(dim=1))
+            running_max = new_max
+        shift = torch.where(torch.isinf(running_max), torch.zeros_like(running_max), running_max)
+        out.append(shift + torch.log(running_sum))
+    if not out:
+        return weights.new_empty((0,))
+    return torch.cat(out, dim=0)
@@ -0,0 +1,151 @@
+import os
+import resource
+
+import torch
+
+from onlikhorn.backend import BLOCK_SIZES, MAX_DENSE_BYTES
+from onlikhorn.cache import BlockCostCache
+from onlikhorn.kernels import check_block_size
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def process_memory():
+    """Current and peak resident set size of the process, in bytes."""
+    if psutil is not None:
+        rss = psutil.Process().memory_info().rss
+    else:
+        with open('/proc/self/statm', 'r') as f:
+            rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # kilobytes on Linux
+    return rss, max(peak_rss, rss)
+
+
+def storage_key(tensor):
+    storage = tensor.untyped_storage() if hasattr(tensor, 'untyped_storage') else tensor.storage()
+    return storage.data_ptr(), storage.nbytes() if hasattr(storage, 'nbytes') else storage.size()
+
+
+def tensor_bytes(*tensors):
+    """Bytes of the buffers holding the tensors, views of a same buffer being counted once."""
+    storages = dict(storage_key(tensor) for tensor in tensors if isinstance(tensor, torch.Tensor))
+    return sum(storages.values())
+
+
+def cost_bytes(C):
+    """Bytes held by a precomputed cost: a tensor, a CompressedCost or a BlockCostCache (or a view of one)."""
+    if C is None:
+        return 0
+    if isinstance(C, torch.Tensor):
+        return tensor_bytes(C)
+    C = getattr(C, 'cache', C)
+    return getattr(C, 'nbytes', 0)
+
+
+def potential_bytes(potential):
+    """Bytes held by the position, weight and bookkeeping buffers of a potential, and by its query caches."""
+    tensors = [value for value in vars(potential).values() if isinstance(value, torch.Tensor)]
+    tensors += [cache['lse'] for cache in potential.query_caches.values() if cache['lse'] is not None]
+    return tensor_bytes(*tensors)
+
+
+def memory_columns(F, G, C=None):
+    """Process and allocator memory, and bytes held by the solver buffers, as flat trace columns."""
+    rss, peak_rss = process_memory()
+    columns = dict(mem_rss=rss, mem_peak_rss=peak_rss, mem_F=potential_bytes(F), mem_G=potential_bytes(G),
+                   mem_C=cost_bytes(C))
+    if F.device.type == 'cuda':
+        columns['mem_cuda'] = torch.cuda.memory_allocated(F.device)
+        columns['mem_cuda_peak'] = torch.cuda.max_memory_allocated(F.device)
+    return columns
+
+
+def reduction_bytes(n, m, element_size, backend=None, block_size=None, device='cpu', cached=False):
+    """Transient bytes of the evaluation of a potential with m atoms on n points (see `BasePotential.get_backend`).
+
+    Dense reductions hold about three (n, m) temporaries, tiled ones three blocks, keops only its output.
+    Reductions of a BlockCostCache (cached=True) are tiled. The 'auto' backend is not benchmarked: the largest of
+    its candidates is assumed.
+    """
+    def tiled(block_size):
+        row_size, col_size = check_block_size(block_size)
+        return 3 * min(row_size, n) * min(col_size, m) * element_size
+
+    if cached:
+        return tiled(block_size)
+    if backend is None:
+        if torch.device(device).type == 'cuda':
+            backend = 'keops'
+        else:
+            backend = 'tiled' if block_size is not None else 'dense'
+    if backend == 'keops':
+        return n * element_size
+    elif backend == 'dense':
+        return 3 * n * m * element_size
+    elif backend == 'auto':
+        candidates = [tiled(block_size) for block_size in BLOCK_SIZES]
+        if 3 * n * m * element_size <= MAX_DENSE_BYTES:
+            candidates.append(3 * n * m * element_size)
+        return max(candidates)
+    return tiled(block_size)
+
+
+def project_online_memory(batch_sizes, dimension, max_length=100000, use_finite=True, n_x=None, n_y=None,
+                          refit=False, force_full=False, precompute_C=False, cache_bytes=None, cost_dtype=None,
+                          block_size=None, backend=None, device='cpu', prefetch=None, dtype=None):
+    """Projected memory of `online_sinkhorn` along a batch size schedule, without allocating anything.
+
+    Returns the projected peak and a list of per-iteration entries with the bytes of the potentials (mem_F, mem_G),
+    of the cost cache (mem_C), of the sampled batches (mem_batches) and of the largest reduction (mem_workspace),
+    and their sum mem_total. The process baseline, the input data held by the samplers and the trace evaluations
+    are not included. Infinite potentials are assumed to never be trimmed.
+    """
+    element_size = torch.empty((), dtype=dtype if dtype is not None else torch.get_default_dtype()).element_size()
+
+    def finite_bytes(n, n_seen):
+        size = n * (dimension + 1) * element_size
+        if n_seen < n:  # Compact buffers, freed once every atom is seen
+            size += n * (1 + 2 * 8) + n * (dimension + 1) * element_size
+        return size
+
+    if force_full and precompute_C:
+        mem_C = BlockCostCache.projected_nbytes(n_x, n_y, block_size=block_size, max_bytes=cache_bytes,
+                                                dtype=cost_dtype)
+    else:
+        mem_C = 0
+    n_buffers = 2 * (1 + (prefetch or 0))
+    projection = []
+    n_seen = 0
+    for i, batch_size in enumerate(batch_sizes):
+        n_seen += batch_size if i > 0 else 2 * batch_size  # With the initial batch
+        if use_finite:
+            m_F, m_G = min(n_seen, n_y), min(n_seen, n_x)
+            mem_F, mem_G = finite_bytes(n_y, m_F), finite_bytes(n_x, m_G)
+        else:
+            m_F = m_G = min(n_seen, max_length)
+            mem_F = mem_G = max_length * (dimension + 1) * element_size
+        if refit:
+            workspace = max(reduction_bytes(m_F, m_G, element_size, backend, block_size, device),
+                            reduction_bytes(m_G, m_F, element_size, backend, block_size, device))
+        else:
+            workspace = max(reduction_bytes(batch_size, m_G, element_size, backend, block_size, device),
+                            reduction_bytes(batch_size, m_F, element_size, backend, block_size, device))
+            if force_full and precompute_C:  # Costs of the batch are materialized to fill the cache
+                workspace = (3 + 1) * batch_size * max(m_F, m_G) * element_size
+        mem_batches = n_buffers * batch_size * (dimension + 1) * element_size
+        projection.append(dict(n_iter=i, n_samples=m_F + m_G, mem_F=mem_F, mem_G=mem_G, mem_C=mem_C,
+                               mem_batches=mem_batches, mem_workspace=workspace,
+                               mem_total=mem_F + mem_G + mem_C + mem_batches + workspace))
+        if force_full and m_F == n_y and m_G == n_x:  # Handoff to Sinkhorn iterations
+            workspace = max(reduction_bytes(n_x, n_y, element_size, backend, block_size, device, precompute_C),
+                            reduction_bytes(n_y, n_x, element_size, backend, block_size, device, precompute_C))
+            mem_F, mem_G = finite_bytes(n_y, n_y), finite_bytes(n_x, n_x)
+            projection.append(dict(n_iter=i + 1, n_samples=n_x + n_y, mem_F=mem_F, mem_G=mem_G, mem_C=mem_C,
+                                   mem_batches=0, mem_workspace=workspace,
+                                   mem_total=mem_F + mem_G + mem_C + workspace))
+            break
+    peak = max((entry['mem_total'] for entry in projection), default=0)
+    return peak, projection
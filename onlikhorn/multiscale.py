@@ -0,0 +1,113 @@
+import time
+
+import torch
+from sklearn.cluster import MiniBatchKMeans
+
+from onlikhorn.algorithm import sinkhorn, FinitePotential
+
+
+def aggregate(x, la, labels, epsilon=1.):
+    """Weighted barycenters and summed log-weights of the clusters given by labels.
+
+    Potentials weight atoms by exp(la / epsilon), so that cluster log-weights are summed as
+    epsilon * logsumexp(la / epsilon), which keeps the coarse problems consistent with the fine one.
+    """
+    _, labels = torch.unique(labels, return_inverse=True)
+    n_clusters = labels.max().item() + 1
+    max_la = la.max()
+    mass = torch.exp((la - max_la) / epsilon)
+    cluster_mass = torch.zeros(n_clusters, dtype=x.dtype, device=x.device).index_add_(0, labels, mass)
+    centers = torch.zeros((n_clusters, x.shape[1]), dtype=x.dtype, device=x.device)
+    centers.index_add_(0, labels, mass[:, None] * x)
+    centers /= cluster_mass[:, None]
+    cluster_la = epsilon * torch.log(cluster_mass) + max_la
+    return centers, cluster_la, labels
+
+
+def grid_clustering(x, la, cell_size, origin, epsilon=1.):
+    coords = torch.floor((x - origin[None, :]) / cell_size).long()
+    _, labels = torch.unique(coords, dim=0, return_inverse=True)
+    return aggregate(x, la, labels, epsilon=epsilon)
+
+
+def kmeans_clustering(x, la, n_clusters, epsilon=1., seed=0):
+    sample_weight = torch.exp((la - la.max()) / epsilon).cpu().numpy()
+    kmeans = MiniBatchKMeans(n_clusters=n_clusters, random_state=seed, n_init=3)
+    kmeans.fit(x.cpu().numpy(), sample_weight=sample_weight)
+    labels = torch.from_numpy(kmeans.labels_).long().to(x.device)
+    return aggregate(x, la, labels, epsilon=epsilon)
+
+
+def make_hierarchy(x, la, y, lb, n_levels=3, method='grid', base_resolution=8, coarsening=8, epsilon=1., seed=0):
+    """Coarse-to-fine list of (x, la, y, lb) problems, the last one being the original problem.
+
+    With method='grid', level k clusters both measures on a common grid with base_resolution * 2 ** k cells per
+    axis. With method='kmeans', level k has n / coarsening ** (n_levels - 1 - k) clusters per measure.
+    """
+    levels = []
+    if method == 'grid':
+        origin = torch.min(x.min(dim=0)[0], y.min(dim=0)[0])
+        extent = (torch.max(x.max(dim=0)[0], y.max(dim=0)[0]) - origin).max().item()
+        for level in range(n_levels - 1):
+            cell_size = extent / (base_resolution * 2 ** level) * (1 + 1e-6)
+            xl, lal, _ = grid_clustering(x, la, cell_size, origin, epsilon=epsilon)
+            yl, lbl, _ = grid_clustering(y, lb, cell_size, origin, epsilon=epsilon)
+            levels.append((xl, lal, yl, lbl))
+    elif method == 'kmeans':
+        for level in range(n_levels - 1):
+            factor = coarsening ** (n_levels - 1 - level)
+            xl, lal, _ = kmeans_clustering(x, la, max(len(x) // factor, 1), epsilon=epsilon, seed=seed)
+            yl, lbl, _ = kmeans_clustering(y, lb, max(len(y) // factor, 1), epsilon=epsilon, seed=seed)
+            levels.append((xl, lal, yl, lbl))
+    else:
+        raise ValueError(f'Unknown clustering method {method}')
+    levels.append((x, la, y, lb))
+    return levels
+
+
+def multiscale_sinkhorn(x, la, y, lb, epsilon=1., n_levels=3, method='grid', base_resolution=8, coarsening=8,
+                        n_iter=10, n_iter_coarse=100, tol=None, coarse_tol=1e-3, save_trace=False, ref=None,
+                        precompute_C=True, max_calls=None, verbose=True, trace_every=1, block_size=None,
+                        backend=None, seed=0):
+    """Coarse-to-fine Sinkhorn: each level is warm-started from the potentials of the coarser one.
+
+    Coarse levels run up to n_iter_coarse iterations or until their fixed-point error reaches coarse_tol,
+    the original problem runs up to n_iter iterations (or until tol). Returns the same outputs as `sinkhorn`,
+    with trace entries tagged with their level.
+    """
+    levels = make_hierarchy(x, la, y, lb, n_levels=n_levels, method=method, base_resolution=base_resolution,
+                            coarsening=coarsening, epsilon=epsilon, seed=seed)
+    F, G = None, None
+    trace = [] if save_trace else None
+    start_time = 0
+    for level, (xl, lal, yl, lbl) in enumerate(levels):
+        last = level == len(levels) - 1
+        level_t0 = time.perf_counter()
+        if F is not None:
+            # Interpolate the coarse potentials on the finer atoms
+            f, g = F(xl), G(yl)
+            n_calls_F, n_calls_G = F.n_calls_, G.n_calls_
+            F = FinitePotential(yl, g + lbl, epsilon=epsilon, block_size=block_size, backend=backend)
+            G = FinitePotential(xl, f + lal, epsilon=epsilon, block_size=block_size, backend=backend)
+            F.n_calls_, G.n_calls_ = n_calls_F, n_calls_G
+        trace_start = len(trace) if save_trace else 0
+        res = sinkhorn(xl, lal, yl, lbl, F=F, G=G, epsilon=epsilon, n_iter=n_iter if last else n_iter_coarse,
+                       tol=tol if last else coarse_tol, save_trace=save_trace, trace=trace, ref=ref,
+                       precompute_C=precompute_C, max_calls=max_calls, verbose=verbose, trace_every=trace_every,
+                       start_time=start_time, block_size=block_size, backend=backend)
+        if save_trace:
+            F, G, trace = res
+            for this_trace in trace[trace_start:]:
+                this_trace['level'] = level
+                this_trace['level_size'] = (len(xl), len(yl))
+            eval_time = trace[-1]['eval_time'] if len(trace) > trace_start else 0
+        else:
+            F, G = res
+            eval_time = 0
+        start_time += time.perf_counter() - level_t0 - eval_time
+        if max_calls is not None and F.n_calls_ + G.n_calls_ > max_calls:
+            break
+    if save_trace:
+        return F, G, trace
+    else:
+        return F, G
@@ -0,0 +1,127 @@
+import atexit
+import os
+import threading
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+
+def worker_loop(tasks, results, n_threads):
+    """Reduce row slices of the shared queries against the shared atoms, until a None task is received."""
+    from onlikhorn.backend import BACKENDS  # Imported in the worker, as the backend module imports this one
+
+    torch.set_num_threads(n_threads)
+    buffers = None
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        if task[0] == 'buffers':
+            buffers = task[1]
+            continue
+        _, rows, m, epsilon, backend, block_size = task
+        queries, positions, weights, out = buffers
+        try:
+            out[rows] = BACKENDS[backend](queries[rows], positions[:m], weights[:m], epsilon, block_size=block_size)
+            results.put((rows.start, None))
+        except Exception as e:
+            results.put((rows.start, repr(e)))
+
+
+class ReductionPool:
+    """Persistent worker processes evaluating log sum_j exp((weights_j - C(x_i, y_j)) / epsilon) by row slices.
+
+    Queries, atoms and the output live in shared memory buffers, which grow as needed and are sent to the workers
+    only when reallocated: a call copies its inputs into them, and every worker writes its rows of the output in
+    place. Each worker runs the single-process backend (tiled by default) with n_threads threads. Pools are meant to
+    be created once per run, and used as backend='pool', backend_options=dict(pool=pool), e.g. in `sinkhorn` with
+    precompute_C=False (precomputed costs are reduced by the tiled backend) or in `evaluate`. Calls are serialized.
+    """
+
+    def __init__(self, n_workers=None, n_threads=1, backend='tiled'):
+        if n_workers is None:
+            n_workers = max(os.cpu_count() // n_threads, 1)
+        self.backend = backend
+        context = mp.get_context('spawn')
+        self.results = context.Queue()
+        self.tasks = [context.Queue() for _ in range(n_workers)]
+        self.workers = [context.Process(target=worker_loop, args=(tasks, self.results, n_threads), daemon=True)
+                        for tasks in self.tasks]
+        for worker in self.workers:
+            worker.start()
+        self.buffers = None
+        self.lock = threading.Lock()
+
+    @property
+    def n_workers(self):
+        return len(self.workers)
+
+    def reserve(self, n, m, d, dtype):
+        """Shared buffers for n queries and m atoms in dimension d, reallocated with some slack if too small."""
+        if self.buffers is not None:
+            queries, positions, _, _ = self.buffers
+            if (queries.shape[0] >= n and positions.shape[0] >= m and queries.shape[1] == d
+                    and queries.dtype == dtype):
+                return self.buffers
+        n, m = 2 * n, 2 * m
+        self.buffers = tuple(buffer.share_memory_() for buffer in (torch.empty((n, d), dtype=dtype),
+                                                                   torch.empty((m, d), dtype=dtype),
+                                                                   torch.empty((m,), dtype=dtype),
+                                                                   torch.empty((n,), dtype=dtype)))
+        for tasks in self.tasks:
+            tasks.put(('buffers', self.buffers))
+        return self.buffers
+
+    def __call__(self, x, y, weights, epsilon, block_size=None):
+        with self.lock:
+            n, m = len(x), len(y)
+            queries, positions, shared_weights, out = self.reserve(n, m, x.shape[1], x.dtype)
+            queries[:n] = x
+            positions[:m] = y
+            shared_weights[:m] = weights
+            bounds = np.linspace(0, n, self.n_workers + 1).astype(int)
+            n_tasks = 0
+            for tasks, start, stop in zip(self.tasks, bounds[:-1], bounds[1:]):
+                if stop > start:
+                    tasks.put(('reduce', slice(start, stop), m, epsilon, self.backend, block_size))
+                    n_tasks += 1
+            errors = [self.results.get()[1] for _ in range(n_tasks)]
+            errors = [error for error in errors if error is not None]
+            if errors:
+                raise RuntimeError(f'Reduction failed in a worker: {errors[0]}')
+            return out[:n].clone().to(x.device)
+
+    def close(self):
+        for tasks in self.tasks:
+            tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+_default_pool = None
+
+
+def get_default_pool():
+    """Pool of os.cpu_count() single-threaded workers, started on first use and closed at exit."""
+    global _default_pool
+    if _default_pool is None:
+        _default_pool = ReductionPool()
+        atexit.register(_default_pool.close)
+    return _default_pool
+
+
+def pool_logsumexp(x, y, weights, epsilon, C=None, block_size=None, pool=None):
+    if C is not None:
+        raise ValueError('The pool backend cannot reduce a precomputed cost')
+    if pool is None:
+        pool = get_default_pool()
+    return pool(x, y, weights, epsilon, block_size=block_size)
@@ -0,0 +1,145 @@
+import json
+import os
+import threading
+import time
+from contextlib import nullcontext
+
+import torch
+
+PHASES = ['sampling', 'distance', 'logsumexp', 'push', 'add_weight', 'trim', 'refit', 'evaluate']
+
+
+class Phase:
+    __slots__ = ('profiler', 'name', 'pairs', 'start', 'parent', 'owner', 'child_time')
+
+    def __init__(self, profiler, name, pairs):
+        self.profiler = profiler
+        self.name = name
+        self.pairs = pairs
+
+    def __enter__(self):
+        stack = self.profiler.stack()
+        self.parent = stack[-1] if stack else None
+        # Phase within an opaque phase (e.g. a reduction within 'evaluate'), counted in the latter
+        self.owner = None
+        if self.parent is not None:
+            if self.parent.owner is not None:
+                self.owner = self.parent.owner
+            elif self.parent.name in self.profiler.opaque:
+                self.owner = self.parent
+        self.child_time = 0.
+        stack.append(self)
+        if self.profiler.synchronize:
+            torch.cuda.synchronize()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.profiler.synchronize:
+            torch.cuda.synchronize()
+        stop = time.perf_counter()
+        self.profiler.stack().pop()
+        if self.owner is not None:
+            self.owner.pairs += self.pairs
+        else:
+            if self.parent is not None:
+                self.parent.child_time += stop - self.start
+            self.profiler.record(self.name, self.start, stop, self.pairs,
+                                 exclusive_time=stop - self.start - self.child_time)
+        return False
+
+
+class Profiler:
+    """Wall time, number of entries and pair evaluations (n * m * d, as n_calls) per solver phase.
+
+    Phases are timed with `with profiler.phase(name, pairs=...)`. Phase times are exclusive: the time of nested
+    phases, e.g. 'logsumexp' within 'refit', is only counted in the nested phase, so that phase times add up. Phases
+    within an opaque phase ('evaluate' by default) are not recorded: their time and pairs are counted in the opaque
+    phase, so that trace evaluations do not inflate solver phases. With record_events=True, every recorded phase is
+    also logged with its start time and thread, for `save_chrome_trace`. With synchronize=True, CUDA streams are
+    synchronized around phases, for accurate GPU timings at the expense of overlap.
+    """
+    enabled = True
+
+    def __init__(self, record_events=True, synchronize=False, opaque=('evaluate',)):
+        self.record_events = record_events
+        self.synchronize = synchronize and torch.cuda.is_available()
+        self.opaque = opaque
+        self.totals = {}
+        self.last_totals = {}
+        self.events = []
+        self.local = threading.local()
+        self.t0 = time.perf_counter()
+
+    def __getstate__(self):  # Thread-local stacks cannot be pickled, e.g. to send a profiler to another process
+        state = self.__dict__.copy()
+        state.pop('local')
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.local = threading.local()
+
+    def stack(self):
+        """Phases open in the current thread."""
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def phase(self, name, pairs=0):
+        return Phase(self, name, pairs)
+
+    def record(self, name, start, stop, pairs=0, exclusive_time=None):
+        """Record a phase, whose time without nested phases is exclusive_time (stop - start by default)."""
+        total = self.totals.get(name)
+        if total is None:
+            total = self.totals[name] = dict(time=0., count=0, pairs=0)
+        total['time'] += stop - start if exclusive_time is None else exclusive_time
+        total['count'] += 1
+        total['pairs'] += pairs
+        if self.record_events:
+            self.events.append((name, start, stop, pairs, threading.get_ident()))
+
+    def columns(self):
+        """Times and pair counts since the previous call, e.g. the previous trace point, as flat trace columns."""
+        columns = {}
+        for name, total in self.totals.items():
+            last = self.last_totals.get(name, dict(time=0., pairs=0))
+            columns[f'profile_{name}_time'] = total['time'] - last['time']
+            columns[f'profile_{name}_pairs'] = total['pairs'] - last['pairs']
+        self.last_totals = {name: dict(total) for name, total in self.totals.items()}
+        return columns
+
+    def chrome_trace(self):
+        pid = os.getpid()
+        events = [dict(name=name, cat='onlikhorn', ph='X', ts=(start - self.t0) * 1e6, dur=(stop - start) * 1e6,
+                       pid=pid, tid=tid, args=dict(pairs=pairs))
+                  for name, start, stop, pairs, tid in self.events]
+        return dict(traceEvents=events, displayTimeUnit='ms')
+
+    def save_chrome_trace(self, filename):
+        """Write the events in the Chrome trace format, readable by chrome://tracing and Perfetto."""
+        with open(filename, 'w+') as f:
+            json.dump(self.chrome_trace(), f)
+
+
+class NullProfiler:
+    """Profiler doing nothing, used when profiling is disabled."""
+    enabled = False
+    _phase = nullcontext()
+
+    def phase(self, name, pairs=0):
+        return self._phase
+
+    def record(self, name, start, stop, pairs=0, exclusive_time=None):
+        pass
+
+    def columns(self):
+        return {}
+
+
+NULL_PROFILER = NullProfiler()
+
+
+def check_profiler(profiler):
+    return NULL_PROFILER if profiler is None else profiler
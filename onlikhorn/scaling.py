@@ -0,0 +1,120 @@
+import time
+
+import torch
+
+from onlikhorn.algorithm import FinitePotential, check_trace, evaluate, var_norm
+from onlikhorn.kernels import compute_distance
+
+
+def kernel_sinkhorn(x, la, y, lb, n_iter=100, epsilon=1., precompute_C=True, tol=None, threshold=1e10,
+                    save_trace=False, ref=None, max_calls=None, verbose=True, trace_every=1, start_time=0):
+    """Sinkhorn in the scaling domain, with matrix-vector products against a precomputed Gibbs kernel.
+
+    The kernel K_ij = exp((alpha_i + beta_j - C_ij) / epsilon) is built once, and iterations reduce to
+    u = a / (K v), v = b / (K^T u). Whenever a scaling leaves [1 / threshold, threshold], it is absorbed in the
+    log-domain potentials alpha and beta and the kernel is rebuilt (log-domain stabilization).
+    Returns the same FinitePotential pair as `sinkhorn`, which it matches at convergence.
+    Kernel passes and kernel rebuilds are counted in n_calls like log-domain passes over a precomputed cost.
+    The cost and kernel are always materialized: precompute_C is True or a precomputed cost, and False is an error.
+    Iterations update F then G, as in `sinkhorn`, and trace the same fixed_err, so that traces are comparable.
+    """
+    eval_time = 0
+    t0 = time.perf_counter()
+    if n_iter is None:
+        assert max_calls is not None
+        n_iter = int(1e6)
+    if precompute_C is False:
+        raise ValueError('kernel_sinkhorn always materializes the cost and the kernel, precompute_C cannot be False')
+    if precompute_C is True:
+        C = compute_distance(x, y, lazy=False)[..., 0]
+    elif isinstance(precompute_C, torch.Tensor):
+        C = precompute_C[..., 0].float()
+    else:  # CompressedCost
+        C = precompute_C.tile(slice(None), slice(None))
+    n, m = C.shape
+    pass_calls = n * m * x.shape[1]
+    n_calls = pass_calls
+
+    trace, ref = check_trace(save_trace, ref=ref, ref_needed=False)
+
+    # Constant shifts of the log-weights only shift the potentials
+    la_, lb_ = la - la.max(), lb - lb.max()
+    a, b = torch.exp(la_ / epsilon), torch.exp(lb_ / epsilon)
+    # The first F update is done in the log-domain, so that the columns of the initial kernel are normalized
+    alpha = la_.clone()
+    beta = - epsilon * torch.logsumexp((alpha[:, None] - C) / epsilon, dim=0) + lb_
+    n_calls += pass_calls
+    u, v = torch.ones_like(alpha), torch.ones_like(beta)
+    tiny = torch.finfo(C.dtype).tiny
+
+    def make_kernel():
+        return torch.exp((alpha[:, None] + beta[None, :] - C) / epsilon)
+
+    def out_of_range(s):
+        return s.max() > threshold or s.min() < 1 / threshold
+
+    def absorb():
+        nonlocal alpha, beta, u, v, K, n_calls, n_absorptions
+        alpha += epsilon * torch.log(u)
+        beta += epsilon * torch.log(v)
+        u.fill_(1.)
+        v.fill_(1.)
+        K = make_kernel()
+        n_calls += pass_calls
+        n_absorptions += 1
+
+    K = make_kernel()
+    n_calls += pass_calls
+    n_absorptions = 0
+    wG, wF = alpha.clone(), lb_.clone()  # Initial weights of G and F in `sinkhorn`
+    call_trace = 0
+    for i in range(n_iter):
+        if i > 0:
+            v = b / (K.transpose(0, 1) @ u).clamp_min(tiny)
+            n_calls += pass_calls
+            if out_of_range(v):
+                absorb()
+        new_wF = beta + epsilon * torch.log(v)
+        u = a / (K @ v).clamp_min(tiny)
+        n_calls += pass_calls
+        if out_of_range(u):
+            absorb()
+        new_wG = alpha + epsilon * torch.log(u)
+        if max_calls is not None and n_calls > max_calls:
+            break
+        fixed_err = (var_norm(new_wG - wG) + var_norm(new_wF - wF)).item()
+        wG, wF = new_wG, new_wF
+        if save_trace and n_calls >= call_trace:
+            eval_t0 = time.perf_counter()
+            F = FinitePotential(y, wF + lb.max(), epsilon=epsilon)
+            G = FinitePotential(x, wG + la.max(), epsilon=epsilon)
+            this_trace = dict(n_iter=i + 1, n_calls=n_calls, n_samples=n + m, fixed_err=fixed_err,
+                              n_absorptions=n_absorptions, algorithm='kernel')
+            ref_fixed_err, ref_err = evaluate(F, G, epsilon, ref)
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            eval_time += time.perf_counter() - eval_t0
+            this_trace['time'] = time.perf_counter() - t0 - eval_time + start_time
+            this_trace['eval_time'] = eval_time
+            for name, err in ref_fixed_err.items():
+                this_trace[f'fixed_err_{name}'] = err
+            for name, err in ref_err.items():
+                this_trace[f'ref_err_{name}'] = err
+            trace.append(this_trace)
+            call_trace = n_calls + trace_every
+            if verbose:
+                print(' '.join(f'{k}:{v:.2e}' if type(v) in [int, float] else f'{k}:{v}' for k, v in this_trace.items()))
+        if tol is not None and fixed_err < tol:
+            break
+    # Fold the scalings back in the log-domain, with G matching F exactly as in `sinkhorn`
+    F = FinitePotential(y, beta + epsilon * torch.log(v) + lb.max(), epsilon=epsilon)
+    eF = F(positions=x, C=C[..., None])
+    G = FinitePotential(x, eF + la, epsilon=epsilon)
+    F.n_calls_ = n_calls
+    anchor = F(torch.zeros_like(x[[0]]))
+    F.add_weight(anchor)
+    G.add_weight(-anchor)
+    if save_trace:
+        return F, G, trace
+    else:
+        return F, G
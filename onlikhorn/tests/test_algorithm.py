@@ -1,8 +1,10 @@
 import pytest
 import torch
 
-from onlikhorn.algorithm import sinkhorn, subsampled_sinkhorn, online_sinkhorn, random_sinkhorn
+from onlikhorn.algorithm import sinkhorn, subsampled_sinkhorn, online_sinkhorn, random_sinkhorn, FinitePotential, \
+    InfinitePotential, evaluate, subsample_atoms
 from onlikhorn.dataset import make_data
+from onlikhorn.kernels import compute_distance, precompute_cost
 
 import numpy as np
 
@@ -49,6 +51,23 @@ def test_precompute_C():
     assert_allclose(Gp(y), G(y))
 
 
+@pytest.mark.parametrize("cost_dtype,tol", [('float16', 1e-2), ('bfloat16', 1e-1), ('int16', 1e-2)])
+def test_precompute_C_dtype(cost_dtype, tol):
+    x, la, y, lb, x_sampler, y_sampler = make_data('gmm_1d', 100)
+    F, G = sinkhorn(x=x, la=la, y=y, lb=lb, n_iter=10, precompute_C=True)
+    Fp, Gp = sinkhorn(x=x, la=la, y=y, lb=lb, n_iter=10, precompute_C=True, cost_dtype=cost_dtype,
+                      block_size=(32, 64))
+    assert (Fp(x) - F(x)).abs().max().item() < tol
+    assert (Gp(y) - G(y)).abs().max().item() < tol
+
+
+def test_precompute_C_float16_overflow():
+    x, y = 1000 * torch.randn(10, 2), 1000 * torch.randn(10, 2)
+    with pytest.raises(ValueError):
+        precompute_cost(x, y, dtype='float16')
+    precompute_cost(x, y, dtype='bfloat16')
+
+
 @pytest.mark.parametrize("device", ['cpu', 'cuda'])
 @pytest.mark.parametrize("save_trace", [True, False])
 @pytest.mark.parametrize("force_full", [True, False])
@@ -106,4 +125,184 @@ def test_gaussian_algorithm(device):
                                           y.to(device), lb.to(device), x_sampler.to(device), y_sampler.to(device))
     F, G = sinkhorn_gaussian(x_sampler=x_sampler, y_sampler=y_sampler)
     assert not np.isnan(F(x).sum().item())
-    assert not np.isnan(G(y).sum().item())
\ No newline at end of file
+    assert not np.isnan(G(y).sum().item())
+
+@pytest.mark.parametrize("block_size", [7, (13, 5), 1000])
+def test_tiled_potential(block_size):
+    x, la, y, lb, x_sampler, y_sampler = make_data('gmm_2d', 50)
+    F = FinitePotential(y, lb.clone(), epsilon=1e-2)
+    Ft = FinitePotential(y, lb.clone(), epsilon=1e-2, block_size=block_size)
+    assert_allclose(Ft(x), F(x))
+    C = compute_distance(x, y)
+    assert_allclose(Ft(x, C=C), F(x, C=C))
+
+
+def test_tiled_sinkhorn():
+    x, la, y, lb, x_sampler, y_sampler = make_data('gmm_1d', 100)
+    F, G = sinkhorn(x=x, la=la, y=y, lb=lb, n_iter=10, precompute_C=False)
+    Ft, Gt = sinkhorn(x=x, la=la, y=y, lb=lb, n_iter=10, precompute_C=False, block_size=(16, 32))
+    assert_allclose(Ft(x), F(x))
+    assert_allclose(Gt(y), G(y))
+
+
+def test_finite_potential_push():
+    x, la, y, lb, x_sampler, y_sampler = make_data('gmm_2d', 50)
+    F = FinitePotential(y, epsilon=1e-1)
+    pushes = [[3, 7, 1], [7, 20, 4], list(range(10, 30))]
+    for idx in pushes:
+        F.push(idx, lb[idx])
+        F.add_weight(-.5)
+    seen = F.seen.tolist()
+    assert sorted(seen) == sorted(set(sum(pushes, [])))
+    positions, weights = F.support()
+    assert_allclose(positions, y[seen])
+    assert_allclose(weights, F.weights[seen])
+    assert_allclose(F(x), FinitePotential(y[seen], F.weights[seen].clone(), epsilon=1e-1)(x))
+    F.push(slice(None), lb)
+    assert F.full
+    assert F.mask is None and F.active_positions is None  # Bookkeeping buffers are freed
+    assert_allclose(F.support()[0], y)
+
+
+@pytest.mark.parametrize("acceleration,omega", [('sor', 1.5), ('sor', 'adaptive'), ('anderson', None)])
+def test_accelerated_sinkhorn(acceleration, omega):
+    x, la, y, lb, x_sampler, y_sampler = make_data('gmm_1d', 100)
+    F, G, trace = sinkhorn(x=x, la=la, y=y, lb=lb, n_iter=1000, epsilon=1e-1, tol=1e-5, save_trace=True,
+                           verbose=False)
+    Fa, Ga, trace_a = sinkhorn(x=x, la=la, y=y, lb=lb, n_iter=1000, epsilon=1e-1, tol=1e-5, save_trace=True,
+                               verbose=False, acceleration=acceleration, omega=omega)
+    assert trace_a[-1]['n_calls'] <= trace[-1]['n_calls']
+    assert (Fa(x) - F(x)).abs().max().item() < 1e-3
+    assert (Ga(y) - G(y)).abs().max().item() < 1e-3
+
+
+@pytest.mark.parametrize("use_finite", [True, False])
+def test_prefetch_online_sinkhorn(use_finite):
+    x, la, y, lb, x_sampler, y_sampler = make_data('gmm_1d', 100)
+    if use_finite:
+        input = dict(x=x, la=la, y=y, lb=lb)
+    else:
+        input = dict(x_sampler=x_sampler, y_sampler=y_sampler)
+    torch.manual_seed(0)
+    F, G = online_sinkhorn(**input, use_finite=use_finite, n_iter=20, batch_sizes=10, verbose=False)
+    torch.manual_seed(0)
+    Fp, Gp = online_sinkhorn(**input, use_finite=use_finite, n_iter=20, batch_sizes=10, verbose=False, prefetch=3)
+    assert not np.isnan(Fp(x).sum().item())
+    if use_finite:  # Subsampler draws do not depend on prefetching
+        assert_allclose(Fp(x), F(x))
+
+
+@pytest.mark.parametrize("algorithm", ['sinkhorn', 'online_sinkhorn'])
+def test_async_eval(algorithm):
+    x, la, y, lb, x_sampler, y_sampler = make_data('gmm_1d', 50)
+    ref = {'train': (None, x, None, y)}
+    func = sinkhorn if algorithm == 'sinkhorn' else online_sinkhorn
+    traces = []
+    for async_eval in [False, True]:
+        torch.manual_seed(0)
+        F, G, trace = func(x=x, la=la, y=y, lb=lb, n_iter=10, save_trace=True, ref=ref, verbose=False,
+                           async_eval=async_eval)
+        traces.append(trace)
+    for this_trace, async_trace in zip(*traces):
+        assert async_trace['n_calls'] == this_trace['n_calls']
+        assert abs(async_trace['fixed_err_train'] - this_trace['fixed_err_train']) < 1e-5
+
+
+@pytest.mark.parametrize("potential", ['finite', 'infinite'])
+def test_query_cache(potential):
+    x, la, y, lb, x_sampler, y_sampler = make_data('gmm_2d', 60)
+    if potential == 'finite':
+        F = FinitePotential(y, epsilon=1e-1)
+    else:
+        F = InfinitePotential(max_length=50, dimension=2, epsilon=1e-1)
+    F.register_queries('train', x)
+    for i in range(6):
+        idx = list(range(10 * i, 10 * (i + 1)))
+        F.push(idx if potential == 'finite' else y[idx], lb[idx])
+        assert_allclose(F.query('train'), F(x, free=True))
+        F.add_weight(-.3)
+        assert_allclose(F.query('train'), F(x, free=True))
+    if potential == 'infinite':
+        F.trim()
+        assert_allclose(F.query('train'), F(x, free=True))
+
+
+@pytest.mark.parametrize("potential", ['finite', 'infinite'])
+def test_query_cache_pending(potential):
+    x, la, y, lb, x_sampler, y_sampler = make_data('gmm_2d', 60)
+    if potential == 'finite':
+        F = FinitePotential(y, epsilon=1e-1)
+    else:
+        F = InfinitePotential(max_length=100, dimension=2, epsilon=1e-1)
+    F.register_queries('train', x)
+    F.push([0, 1] if potential == 'finite' else y[[0, 1]], lb[[0, 1]])
+    F.query('train')
+    n_calls = F.n_calls_
+    for i in range(4):  # Repeated atoms, as in batches across two epochs
+        idx = [5 * i, 5 * i + 1, 5 * i + 1, 5 * i + 2]
+        F.push(idx if potential == 'finite' else y[idx], lb[idx])
+        F.add_weight(-.3)
+    assert len(F.pending_queries) == 4  # Reduced against the queries on the next query only
+    assert F.n_calls_ == n_calls
+    assert_allclose(F.query('train'), F(x, free=True))
+
+
+def test_estimated_errors():
+    x, la, y, lb, x_sampler, y_sampler = make_data('gmm_2d', 200)
+    Fs, Gs = sinkhorn(x=x, la=la, y=y, lb=lb, n_iter=100, epsilon=1e-1)
+    ref = {'train': (Fs(x), x, Gs(y), y)}
+    F, G = sinkhorn(x=x, la=la, y=y, lb=lb, n_iter=3, epsilon=1e-1)
+    fixed_err, ref_err = evaluate(F, G, 1e-1, ref)
+    # Large budgets fall back to the exact errors
+    fixed_est, ref_est = evaluate(F, G, 1e-1, ref, budget=1e9)
+    assert abs(fixed_est['train'] - fixed_err['train']) < 1e-4
+    assert fixed_est['train_lo'] == fixed_est['train_hi'] == fixed_est['train']
+    fixed_est, ref_est = evaluate(F, G, 1e-1, ref, budget=4 * 2 * 50 ** 2)
+    for est, err in [(fixed_est, fixed_err), (ref_est, ref_err)]:
+        assert est['train'] <= est['train_lo'] <= est['train_hi']
+        assert 0 < est['train'] < 10 * err['train']
+
+
+def test_subsample_atoms():
+    x, la, y, lb, x_sampler, y_sampler = make_data('gmm_2d', 400)
+    F = FinitePotential(y, lb.clone(), epsilon=.5)
+    generator = torch.Generator().manual_seed(0)
+    estimates = torch.stack([- F.epsilon * F.reduce(x, *subsample_atoms(F, 200, generator)) for _ in range(20)])
+    assert (estimates.mean(dim=0) - F(x)).abs().mean().item() < .05
+
+
+def test_eval_budget():
+    x, la, y, lb, x_sampler, y_sampler = make_data('gmm_1d', 100)
+    F, G, trace = online_sinkhorn(x=x, la=la, y=y, lb=lb, n_iter=10, save_trace=True, verbose=False,
+                                  eval_budget=.5, ref={'train': (None, x, None, y)})
+    assert all('fixed_err_train_hi' in this_trace for this_trace in trace)
+
+
+@pytest.mark.parametrize("use_finite", [False, True])
+def test_online_sinkhorn_lr_one(use_finite):
+    # A learning rate of 1 discards all previous atoms (add_weight(-inf)), which must reset the query caches
+    x, la, y, lb, x_sampler, y_sampler = make_data('gmm_1d', 100)
+    F, G, trace = online_sinkhorn(x=x, la=la, y=y, lb=lb, x_sampler=x_sampler, y_sampler=y_sampler,
+                                  use_finite=use_finite, n_iter=6, batch_sizes=10, lrs=1, save_trace=True,
+                                  verbose=False, ref={'train': (None, x, None, y)})
+    assert all(np.isfinite(this_trace['fixed_err_train']) for this_trace in trace)
+
+
+@pytest.mark.parametrize("use_finite", [False, True])
+@pytest.mark.parametrize("prefetch", [None, 2])
+@pytest.mark.parametrize("checkpoint_every", [0, 1e9])  # Only saved when running out of calls with 1e9
+def test_checkpoint_resume(use_finite, prefetch, checkpoint_every, tmp_path):
+    x, la, y, lb, x_sampler, y_sampler = make_data('gmm_1d', 100)
+    ref = {'train': (None, x, None, y)}
+    kwargs = dict(x=x, la=la, y=y, lb=lb, x_sampler=x_sampler, y_sampler=y_sampler, use_finite=use_finite,
+                  n_iter=20, batch_sizes=10, save_trace=True, ref=ref, verbose=False, prefetch=prefetch)
+    torch.manual_seed(0)
+    F, G, trace = online_sinkhorn(**kwargs)
+    checkpoint = str(tmp_path / 'checkpoint.pkl')
+    torch.manual_seed(0)
+    online_sinkhorn(**kwargs, max_calls=trace[8]['n_calls'], checkpoint=checkpoint, checkpoint_every=checkpoint_every)
+    torch.manual_seed(1)  # Random states are restored from the checkpoint
+    Fr, Gr, resumed_trace = online_sinkhorn(**kwargs, checkpoint=checkpoint, checkpoint_every=checkpoint_every)
+    assert_allclose(Fr(x), F(x))
+    assert_allclose(Gr(y), G(y))
+    assert [this_trace['n_calls'] for this_trace in resumed_trace] == [this_trace['n_calls'] for this_trace in trace]
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+import torch
+
+from onlikhorn.algorithm import sinkhorn, var_norm
+from onlikhorn.annealing import epsilon_schedule, scaled_sinkhorn, scaled_online_sinkhorn, regularization_path
+from onlikhorn.dataset import make_data
+
+
+def test_epsilon_schedule():
+    epsilons = epsilon_schedule(1e-3, epsilon_start=1., decay=.5)
+    assert epsilons[0] == 1.
+    assert epsilons[-1] == 1e-3
+    assert np.all(np.diff(epsilons) < 0)
+    assert epsilon_schedule(1., epsilon_start=.1) == [1.]
+    assert epsilon_schedule(1e-3, epsilon_start=1., decay=.1) == [1., 1e-1, 1e-2, 1e-3]
+    assert epsilon_schedule(1e-2, epsilon_start=1., decay=.1 ** .5) == [1., .316227766017, 1e-1, .0316227766017, 1e-2]
+
+
+def test_scaled_sinkhorn():
+    x, la, y, lb, x_sampler, y_sampler = make_data('gmm_1d', 100)
+    F, G = sinkhorn(x=x, la=la, y=y, lb=lb, n_iter=1000, epsilon=1e-1, tol=1e-6)
+    Fs, Gs, trace = scaled_sinkhorn(x=x, la=la, y=y, lb=lb, n_iter=1000, epsilon=1e-1, epsilon_start=10.,
+                                    tol=1e-6, save_trace=True, verbose=False)
+    assert var_norm(Fs(x) - F(x)).item() < 1e-3
+    assert var_norm(Gs(y) - G(y)).item() < 1e-3
+    stages = [this_trace['stage'] for this_trace in trace]
+    assert stages[0] == 0 and stages[-1] == len(epsilon_schedule(1e-1, 10.)) - 1
+    assert all(this_trace['stage_n_calls'] <= this_trace['n_calls'] for this_trace in trace)
+
+
+def test_scaled_sinkhorn_calls():
+    # Annealing reaches tol at small epsilon with fewer calls than a direct solve
+    torch.manual_seed(0)
+    np.random.seed(0)
+    x, la, y, lb, x_sampler, y_sampler = make_data('gmm_1d', 100)
+    F, G = sinkhorn(x=x, la=la, y=y, lb=lb, n_iter=20000, epsilon=3e-2, tol=1e-5, verbose=False)
+    Fs, Gs = scaled_sinkhorn(x=x, la=la, y=y, lb=lb, n_iter=20000, epsilon=3e-2, epsilon_start=1., tol=1e-5,
+                             verbose=False)
+    assert Fs.n_calls_ + Gs.n_calls_ < F.n_calls_ + G.n_calls_
+    assert var_norm(Fs(x) - F(x)).item() < 1e-3
+
+
+@pytest.mark.parametrize("use_finite", [True, False])
+def test_scaled_online_sinkhorn(use_finite):
+    x, la, y, lb, x_sampler, y_sampler = make_data('gmm_1d', 10)
+    F, G = sinkhorn(x=x, la=la, y=y, lb=lb, n_iter=10)
+    ref = {'train': (F(x), x, G(y), y)}
+    if use_finite:
+        input = dict(x=x, la=la, y=y, lb=lb)
+    else:
+        input = dict(x_sampler=x_sampler, y_sampler=y_sampler)
+    F, G, trace = scaled_online_sinkhorn(**input, use_finite=use_finite, epsilon=1e-1, epsilon_start=1.,
+                                         n_iter=20, batch_sizes=10, lrs=.5, save_trace=True, ref=ref,
+                                         verbose=False)
+    assert len(set(this_trace['stage'] for this_trace in trace)) == len(epsilon_schedule(1e-1, 1.))
+    assert not np.isnan(F(x).sum().item())
+    assert not np.isnan(G(y).sum().item())
+
+
+def test_regularization_path():
+    torch.manual_seed(0)
+    np.random.seed(0)
+    x, la, y, lb, x_sampler, y_sampler = make_data('gmm_1d', 100)
+    epsilons = [1e-1, 1., 1e-2]
+    solutions, trace = regularization_path(x, la, y, lb, epsilons, n_iter=2000, tol=1e-6, save_trace=True,
+                                           verbose=False)
+    assert [epsilon for epsilon, _, _ in solutions] == [1., 1e-1, 1e-2]
+    cold_calls = 0
+    for epsilon, Fp, Gp in solutions:
+        # Cold solves at small epsilon need more iterations to reach tol
+        F, G = sinkhorn(x=x, la=la, y=y, lb=lb, n_iter=10000, epsilon=epsilon, tol=1e-6, verbose=False)
+        cold_calls += F.n_calls_ + G.n_calls_
+        assert var_norm(Fp(x) - F(x)).item() < 1e-3
+        assert var_norm(Gp(y) - G(y)).item() < 1e-3
+    assert trace[-1]['n_calls'] < cold_calls
+    assert set(this_trace['stage_epsilon'] for this_trace in trace) == set(epsilons)
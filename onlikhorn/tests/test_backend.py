@@ -0,0 +1,85 @@
+import json
+
+import pytest
+import torch
+from torch.testing import assert_allclose
+
+from onlikhorn import backend
+from onlikhorn.algorithm import FinitePotential
+from onlikhorn.backend import BACKENDS, select_backend
+from onlikhorn.dataset import make_data
+
+
+@pytest.mark.parametrize("name", ['dense', 'tiled', 'keops'])
+def test_backends(name):
+    x, la, y, lb, x_sampler, y_sampler = make_data('gmm_2d', 50)
+    F = FinitePotential(y, lb.clone(), epsilon=1e-1)
+    Fb = FinitePotential(y, lb.clone(), epsilon=1e-1, backend=name, block_size=(8, 16))
+    try:
+        e = Fb(x)
+    except Exception:
+        if name == 'keops':
+            pytest.skip('KeOps unavailable')
+        raise
+    assert_allclose(e, F(x))
+    assert Fb.backend_stats_[name]['calls'] == 1
+
+
+def test_select_backend(tmp_path, monkeypatch):
+    cache_file = str(tmp_path / 'backends.json')
+    monkeypatch.setattr(backend, '_selection_cache', {})
+    name, block_size = select_backend(100, 200, 2, cache_file=cache_file)
+    assert name in BACKENDS
+    with open(cache_file, 'r') as f:
+        selections = json.load(f)
+    assert len(selections) == 1
+    selection, = selections.values()
+    assert selection['backend'] == name
+    assert len(selection['timings']) > 1
+
+    # Second selection is read from the disk cache, without probing
+    monkeypatch.setattr(backend, '_selection_cache', {})
+    monkeypatch.setattr(backend, 'autotune', None)
+    assert select_backend(120, 256, 2, cache_file=cache_file) == (name, block_size)
+
+
+@pytest.mark.parametrize("tol", [1e-6, 1e-2])
+def test_truncated(tol):
+    epsilon = 1e-3
+    x, la, y, lb, x_sampler, y_sampler = make_data('gmm_2d', 200)
+    F = FinitePotential(y, lb.clone(), epsilon=epsilon)
+    Ft = FinitePotential(y, lb.clone(), epsilon=epsilon, backend='truncated', backend_options=dict(tol=tol))
+    e, et = F(x), Ft(x)
+    # Skipped terms can only decrease the logsumexp
+    assert torch.all(et - e >= -1e-5)
+    assert torch.all(et - e <= epsilon * tol + 1e-5)
+
+
+def test_truncated_empty():
+    x, la, y, lb, x_sampler, y_sampler = make_data('gmm_2d', 20)
+    assert BACKENDS['truncated'](x[:0], y, lb, 1e-2).shape == (0,)
+    assert torch.all(BACKENDS['truncated'](x, y[:0], lb[:0], 1e-2) == -float('inf'))
+    assert torch.all(BACKENDS['truncated'](x, y, torch.full_like(lb, -float('inf')), 1e-2) == -float('inf'))
+
+
+def test_pool():
+    from onlikhorn.algorithm import sinkhorn, evaluate
+    from onlikhorn.parallel import ReductionPool
+
+    x, la, y, lb, x_sampler, y_sampler = make_data('gmm_2d', 50)
+    with ReductionPool(n_workers=3) as pool:
+        assert_allclose(pool(x, y, lb, 1e-1, block_size=(8, 16)), BACKENDS['dense'](x, y, lb, 1e-1))
+        # Buffers grow with the problem size
+        x2, la2, y2, lb2, _, _ = make_data('gmm_2d', 200)
+        assert_allclose(pool(x2, y2, lb2, 1e-1), BACKENDS['dense'](x2, y2, lb2, 1e-1))
+
+        F, G = sinkhorn(x, la, y, lb, n_iter=10, epsilon=1e-1, precompute_C=False, verbose=False)
+        Fp, Gp = sinkhorn(x, la, y, lb, n_iter=10, epsilon=1e-1, precompute_C=False, verbose=False,
+                          backend='pool', backend_options=dict(pool=pool))
+        assert Fp.backend_stats_['pool']['calls'] > 0
+        assert_allclose(Fp(x), F(x))
+        ref = {'train': (F(x), x, G(y), y)}
+        fixed_err, ref_err = evaluate(F, G, 1e-1, ref)
+        pool_fixed_err, pool_ref_err = evaluate(F, G, 1e-1, ref, backend='pool', backend_options=dict(pool=pool))
+        assert abs(pool_fixed_err['train'] - fixed_err['train']) < 1e-5
+        assert F.backend is None
@@ -0,0 +1,32 @@
+import pytest
+import torch
+from torch.testing import assert_allclose
+
+from onlikhorn.algorithm import sinkhorn
+from onlikhorn.batched import batched_sinkhorn
+from onlikhorn.dataset import make_data
+
+
+def make_batch(n_problems, n_samples):
+    problems = [make_data('gmm_2d', n_samples)[:4] for _ in range(n_problems)]
+    return [torch.stack(tensors) for tensors in zip(*problems)]
+
+
+@pytest.mark.parametrize("precompute_C", [True, False])
+@pytest.mark.parametrize("tol", [None, 1e-4])
+def test_batched_sinkhorn(precompute_C, tol):
+    torch.manual_seed(0)
+    x, la, y, lb = make_batch(4, 30)
+    n_iter = 50 if tol is None else 1000
+    F, G = batched_sinkhorn(x, la, y, lb, n_iter=n_iter, epsilon=1e-1, tol=tol, precompute_C=precompute_C)
+    z = torch.randn(10, 2)
+    fz = F(z)
+    assert fz.shape == (4, 10)
+    for b in range(4):
+        Fb, Gb = sinkhorn(x[b], la[b], y[b], lb[b], n_iter=n_iter, epsilon=1e-1, tol=tol, verbose=False)
+        assert_allclose(F(x)[b], Fb(x[b]), rtol=1e-4, atol=1e-4)
+        assert_allclose(G(y)[b], Gb(y[b]), rtol=1e-4, atol=1e-4)
+        assert_allclose(fz[b], F[b](z), rtol=1e-5, atol=1e-5)
+    if tol is not None:
+        assert (F.fixed_err_ < tol).all()
+        assert (F.n_iter_ < n_iter).all()
@@ -0,0 +1,70 @@
+import pytest
+import torch
+from torch.testing import assert_allclose
+
+from onlikhorn.algorithm import online_sinkhorn, sinkhorn
+from onlikhorn.cache import BlockCostCache
+from onlikhorn.dataset import make_data
+from onlikhorn.kernels import compute_distance
+
+
+@pytest.mark.parametrize("max_bytes", [None, 2000, 0])
+def test_block_cost_cache(max_bytes):
+    x, la, y, lb, x_sampler, y_sampler = make_data('gmm_2d', 50)
+    C = compute_distance(x, y)[..., 0]
+    cache = BlockCostCache(x, y, block_size=(16, 8), max_bytes=max_bytes)
+    xidx, yidx = torch.arange(0, 32), torch.tensor([1, 3, 5, 40])
+    cache.scatter(xidx, yidx, C[xidx][:, yidx])
+    assert_allclose(cache.tile(slice(None), slice(None)), C)
+    assert_allclose(cache.tile(slice(3, 20), slice(5, 30)), C[3:20, 5:30])
+    assert_allclose(cache.transpose(0, 1).tile(slice(7, 37), slice(0, 16)), C.transpose(0, 1)[7:37, :16])
+    if max_bytes is None:
+        n_computed = cache.n_computed_tiles_
+        cache.tile(slice(None), slice(None))
+        assert cache.n_computed_tiles_ == n_computed
+    else:
+        assert cache.nbytes <= max_bytes
+
+
+@pytest.mark.parametrize("cache_bytes", [None, 10000])
+def test_online_sinkhorn_cache(cache_bytes):
+    x, la, y, lb, x_sampler, y_sampler = make_data('gmm_1d', 40)
+    F, G = online_sinkhorn(x=x, la=la, y=y, lb=lb, n_iter=100, batch_sizes=10, lrs=1., force_full=True,
+                           precompute_C=True, cache_bytes=cache_bytes, block_size=(16, 16), verbose=False)
+    Fs, Gs = sinkhorn(x=x, la=la, y=y, lb=lb, n_iter=100, verbose=False)
+    assert (F(x) - Fs(x)).abs().max().item() < 1e-3
+    assert (G(y) - Gs(y)).abs().max().item() < 1e-3
+
+
+def test_online_sinkhorn_cache_calls():
+    x, la, y, lb, x_sampler, y_sampler = make_data('gmm_1d', 40)
+    # Without cache, every Sinkhorn iteration computes the costs twice, counted as they are computed
+    F, G, trace = online_sinkhorn(x=x, la=la, y=y, lb=lb, n_iter=100, batch_sizes=10, lrs=1., force_full=True,
+                                  precompute_C=True, cache_bytes=0, block_size=(16, 16), save_trace=True,
+                                  ref={'train': (None, x, None, y)}, verbose=False)
+    full_trace = [this_trace for this_trace in trace if this_trace['algorithm'] == 'full']
+    for this_trace, next_trace in zip(full_trace[:-1], full_trace[1:]):
+        assert next_trace['n_calls'] - this_trace['n_calls'] == 4 * 40 * 40
+
+
+def test_block_cost_cache_fill():
+    x, la, y, lb, x_sampler, y_sampler = make_data('gmm_2d', 32)
+    C = compute_distance(x, y)[..., 0]
+    cache = BlockCostCache(x, y, block_size=(16, 16))
+    assert cache.nbytes == 4 * (16 + 16)  # Tiles are allocated on first write
+    # Products of seen points, as written by online_sinkhorn
+    seen_x, seen_y = torch.arange(0, 8), torch.arange(0, 8)
+    cache.scatter(seen_x, seen_y, C[seen_x][:, seen_y])
+    assert cache.nbytes == 16 * 16 * 4 + 4 * (16 + 16)
+    new_y = torch.arange(8, 16)
+    cache.scatter(seen_x, new_y, C[seen_x][:, new_y])
+    seen_y = torch.arange(0, 16)
+    new_x = torch.arange(8, 16)
+    cache.scatter(new_x, seen_y, C[new_x][:, seen_y])
+    assert_allclose(cache.tile(slice(0, 16), slice(0, 16)), C[:16, :16])
+    assert cache.n_computed_tiles_ == 0
+    # A write that does not extend the known product is not trusted beyond the largest product
+    cache.scatter(torch.arange(16, 20), torch.arange(16, 18), C[16:20, 16:18])
+    cache.scatter(torch.arange(18, 22), torch.arange(18, 20), C[18:22, 18:20])
+    assert_allclose(cache.tile(slice(16, 32), slice(16, 32)), C[16:, 16:])
+    assert cache.n_computed_tiles_ == 1
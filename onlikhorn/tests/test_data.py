@@ -1,8 +1,9 @@
 import pytest
 import torch
+from torch.testing import assert_allclose
 
-from onlikhorn.data import Subsampler
-from onlikhorn.dataset import make_data
+from onlikhorn.data import Subsampler, PrefetchSampler, sample_without_replacement
+from onlikhorn.dataset import make_data, make_gmm
 
 
 @pytest.mark.parametrize("device", ['cpu', 'cuda'])
@@ -26,3 +27,76 @@ def test_subsampler(device):
     assert(x.device.type == device)
     assert(la.device.type == device)
     assert isinstance(xidx, list)
+
+
+@pytest.mark.parametrize("cycle", [True, False])
+@pytest.mark.parametrize("reuse_buffers", [True, False])
+def test_subsampler_draws(cycle, reuse_buffers):
+    x, la, y, lb, x_sampler, y_sampler = make_data('gmm_1d', 100)
+    sampler = Subsampler(x, la, cycle=cycle, seed=0, reuse_buffers=reuse_buffers)
+    state = sampler.state_dict()
+    seen = []
+    for k in range(10):
+        xb, lab, idx = sampler(30)
+        if not cycle or (30 * k) // 100 == (30 * k + 29) // 100:  # Batches across two epochs may repeat points
+            assert len(set(idx)) == 30
+        assert torch.equal(xb, x[idx])
+        assert abs(torch.logsumexp(lab, dim=0).item()) < 1e-5
+        seen += idx
+    if cycle:  # Each epoch visits every point once
+        for epoch in range(3):
+            assert sorted(seen[100 * epoch:100 * (epoch + 1)]) == list(range(100))
+    sampler.load_state_dict(state)
+    assert sampler(30)[2] == seen[:30]
+
+
+def test_sample_without_replacement():
+    idx = sample_without_replacement(10 ** 6, 100, torch.Generator().manual_seed(0))
+    assert len(set(idx.tolist())) == 100
+    assert not torch.equal(idx, torch.sort(idx).values)  # In random order, as a permutation prefix would be
+
+
+def test_gmm_log_prob():
+    x_sampler, _ = make_gmm(3, 4)
+    x_sampler.chunk_size = 7
+    x, _, _ = x_sampler(50, generator=torch.Generator().manual_seed(0))
+    x2, _, _ = x_sampler(50, generator=torch.Generator().manual_seed(0))
+    assert torch.equal(x, x2)
+    mixture = torch.distributions.MixtureSameFamily(
+        torch.distributions.Categorical(probs=x_sampler.p),
+        torch.distributions.MultivariateNormal(x_sampler.mean, covariance_matrix=x_sampler.cov))
+    assert_allclose(x_sampler.log_prob(x), mixture.log_prob(x))
+
+
+@pytest.mark.parametrize("n_workers", [1, 3])
+def test_prefetch_sampler(n_workers):
+    x_sampler, _ = make_gmm(2, 3)
+    batch_sizes = [10 * (i + 1) for i in range(6)]
+    draws = []
+    for _ in range(2):
+        sampler = PrefetchSampler(x_sampler, batch_sizes, depth=2, n_workers=n_workers, seed=0)
+        draws.append([sampler(n)[0] for n in batch_sizes])
+        assert len(sampler(5)[0]) == 5  # Off-schedule draw
+        sampler.close()
+    for x, x2, n in zip(*draws, batch_sizes):
+        assert len(x) == n
+        assert torch.equal(x, x2)
+
+
+@pytest.mark.parametrize("n_workers", [1, 2])
+def test_prefetch_sampler_state(n_workers):
+    x_sampler, _ = make_gmm(2, 3)
+    batch_sizes = [10 * (i + 1) for i in range(6)]
+    sampler = PrefetchSampler(x_sampler, batch_sizes, depth=3, n_workers=n_workers, seed=0)
+    draws = [sampler(n)[0] for n in batch_sizes]
+    sampler.close()
+    sampler = PrefetchSampler(x_sampler, batch_sizes, depth=3, n_workers=n_workers, seed=0)
+    for n in batch_sizes[:2]:
+        sampler(n)
+    state = sampler.state_dict()
+    sampler.close()
+    sampler = PrefetchSampler(x_sampler, batch_sizes[2:], depth=3, n_workers=n_workers, seed=1)
+    sampler.load_state_dict(state)
+    for x, n in zip(draws[2:], batch_sizes[2:]):
+        assert torch.equal(sampler(n)[0], x)
+    sampler.close()
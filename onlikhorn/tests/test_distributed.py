@@ -0,0 +1,40 @@
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from onlikhorn.algorithm import online_sinkhorn
+from onlikhorn.dataset import make_gmm_1d
+from onlikhorn.distributed import distributed_online_sinkhorn
+
+KWARGS = dict(epsilon=1e-1, n_iter=10, batch_sizes=10, lrs=.5, max_length=1000, trim_every=5)
+
+
+def run(rank, world_size, init_file, out_file):
+    dist.init_process_group('gloo', init_method=f'file://{init_file}', rank=rank, world_size=world_size)
+    torch.manual_seed(0)
+    x_sampler, y_sampler = make_gmm_1d()
+    F, G = distributed_online_sinkhorn(x_sampler, y_sampler, verbose=False, **KWARGS)
+    z = torch.linspace(-1, 6, 20)[:, None]
+    f, g = F(z), G(z)
+    assert F.n_samples_ == sum(F.rank_seen)
+    if rank == 0:
+        torch.save(dict(f=f, g=g, n_calls=F.n_calls_ + G.n_calls_), out_file)
+    dist.destroy_process_group()
+
+
+@pytest.mark.parametrize("world_size", [2, 3])
+def test_distributed_online_sinkhorn(world_size, tmp_path):
+    if not dist.is_available():
+        pytest.skip('No torch.distributed')
+    out_file = str(tmp_path / 'out.pkl')
+    mp.spawn(run, args=(world_size, str(tmp_path / 'init'), out_file), nprocs=world_size)
+    res = torch.load(out_file)
+
+    torch.manual_seed(0)
+    x_sampler, y_sampler = make_gmm_1d()
+    F, G = online_sinkhorn(x_sampler=x_sampler, y_sampler=y_sampler, use_finite=False, verbose=False, **KWARGS)
+    z = torch.linspace(-1, 6, 20)[:, None]
+    assert (res['f'] - F(z)).abs().max().item() < 1e-4
+    assert (res['g'] - G(z)).abs().max().item() < 1e-4
+    assert res['n_calls'] == F.n_calls_ + G.n_calls_
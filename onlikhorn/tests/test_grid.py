@@ -0,0 +1,92 @@
+import json
+import math
+import os
+
+from onlikhorn.algorithm import online_sinkhorn
+from onlikhorn.dataset import make_data
+from onlikhorn.grid import group_configs, last_fixed_err, pending_configs, run_local, successive_halving
+
+
+def write_run(exp_dir, run_id, config, status):
+    os.makedirs(exp_dir / run_id)
+    with open(exp_dir / run_id / 'config.json', 'w+') as f:
+        json.dump(config, f)
+    with open(exp_dir / run_id / 'run.json', 'w+') as f:
+        json.dump(dict(status=status), f)
+
+
+def test_pending_configs(tmp_path):
+    write_run(tmp_path, '1', dict(data_source='gmm_1d', epsilon=1e-2, batch_size=None, seed=0, lr=1), 'COMPLETED')
+    write_run(tmp_path, '2', dict(data_source='gmm_1d', epsilon=1e-3, batch_size=None, seed=0, lr=1), 'FAILED')
+    configs = [dict(data_source='gmm_1d', epsilon=1e-2, batch_size=None, seed=0),
+               dict(data_source='gmm_1d', epsilon=1e-3, batch_size=None, seed=0),
+               dict(data_source='gmm_1d', epsilon=1e-2, batch_size=10, seed=0)]
+    assert pending_configs(configs, str(tmp_path)) == configs[1:]
+
+
+def test_group_configs():
+    configs = [dict(data_source=data_source, seed=seed) for seed in range(5) for data_source in ['a', 'b']]
+    chunks = group_configs(configs, chunk_size=2)
+    assert len(chunks) == 6
+    assert all(len(set(config['data_source'] for config in chunk)) == 1 for chunk in chunks)
+    assert sorted(config['seed'] for chunk in chunks for config in chunk) == sorted(list(range(5)) * 2)
+
+
+def touch(config):
+    if config['seed'] == 2:
+        raise ValueError('Failing config')
+    with open(os.path.join(config['output_dir'], str(config['seed'])), 'w+'):
+        pass
+
+
+def test_run_local(tmp_path):
+    configs = [dict(seed=seed, output_dir=str(tmp_path)) for seed in range(4)]
+    failures = run_local(touch, configs, n_workers=2, chunk_size=1, group_keys=('seed',), verbose=False)
+    assert [config['seed'] for config, _ in failures] == [2]
+    assert sorted(os.listdir(tmp_path)) == ['0', '1', '3']
+
+
+def fake_run(config):
+    if config['lr'] == 0:
+        raise ValueError('Diverging config')
+    return dict(fixed_err_train=config['lr'] * (1 + config['seed']) / config['max_calls'],
+                checkpoint=config['checkpoint'])
+
+
+def test_successive_halving(tmp_path):
+    configs = [dict(data_source=data_source, lr=lr, seed=seed)
+               for data_source in ['a', 'b'] for lr in [0, 1, 2, 3, 4, 5] for seed in range(2)]
+    rungs = successive_halving(fake_run, configs, 10, 100, eta=3, checkpoint_dir=str(tmp_path), verbose=False)
+    assert [budget for budget, _ in rungs] == [10, 30, 90, 100]
+    assert [len(runs) for _, runs in rungs] == [24, 8, 4, 4]
+    for data_source in ['a', 'b']:
+        lrs = [sorted(set(config['lr'] for config, _ in runs if config['data_source'] == data_source))
+               for _, runs in rungs]
+        assert lrs == [[0, 1, 2, 3, 4, 5], [1, 2], [1], [1]]
+    checkpoints = set(result['checkpoint'] for _, runs in rungs for _, result in runs if result is not None)
+    assert len(checkpoints) == 20  # One per config, kept across budgets
+
+
+def test_successive_halving_methods(tmp_path):
+    # Methods solve the same problem but do not compete: each keeps its best candidate
+    configs = [dict(data_source='a', method=method, lr=lr, seed=0)
+               for method, lrs in [('online', [1, 2, 3]), ('sinkhorn', [4, 5, 6])] for lr in lrs]
+    rungs = successive_halving(fake_run, configs, 10, 30, eta=3, checkpoint_dir=str(tmp_path), verbose=False)
+    assert sorted((config['method'], config['lr']) for config, _ in rungs[-1][1]) == [('online', 1), ('sinkhorn', 4)]
+
+
+def online_run(config):
+    x, la, y, lb, x_sampler, y_sampler = make_data('gmm_1d', 100)
+    F, G, trace = online_sinkhorn(x=x, la=la, y=y, lb=lb, n_iter=None, batch_sizes=10, lrs=config['lr'],
+                                  max_calls=config['max_calls'], trace_every=config['max_calls'] // 4,
+                                  save_trace=True, ref={'train': (None, x, None, y)}, verbose=False)
+    return trace[-1]
+
+
+def test_successive_halving_online(capsys):
+    # Real traces, with the default lr=1 of online.py among the candidates
+    configs = [dict(data_source='gmm_1d', method='online', lr=lr, seed=0) for lr in [1, .5, .1]]
+    rungs = successive_halving(online_run, configs, 1e5, 3e5, eta=3)
+    assert all(result is not None and math.isfinite(last_fixed_err(result)) for _, result in rungs[0][1])
+    assert len(rungs[-1][1]) == 1
+    assert 'Dropping' not in capsys.readouterr().out
@@ -0,0 +1,37 @@
+import pytest
+
+from onlikhorn.algorithm import online_sinkhorn, schedule, InfinitePotential
+from onlikhorn.dataset import make_data
+from onlikhorn.memory import potential_bytes, project_online_memory
+
+
+def test_memory_trace():
+    x, la, y, lb, x_sampler, y_sampler = make_data('gmm_1d', 50)
+    ref = {'train': (None, x, None, y)}
+    F, G, trace = online_sinkhorn(x=x, la=la, y=y, lb=lb, n_iter=5, save_trace=True, ref=ref, verbose=False)
+    for this_trace in trace:
+        assert this_trace['mem_peak_rss'] >= this_trace['mem_rss'] > 0
+        assert this_trace['mem_F'] > 0 and this_trace['mem_G'] > 0
+        assert this_trace['mem_C'] == 0
+
+
+@pytest.mark.parametrize("use_finite", [False, True])
+def test_dry_run(use_finite):
+    x, la, y, lb, x_sampler, y_sampler = make_data('gmm_2d', 100)
+    batch_sizes, lrs, _ = schedule(1., 10, 1., 'auto', 1000, 20, False)
+    peak, projection = online_sinkhorn(x=x, la=la, y=y, lb=lb, x_sampler=x_sampler, y_sampler=y_sampler,
+                                       use_finite=use_finite, batch_sizes=batch_sizes, lrs=lrs, max_length=1000,
+                                       dry_run=True)
+    assert len(projection) == len(batch_sizes)
+    assert peak == max(entry['mem_total'] for entry in projection)
+    if use_finite:  # Compact buffers are freed once all atoms are seen
+        assert projection[-1]['mem_F'] == 100 * 3 * 4 < projection[0]['mem_F']
+    else:
+        F = InfinitePotential(max_length=1000, dimension=2)
+        assert projection[0]['mem_F'] == potential_bytes(F)
+
+
+def test_force_full_projection():
+    peak, projection = project_online_memory([10] * 20, 2, n_x=50, n_y=50, force_full=True, precompute_C=True)
+    assert projection[-1]['mem_batches'] == 0  # Sinkhorn iterations
+    assert all(entry['mem_C'] == 50 * 50 * 4 + 50 + 50 for entry in projection)  # Tile and filled rows, columns
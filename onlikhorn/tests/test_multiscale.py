@@ -0,0 +1,30 @@
+import pytest
+import torch
+
+from onlikhorn.algorithm import sinkhorn
+from onlikhorn.dataset import make_data
+from onlikhorn.multiscale import make_hierarchy, multiscale_sinkhorn
+
+
+@pytest.mark.parametrize("method", ['grid', 'kmeans'])
+def test_make_hierarchy(method):
+    x, la, y, lb, x_sampler, y_sampler = make_data('gmm_2d', 200)
+    levels = make_hierarchy(x, la, y, lb, n_levels=3, method=method, base_resolution=4, coarsening=4)
+    assert len(levels) == 3
+    assert levels[-1][0] is x
+    for xl, lal, yl, lbl in levels:
+        assert len(xl) == len(lal) and len(yl) == len(lbl)
+        assert abs(torch.logsumexp(lal, dim=0).item()) < 1e-4
+    assert len(levels[0][0]) <= len(levels[1][0]) <= len(x)
+
+
+@pytest.mark.parametrize("method", ['grid', 'kmeans'])
+def test_multiscale_sinkhorn(method):
+    x, la, y, lb, x_sampler, y_sampler = make_data('gmm_2d', 200)
+    F, G = sinkhorn(x=x, la=la, y=y, lb=lb, n_iter=2000, epsilon=1e-1, tol=1e-6)
+    Fm, Gm, trace = multiscale_sinkhorn(x=x, la=la, y=y, lb=lb, n_iter=2000, epsilon=1e-1, tol=1e-6,
+                                        method=method, base_resolution=4, coarsening=4, save_trace=True,
+                                        verbose=False)
+    assert trace[-1]['level'] == 2
+    assert (Fm(x) - F(x)).abs().max().item() < 1e-3
+    assert (Gm(y) - G(y)).abs().max().item() < 1e-3
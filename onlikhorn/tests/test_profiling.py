@@ -0,0 +1,56 @@
+import json
+
+import pytest
+
+from onlikhorn.algorithm import sinkhorn, online_sinkhorn, FinitePotential
+from onlikhorn.dataset import make_data
+from onlikhorn.profiling import Profiler
+
+
+def test_n_calls():
+    x, la, y, lb, x_sampler, y_sampler = make_data('gmm_2d', 30)
+    F = FinitePotential(y[:20], lb[:20], epsilon=1e-1)
+    F.profiler = profiler = Profiler()
+    F(x)
+    assert F.n_calls_ == 30 * 20 * 2
+    assert profiler.totals['logsumexp']['pairs'] == F.n_calls_
+    F(x, return_C=True)
+    assert F.n_calls_ == 2 * 30 * 20 * 2
+    assert profiler.totals['distance']['count'] == 1
+
+
+@pytest.mark.parametrize("algorithm", ['sinkhorn', 'online'])
+def test_profiler(algorithm, tmp_path):
+    x, la, y, lb, x_sampler, y_sampler = make_data('gmm_1d', 50)
+    ref = {'train': (None, x, None, y)}
+    profiler = Profiler()
+    func = sinkhorn if algorithm == 'sinkhorn' else online_sinkhorn
+    F, G, trace = func(x=x, la=la, y=y, lb=lb, n_iter=5, save_trace=True, ref=ref, verbose=False,
+                       profiler=profiler)
+    assert 'profile_push_time' in trace[-1]
+    assert 'profile_logsumexp_pairs' in trace[-1]
+    if algorithm == 'online':
+        assert profiler.totals['sampling']['count'] > 0
+    filename = tmp_path / 'profile.json'
+    profiler.save_chrome_trace(filename)
+    with open(filename, 'r') as f:
+        events = json.load(f)['traceEvents']
+    assert len(events) == sum(total['count'] for total in profiler.totals.values())
+    assert all(event['dur'] >= 0 for event in events)
+
+
+def test_exclusive_phases():
+    x, la, y, lb, x_sampler, y_sampler = make_data('gmm_1d', 50)
+    ref = {'train': (None, x, None, y)}
+    profiler = Profiler()
+    F, G, trace = sinkhorn(x=x, la=la, y=y, lb=lb, n_iter=5, save_trace=True, ref=ref, verbose=False,
+                           precompute_C=False, profiler=profiler)
+    # Reductions of trace evaluations are counted in 'evaluate', and columns are counted since the last trace point
+    for this_trace, next_trace in zip(trace[:-1], trace[1:]):
+        assert next_trace['profile_logsumexp_pairs'] == next_trace['n_calls'] - this_trace['n_calls']
+        assert next_trace['profile_evaluate_pairs'] > 0
+    with profiler.phase('refit'):
+        with profiler.phase('logsumexp', pairs=10):
+            pass
+    assert profiler.totals['logsumexp']['count'] == 2 * len(trace) + 2
+    assert profiler.totals['refit']['time'] <= profiler.events[-1][2] - profiler.events[-1][1]
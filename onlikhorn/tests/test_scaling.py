@@ -0,0 +1,35 @@
+import pytest
+
+from onlikhorn.algorithm import sinkhorn
+from onlikhorn.dataset import make_data
+from onlikhorn.scaling import kernel_sinkhorn
+
+
+@pytest.mark.parametrize("epsilon", [1., 1e-1, 1e-2])
+@pytest.mark.parametrize("save_trace", [True, False])
+def test_kernel_sinkhorn(epsilon, save_trace):
+    x, la, y, lb, x_sampler, y_sampler = make_data('gmm_1d', 100)
+    y, lb = y[:80], lb[:80] - lb[:80].logsumexp(dim=0)
+    F, G = sinkhorn(x=x, la=la, y=y, lb=lb, n_iter=2000, epsilon=epsilon, tol=1e-6)
+    res = kernel_sinkhorn(x=x, la=la, y=y, lb=lb, n_iter=2000, epsilon=epsilon, tol=1e-6,
+                          save_trace=save_trace, ref={'train': (F(x), x, G(y), y)}, verbose=False)
+    if save_trace:
+        Fk, Gk, trace = res
+        assert trace[-1]['algorithm'] == 'kernel'
+    else:
+        Fk, Gk = res
+    assert (Fk(x) - F(x)).abs().max().item() < 1e-3
+    assert (Gk(y) - G(y)).abs().max().item() < 1e-3
+
+
+def test_kernel_sinkhorn_trace():
+    x, la, y, lb, x_sampler, y_sampler = make_data('gmm_1d', 100)
+    ref = {'train': (None, x, None, y)}
+    _, _, trace = sinkhorn(x=x, la=la, y=y, lb=lb, n_iter=10, epsilon=1e-1, save_trace=True, ref=ref, verbose=False)
+    _, _, trace_k = kernel_sinkhorn(x=x, la=la, y=y, lb=lb, n_iter=10, epsilon=1e-1, save_trace=True, ref=ref,
+                                    verbose=False)
+    assert [this_trace['n_iter'] for this_trace in trace_k] == [this_trace['n_iter'] for this_trace in trace]
+    for this_trace, this_trace_k in zip(trace, trace_k):
+        assert this_trace_k['fixed_err'] == pytest.approx(this_trace['fixed_err'], rel=1e-3, abs=1e-5)
+    with pytest.raises(ValueError):
+        kernel_sinkhorn(x=x, la=la, y=y, lb=lb, precompute_C=False)
@@ -0,0 +1,74 @@
+import math
+
+import torch
+
+from onlikhorn.kernels import tiled_logsumexp
+
+
+def grid_cells(points, origin, cell_size):
+    """Integer cell coordinates of the occupied cells, and the cell index of every point."""
+    coords = torch.floor((points - origin[None, :]) / cell_size).long()
+    cells, labels = torch.unique(coords, dim=0, return_inverse=True)
+    return cells, labels
+
+
+def gather_ranges(starts, counts):
+    """Concatenation of the index ranges [start, start + count)."""
+    offsets = torch.cumsum(counts, dim=0) - counts
+    total = counts.sum().item()
+    return (torch.arange(total, device=starts.device) + torch.repeat_interleave(starts - offsets, counts))
+
+
+def truncated_logsumexp(x, y, weights, epsilon, C=None, block_size=None, tol=1e-6, cell_size=None,
+                        max_cells=64, chunk_size=256):
+    """log sum_j exp((weights_j - C(x_i, y_j)) / epsilon), skipping pairs of grid cells that cannot contribute.
+
+    Queries and atoms are bucketed in a common grid. For a query cell q and an atom cell a, box distances give an
+    upper bound U(q, a) on the log-sum over the atoms of a, and a lower bound on the contribution of their heaviest
+    atom; L(q) is the largest of these lower bounds. Atom cells with U(q, a) < L(q) + log(tol / n_cells) are
+    skipped, so that the skipped mass is at most tol times the kept mass: the returned value is at most
+    log(1 + tol) <= tol below the exact one, i.e. potentials are off by at most epsilon * tol.
+    Meant for low-dimensional data, where most cell pairs are pruned when epsilon is small.
+    """
+    if C is not None:
+        raise ValueError('Truncated evaluation cannot use a precomputed cost')
+    n, d = x.shape
+    finite = weights > -float('inf')
+    y, weights = y[finite], weights[finite]
+    if n == 0 or len(y) == 0:  # No query, or no atom of positive mass
+        return torch.full((n,), fill_value=-float('inf'), dtype=x.dtype, device=x.device)
+    origin = torch.min(x.min(dim=0)[0], y.min(dim=0)[0])
+    extent = (torch.max(x.max(dim=0)[0], y.max(dim=0)[0]) - origin).max().item()
+    if cell_size is None:
+        cell_size = max(2 * math.sqrt(epsilon), extent / max_cells)
+    cell_size = max(cell_size, 1e-12)
+
+    x_cells, x_labels = grid_cells(x, origin, cell_size)
+    y_cells, y_labels = grid_cells(y, origin, cell_size)
+    x_order, y_order = torch.argsort(x_labels), torch.argsort(y_labels)
+    x_sorted, y_sorted, w_sorted = x[x_order], y[y_order], weights[y_order]
+    x_counts = torch.bincount(x_labels, minlength=len(x_cells))
+    y_counts = torch.bincount(y_labels, minlength=len(y_cells))
+    x_starts = torch.cumsum(x_counts, dim=0) - x_counts
+    y_starts = torch.cumsum(y_counts, dim=0) - y_counts
+    y_max_weight = torch.full((len(y_cells),), fill_value=-float('inf'), dtype=weights.dtype, device=weights.device)
+    y_max_weight = y_max_weight.scatter_reduce(0, y_labels, weights, reduce='amax')
+    log_threshold = math.log(tol / len(y_cells))
+
+    out = torch.empty(n, dtype=x.dtype, device=x.device)
+    for q0 in range(0, len(x_cells), chunk_size):
+        q_cells = x_cells[q0:q0 + chunk_size]
+        gap = (q_cells[:, None, :] - y_cells[None, :, :]).abs().to(x.dtype)
+        min_dist = ((gap - 1).clamp_min(0) * cell_size) ** 2
+        max_dist = ((gap + 1) * cell_size) ** 2
+        upper = (y_max_weight[None, :] - min_dist.sum(dim=2) / 2) / epsilon + torch.log(y_counts.to(x.dtype))[None, :]
+        lower = ((y_max_weight[None, :] - max_dist.sum(dim=2) / 2) / epsilon).max(dim=1)[0]
+        keep = upper >= lower[:, None] + log_threshold
+        for k in range(len(q_cells)):
+            q = q0 + k
+            kept = torch.nonzero(keep[k])[:, 0]
+            idx = gather_ranges(y_starts[kept], y_counts[kept])
+            rows = slice(x_starts[q].item(), x_starts[q].item() + x_counts[q].item())
+            out[x_order[rows]] = tiled_logsumexp(x_sorted[rows], y_sorted[idx], w_sorted[idx], epsilon,
+                                                 block_size=block_size)
+    return out
@@ -0,0 +1,59 @@
+"""Accuracy of reduced-precision cost storage (sinkhorn(precompute_C=True, cost_dtype=...)) against float32."""
+import json
+from os.path import join
+
+import numpy as np
+import torch
+
+from onlikhorn.algorithm import sinkhorn, var_norm
+from onlikhorn.dataset import get_output_dir, make_data
+from onlikhorn.kernels import precompute_cost, compute_distance
+
+data_sources = ['gmm_10d', 'dragon_2']
+epsilons = [1e-1, 1e-2, 1e-3]
+cost_dtypes = ['float16', 'bfloat16', 'int16']
+n_samples = 5000
+n_iter = 500
+seed = 0
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+
+def get_data(data_source):
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    x, la, y, lb, x_sampler, y_sampler = make_data(data_source, n_samples)
+    if len(x) > n_samples:  # dragon: subsample the full clouds
+        x, la, _ = x_sampler(n_samples)
+        y, lb, _ = y_sampler(n_samples)
+    return x.to(device), la.to(device), y.to(device), lb.to(device)
+
+
+def main():
+    report = []
+    for data_source in data_sources:
+        x, la, y, lb = get_data(data_source)
+        C = compute_distance(x, y)
+        references = {epsilon: sinkhorn(x, la, y, lb, n_iter=n_iter, epsilon=epsilon, precompute_C=C, verbose=False)
+                      for epsilon in epsilons}
+        for cost_dtype in cost_dtypes:
+            Cc = precompute_cost(x, y, dtype=cost_dtype)
+            cost_err = (Cc.tile(slice(None), slice(None)) - C[..., 0]).abs().max().item()
+            for epsilon in epsilons:
+                F, G = references[epsilon]
+                Fc, Gc = sinkhorn(x, la, y, lb, n_iter=n_iter, epsilon=epsilon, precompute_C=Cc, verbose=False)
+                f, g, fc, gc = F(x, C=C), G(y, C=C.transpose(0, 1)), Fc(x, C=C), Gc(y, C=C.transpose(0, 1))
+                w = ((f * la.exp()).sum() + (g * lb.exp()).sum()).item()
+                wc = ((fc * la.exp()).sum() + (gc * lb.exp()).sum()).item()
+                res = dict(data_source=data_source, cost_dtype=cost_dtype, epsilon=epsilon,
+                           cost_max=C.max().item(), cost_err=cost_err,
+                           potential_err=(var_norm(f - fc) + var_norm(g - gc)).item(),
+                           w=w, w_rel_err=abs(w - wc) / abs(w),
+                           bytes=Cc.nbytes, bytes_float32=C.numel() * C.element_size())
+                print(' '.join(f'{k}:{v:.2e}' if type(v) in [int, float] else f'{k}:{v}' for k, v in res.items()))
+                report.append(res)
+    with open(join(get_output_dir(), 'cost_precision.json'), 'w+') as f:
+        json.dump(report, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
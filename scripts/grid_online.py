@@ -1,4 +1,5 @@
 #!/bin/env python
+import argparse
 import os
 import subprocess
 from os.path import join
@@ -6,6 +7,7 @@ from os.path import join
 from sklearn.model_selection import ParameterGrid
 
 from onlikhorn.dataset import get_output_dir
+from onlikhorn.grid import run_local, successive_halving
 import numpy as np
 
 SLURM_TEMPLATE = """#!/bin/env bash
@@ -48,163 +50,209 @@ def create_one(config, index=0):
     return filename
 
 
-grid = 'online'
-
-if grid == 'online':
-    n_seeds = 3
-    seeds = list(range(n_seeds))
-    epsilons = [1e-4, 1e-3, 1e-2, 1e-1]
-    data_sources = ['gmm_1d', 'gmm_2d', 'gmm_10d', 'gaussian_2d', 'gaussian_10d']
-    reference = ParameterGrid({'data_source': data_sources,
-                               'seed': seeds,
-                               'batch_size': [1000, 10000, None],
-                               'epsilon': epsilons,
-                               'method': ['sinkhorn'],
-                               })
-    random = ParameterGrid({'data_source': data_sources,
-                            'batch_size': [1000, 10000],
-                            'seed': seeds,
-                            'epsilon': epsilons,
-                            'method': ['random'],
-                            })
-    online_non_convergent = ParameterGrid({'data_source': data_sources,
-                                           'batch_size': [1000, 10000],
-                                           'seed': seeds,
-                                           'epsilon': epsilons,
-                                           'method': ['online'],
-                                           'refit': [True, False],
-                                           'batch_exp': [0],
-                                           'lr_exp': [0, .5, 1]})
-    online = ParameterGrid({'data_source': data_sources,
-                            'batch_size': [1000, 10000],
-                            'seed': seeds,
-                            'epsilon': epsilons,
-                            'method': ['online'],
-                            'refit': [True, False],
-                            'batch_exp': [0, .5, 1],
-                            'lr_exp': ['auto']})
-    #
-    grids = [reference, random, online_non_convergent, online]
-
-
-# Dragon online warmup
-elif grid == 'warmup':
-    n_seeds = 3
-    seeds = list(range(n_seeds))
-    epsilons = [1e-4, 1e-3, 1e-2, 1e-1]
-    data_sources = ['dragon', 'gmm_1d', 'gmm_2d', 'gmm_10d']
-    reference = ParameterGrid({'data_source': data_sources,
-                               'seed': seeds,
-                               'epsilon': epsilons,
-                               'method': ['sinkhorn'],
-                               })
-    online = ParameterGrid({'data_source': data_sources,
-                            'batch_size': [100, 1000],
-                            'seed': seeds,
-                            'epsilon': epsilons,
-                            'method': ['online'],
-                            'force_full': [True],
-                            'precompute_C': [True, False],
-                            'refit': [False],
-                            'batch_exp': [0, .5],
-                            'lr_exp': [0, .5, 1]})
-
-    grids = [reference, online]
-
-elif grid == 'gaussian':
-    n_seeds = 3
-    seeds = list(range(n_seeds))
-    epsilons = [1e-4, 1e-3, 1e-2, 1e-1]
-    data_sources = ['gaussian_2d', 'gaussian_10d']
-    reference = ParameterGrid({'data_source': data_sources,
-                               'seed': seeds,
-                               'epsilon': epsilons,
-                               'method': ['sinkhorn'],
-                               })
-    subsampled = ParameterGrid({'data_source': data_sources,
-                                'batch_size': [100, 1000],
+def make_grids(grid='online'):
+    if grid == 'online':
+        n_seeds = 3
+        seeds = list(range(n_seeds))
+        epsilons = [1e-4, 1e-3, 1e-2, 1e-1]
+        data_sources = ['gmm_1d', 'gmm_2d', 'gmm_10d', 'gaussian_2d', 'gaussian_10d']
+        reference = ParameterGrid({'data_source': data_sources,
+                                   'seed': seeds,
+                                   'batch_size': [1000, 10000, None],
+                                   'epsilon': epsilons,
+                                   'method': ['sinkhorn'],
+                                   })
+        random = ParameterGrid({'data_source': data_sources,
+                                'batch_size': [1000, 10000],
                                 'seed': seeds,
                                 'epsilon': epsilons,
-                                'method': ['subsampled'],
+                                'method': ['random'],
                                 })
-    random = ParameterGrid({'data_source': data_sources,
-                            'batch_size': [100, 1000],
-                            'seed': seeds,
-                            'epsilon': epsilons,
-                            'method': ['random'],
-                            })
-    online_non_convergent = ParameterGrid({'data_source': data_sources,
-                                           'batch_size': [100],
-                                           'seed': seeds,
-                                           'epsilon': epsilons,
-                                           'method': ['online'],
-                                           'refit': [False, True],
-                                           'batch_exp': [0],
-                                           'lr_exp': [0, .5, 1]})
-    online = ParameterGrid({'data_source': data_sources,
-                            'batch_size': [100],
-                            'seed': seeds,
-                            'epsilon': epsilons,
-                            'method': ['online'],
-                            'refit': [True, False],
-                            'batch_exp': [0, .5, 1],
-                            'lr_exp': ['auto']})
-    grids = [reference, subsampled, random, online_non_convergent, online]
-
-elif grid == 'quiver':
-    n_seeds = 1
-    seeds = list(range(n_seeds))
-    epsilons = [1e-3]
-    data_sources = ['gmm_2d']
-    reference = ParameterGrid({'data_source': data_sources,
-                               'n_samples': [10000],
-                               'seed': seeds,
-                               'epsilon': epsilons,
-                               'n_iter': [10000],
-                               'max_calls': [1e11],
-                               'method': ['sinkhorn'],
-                               })
-    compete = ParameterGrid({'data_source': data_sources,
-                             'n_samples': [10000],
-                             'batch_size': [10, 100],
-                             'n_iter': [10000],
-                             'seed': seeds,
-                             'epsilon': epsilons,
-                             'max_calls': [1e8],
-                             'method': ['online'],
-                             'batch_exp': [0, .5, 1],
-                             'lr_exp': ['auto']
-                             })
-    subsampled = ParameterGrid({'data_source': data_sources,
-                                'n_samples': [1000],
-                                'batch_size': [10],
-                                'n_iter': [10000],
+        online_non_convergent = ParameterGrid({'data_source': data_sources,
+                                               'batch_size': [1000, 10000],
+                                               'seed': seeds,
+                                               'epsilon': epsilons,
+                                               'method': ['online'],
+                                               'refit': [True, False],
+                                               'batch_exp': [0],
+                                               'lr_exp': [0, .5, 1]})
+        online = ParameterGrid({'data_source': data_sources,
+                                'batch_size': [1000, 10000],
                                 'seed': seeds,
                                 'epsilon': epsilons,
-                                'max_calls': [1e8],
-                                'method': ['sinkhorn'],
+                                'method': ['online'],
+                                'refit': [True, False],
+                                'batch_exp': [0, .5, 1],
+                                'lr_exp': ['auto']})
+        #
+        grids = [reference, random, online_non_convergent, online]
+
+
+    # Dragon online warmup
+    elif grid == 'warmup':
+        n_seeds = 3
+        seeds = list(range(n_seeds))
+        epsilons = [1e-4, 1e-3, 1e-2, 1e-1]
+        data_sources = ['dragon', 'gmm_1d', 'gmm_2d', 'gmm_10d']
+        reference = ParameterGrid({'data_source': data_sources,
+                                   'seed': seeds,
+                                   'epsilon': epsilons,
+                                   'method': ['sinkhorn'],
+                                   })
+        online = ParameterGrid({'data_source': data_sources,
+                                'batch_size': [100, 1000],
+                                'seed': seeds,
+                                'epsilon': epsilons,
+                                'method': ['online'],
+                                'force_full': [True],
+                                'precompute_C': [True, False],
+                                'refit': [False],
+                                'batch_exp': [0, .5],
+                                'lr_exp': [0, .5, 1]})
+
+        grids = [reference, online]
+
+    elif grid == 'gaussian':
+        n_seeds = 3
+        seeds = list(range(n_seeds))
+        epsilons = [1e-4, 1e-3, 1e-2, 1e-1]
+        data_sources = ['gaussian_2d', 'gaussian_10d']
+        reference = ParameterGrid({'data_source': data_sources,
+                                   'seed': seeds,
+                                   'epsilon': epsilons,
+                                   'method': ['sinkhorn'],
+                                   })
+        subsampled = ParameterGrid({'data_source': data_sources,
+                                    'batch_size': [100, 1000],
+                                    'seed': seeds,
+                                    'epsilon': epsilons,
+                                    'method': ['subsampled'],
+                                    })
+        random = ParameterGrid({'data_source': data_sources,
+                                'batch_size': [100, 1000],
+                                'seed': seeds,
+                                'epsilon': epsilons,
+                                'method': ['random'],
                                 })
-    grids = [reference, compete, subsampled]
-
-job_folder = join(get_output_dir(), 'online', 'jobs')
-project_root = os.path.abspath(os.getcwd())
-if not os.path.exists(job_folder):
-    os.makedirs(job_folder)
-
-config_str = ''
-nb_jobs = 0
-for grid in grids:
-    for index, config in enumerate(grid):
-        config_str += ' '.join(f'{key}={value}' for key, value in config.items()) + '\n'
-        nb_jobs += 1
-
-print(nb_jobs)
-config_file = join(job_folder, f'config.txt')
-with open(config_file, 'w+') as f:
-    f.write(config_str)
-
-filename = join(job_folder, f'run.slurm')
-with open(filename, 'w+') as f:
-    f.write(SLURM_TEMPLATE.format(project_root=project_root,
-                                  config_str=config_str, nb_jobs=nb_jobs, config_file=config_file))
-subprocess.check_output("sbatch {}".format(filename), shell=True)
+        online_non_convergent = ParameterGrid({'data_source': data_sources,
+                                               'batch_size': [100],
+                                               'seed': seeds,
+                                               'epsilon': epsilons,
+                                               'method': ['online'],
+                                               'refit': [False, True],
+                                               'batch_exp': [0],
+                                               'lr_exp': [0, .5, 1]})
+        online = ParameterGrid({'data_source': data_sources,
+                                'batch_size': [100],
+                                'seed': seeds,
+                                'epsilon': epsilons,
+                                'method': ['online'],
+                                'refit': [True, False],
+                                'batch_exp': [0, .5, 1],
+                                'lr_exp': ['auto']})
+        grids = [reference, subsampled, random, online_non_convergent, online]
+
+    elif grid == 'quiver':
+        n_seeds = 1
+        seeds = list(range(n_seeds))
+        epsilons = [1e-3]
+        data_sources = ['gmm_2d']
+        reference = ParameterGrid({'data_source': data_sources,
+                                   'n_samples': [10000],
+                                   'seed': seeds,
+                                   'epsilon': epsilons,
+                                   'n_iter': [10000],
+                                   'max_calls': [1e11],
+                                   'method': ['sinkhorn'],
+                                   })
+        compete = ParameterGrid({'data_source': data_sources,
+                                 'n_samples': [10000],
+                                 'batch_size': [10, 100],
+                                 'n_iter': [10000],
+                                 'seed': seeds,
+                                 'epsilon': epsilons,
+                                 'max_calls': [1e8],
+                                 'method': ['online'],
+                                 'batch_exp': [0, .5, 1],
+                                 'lr_exp': ['auto']
+                                 })
+        subsampled = ParameterGrid({'data_source': data_sources,
+                                    'n_samples': [1000],
+                                    'batch_size': [10],
+                                    'n_iter': [10000],
+                                    'seed': seeds,
+                                    'epsilon': epsilons,
+                                    'max_calls': [1e8],
+                                    'method': ['sinkhorn'],
+                                    })
+        grids = [reference, compete, subsampled]
+    else:
+        raise ValueError(f'Unknown grid {grid}')
+    return grids
+
+
+def submit_slurm(grids):
+    job_folder = join(get_output_dir(), 'online', 'jobs')
+    project_root = os.path.abspath(os.getcwd())
+    if not os.path.exists(job_folder):
+        os.makedirs(job_folder)
+
+    config_str = ''
+    nb_jobs = 0
+    for grid in grids:
+        for index, config in enumerate(grid):
+            config_str += ' '.join(f'{key}={value}' for key, value in config.items()) + '\n'
+            nb_jobs += 1
+
+    print(nb_jobs)
+    config_file = join(job_folder, f'config.txt')
+    with open(config_file, 'w+') as f:
+        f.write(config_str)
+
+    filename = join(job_folder, f'run.slurm')
+    with open(filename, 'w+') as f:
+        f.write(SLURM_TEMPLATE.format(project_root=project_root,
+                                      config_str=config_str, nb_jobs=nb_jobs, config_file=config_file))
+    subprocess.check_output("sbatch {}".format(filename), shell=True)
+
+
+def run_online(config):
+    from online import exp  # Imported once per worker process
+
+    return exp.run(config_updates=config).result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a grid of online.py configs, with SLURM or locally')
+    parser.add_argument('--grid', default='online')
+    parser.add_argument('--local', action='store_true', help='Run in a local pool instead of submitting to SLURM')
+    parser.add_argument('--n-workers', type=int, default=1)
+    parser.add_argument('--chunk-size', type=int, default=None)
+    parser.add_argument('--halving', action='store_true',
+                        help='Successive halving over max_calls, only promoting the best configs (local)')
+    parser.add_argument('--min-calls', type=float, default=1e12)
+    parser.add_argument('--max-calls', type=float, default=1e14)
+    parser.add_argument('--eta', type=int, default=3)
+    args = parser.parse_args()
+
+    grids = make_grids(args.grid)
+    if args.halving:
+        from online import exp_dir
+
+        # Reference methods (sinkhorn, random) have no parameters to select
+        configs = [config for grid in grids for config in grid if config.get('method') == 'online']
+        rungs = successive_halving(run_online, configs, args.min_calls, args.max_calls, eta=args.eta,
+                                   checkpoint_dir=join(exp_dir, 'checkpoints'), n_workers=args.n_workers,
+                                   exp_dir=exp_dir)
+        for config, result in rungs[-1][1]:
+            print(config, result)
+    elif args.local:
+        from online import exp_dir
+
+        configs = [config for grid in grids for config in grid]
+        failures = run_local(run_online, configs, n_workers=args.n_workers, exp_dir=exp_dir,
+                             chunk_size=args.chunk_size)
+        for config, error in failures:
+            print(f'Failed: {config} {error}')
+    else:
+        submit_slurm(grids)
@@ -16,6 +16,8 @@ from onlikhorn.algorithm import sinkhorn, online_sinkhorn, random_sinkhorn, subs
 from onlikhorn.cache import torch_cached
 from onlikhorn.dataset import get_output_dir, make_data
 from onlikhorn.gaussian import sinkhorn_gaussian
+from onlikhorn.grid import config_id
+from onlikhorn.profiling import Profiler
 
 exp_name = 'online_grid_big_5'
 exp = Experiment(exp_name)
@@ -49,6 +51,15 @@ def config():
 
     precompute_C = False
     force_full = False
+    block_size = None  # Tiled evaluation on CPU, e.g. (1024, 8192)
+    backend = None  # 'dense', 'tiled', 'keops' or 'auto'
+    prefetch = None  # Number of batches drawn ahead in the background
+    profile = False  # Per-phase timings in the trace, and a Chrome trace in the artifacts
+    # Checkpoint file of the online solver, resumed from if it exists, None to disable checkpoints. With 'auto',
+    # named after the config in the output directory, so that a relaunched run resumes, and deleted once the run
+    # completes. With force_full and precompute_C, checkpoints hold the cost cache, up to n_samples ** 2 costs
+    checkpoint = None
+    checkpoint_every = 600.  # Seconds
 
     use_test = True
 
@@ -144,12 +155,20 @@ def debug_dragon():
 
 @exp.main
 def run(data_source, n_samples, epsilon, n_iter, device, method, max_calls, compare_with_ref, use_test,
-        n_eval, precompute_C, force_full, batch_exp, batch_size, lr, lr_exp, max_length, refit, _seed, _run):
+        n_eval, precompute_C, force_full, batch_exp, batch_size, lr, lr_exp, max_length, refit, block_size,
+        backend, prefetch, profile, checkpoint, checkpoint_every, _seed, _run, _config):
     np.random.seed(_seed)
     torch.manual_seed(_seed)
     output_dir = join(exp.observers[0].dir, 'artifacts')
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
+    default_checkpoint = checkpoint == 'auto'
+    if default_checkpoint:
+        checkpoint_dir = join(get_output_dir(), 'checkpoints')
+        if not os.path.exists(checkpoint_dir):
+            os.makedirs(checkpoint_dir)
+        run_config = {key: value for key, value in _config.items() if key not in ['checkpoint', 'checkpoint_every']}
+        checkpoint = join(checkpoint_dir, f'{exp_name}_{config_id(run_config)}.pkl')
 
     x, la, y, lb, x_sampler, y_sampler = make_data(data_source, n_samples)
 
@@ -187,18 +206,20 @@ def run(data_source, n_samples, epsilon, n_iter, device, method, max_calls, comp
         if use_test:
             ref['test'] = (None, xr, None, yr)
 
+    profiler = Profiler(synchronize=True) if profile else None
+
     if method == 'sinkhorn':
         n_iter = min(n_iter, int(2e3))  # Faster
         F, G, trace = subsampled_sinkhorn(x, la, y, lb, n_iter=n_iter, batch_size=batch_size,
                                           max_calls=max_calls, precompute_C=precompute_C,
-                                          trace_every=max_calls // n_eval,
-                                          epsilon=epsilon, save_trace=True, ref=ref)
+                                          trace_every=max_calls // n_eval, block_size=block_size, backend=backend,
+                                          epsilon=epsilon, save_trace=True, ref=ref, profiler=profiler)
     elif method == 'random':
         F, G, trace = random_sinkhorn(x_sampler=x_sampler, y_sampler=y_sampler, n_iter=n_iter,
                                       epsilon=epsilon, save_trace=True, ref=ref, use_finite=False,
                                       batch_sizes=batch_size,
-                                      trace_every=max_calls // n_eval,
-                                      max_calls=max_calls)
+                                      trace_every=max_calls // n_eval, block_size=block_size, backend=backend,
+                                      max_calls=max_calls, prefetch=prefetch, profiler=profiler)
     elif method == 'online':
         batch_sizes, lrs, lr_exp = schedule(batch_exp, batch_size, lr, lr_exp, max_length, n_iter, refit)
         print(f'Using lr_exp={lr_exp}')
@@ -208,11 +229,19 @@ def run(data_source, n_samples, epsilon, n_iter, device, method, max_calls, comp
                                           refit=refit, force_full=force_full, precompute_C=precompute_C,
                                           trace_every=max_calls // n_eval,
                                           lrs=lrs, n_iter=n_iter, use_finite=force_full, max_length=max_length,
-                                          epsilon=epsilon, save_trace=True, ref=ref, max_calls=max_calls)
+                                          epsilon=epsilon, save_trace=True, ref=ref, max_calls=max_calls,
+                                          block_size=block_size, backend=backend, prefetch=prefetch,
+                                          profiler=profiler, checkpoint=checkpoint,
+                                          checkpoint_every=checkpoint_every)
     else:
         raise ValueError
 
     torch.save(dict(x=x, la=la, y=y, lb=lb, F=F, G=G, trace=trace), join(output_dir, 'results.pkl'))
+    if default_checkpoint and os.path.exists(checkpoint):  # Can hold the whole cost cache
+        os.remove(checkpoint)
+    if profiler is not None:
+        profiler.save_chrome_trace(join(output_dir, 'profile.json'))
+    return trace[-1] if len(trace) > 0 else None  # Stored by sacred, e.g. to score runs in grid_online.py
 
 
 if __name__ == '__main__':